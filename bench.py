@@ -0,0 +1,618 @@
+"""Offline load test for bot.py with fake Telegram, Drive and Sheets backends
+
+    python bench.py --users 200 --seed 1 > bench_output.txt
+    python bench.py --users 2000 --ramp 120 --json after.json
+    python bench.py --cold-start 5
+
+Simulated students go through /start -> menu -> contact -> name -> documents and
+the admin verifies them. The report shows throughput, p50/p95/p99 per step, peak
+Python memory and how the waiting queue behaved. The same arguments and seed give
+the same workload (arrivals, document sizes, injected latencies and errors), so
+runs before and after a change can be compared (--json keeps the raw numbers).
+
+Nothing touches the network: real telegram Updates are put on the update queue
+of the Application that create_app() builds (OrderedApplication, SQLiteUserPersistence,
+the registered handlers, the job queue and the album path), whose Bot is swapped
+for a fake; Google helpers are swapped for in-memory fakes and queue.db lives in
+a scratch directory.
+
+--cold-start N measures startup instead: N fresh interpreters each import bot.py
+and call create_app(); the median must stay within COLD_START_BUDGET.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+
+import gspread
+import httplib2
+import requests
+from googleapiclient.errors import HttpError
+from telegram import Chat, Contact, Message, MessageEntity, PhotoSize, Update, User
+from telegram.error import RetryAfter
+from telegram.ext import TypeHandler
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STEPS = ['start', 'queue_wait', 'menu', 'contact', 'name', 'document', 'album', 'resend', 'sheet_delay', 'verify', 'status_delay',
+         'funnel']
+
+COLD_START_BUDGET = {'import': 0.6, 'create_app': 0.3}  # Seconds (median), on a typical dev machine
+
+bot = None  # bot.py, imported once the scratch directory is set up
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline load test for the FormCare bot")
+    p.add_argument('--users', type=int, default=200, help="simulated students")
+    p.add_argument('--ramp', type=float, default=20.0, help="seconds over which students arrive")
+    p.add_argument('--docs', type=int, default=3, help="documents per student")
+    p.add_argument('--doc-kb', type=int, default=300, help="mean document size in KB")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--verify', choices=['bulk', 'single'], default='bulk',
+                   help="bulk: /verifybulk once a second; single: one /verify per student "
+                        "(admin replies are paced at 1/s in the admin chat, so this mode is slow by design)")
+    p.add_argument('--telegram-latency', type=float, default=0.05, help="median seconds per Telegram call")
+    p.add_argument('--telegram-chat-limit', type=int, default=3, help="fake API: messages per second per chat before RetryAfter")
+    p.add_argument('--telegram-global-limit', type=int, default=30, help="fake API: messages per second before RetryAfter")
+    p.add_argument('--global-rate', type=float, default=None, help="override the bot's outbound messages/s")
+    p.add_argument('--drive-latency', type=float, default=0.3, help="median seconds per Drive call")
+    p.add_argument('--sheets-latency', type=float, default=0.5, help="median seconds per Sheets call")
+    p.add_argument('--drive-quota', type=int, default=3000, help="Drive calls per minute before 429")
+    p.add_argument('--sheets-quota', type=int, default=60, help="Sheets calls per minute before 429")
+    p.add_argument('--error-rate', type=float, default=0.01, help="share of Google calls failing with a 5xx")
+    p.add_argument('--resend-rate', type=float, default=0.0, help="share of documents the student sends a second time")
+    p.add_argument('--album-rate', type=float, default=0.25, help="share of students who send their documents as one album")
+    p.add_argument('--timeout', type=float, default=1800.0, help="give up on a student after this many seconds")
+    p.add_argument('--json', metavar='PATH', help="also write the results as JSON, for comparing runs")
+    p.add_argument('--cold-start', type=int, metavar='N', help="only measure import and create_app() time over N runs")
+    return p.parse_args(argv)
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+# ---------- Fake Google ----------
+class Quota:
+    """Calls per minute, refilled continuously like Google's per-minute quotas"""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.burst = max(1.0, per_minute / 6.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+def _sheets_error(status, message):
+    response = requests.Response()
+    response.status_code = status
+    response._content = ('{"error": {"code": %d, "message": "%s", "status": "FAKE"}}' % (status, message)).encode()
+    return gspread.exceptions.APIError(response)
+
+def _drive_error(status, message):
+    return HttpError(httplib2.Response({'status': status}), message.encode())
+
+class FakeGoogle:
+    """Drive folders/uploads and one worksheet, with latency, quotas and errors"""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.quota = {'drive': Quota(args.drive_quota), 'sheets': Quota(args.sheets_quota)}
+        self.rows = [['Name', 'Phone', 'Univ', 'College', 'Course', 'Session', 'Semester', 'Folder', 'Status']]
+        self.version = 1  # Drive's file version of the sheet, bumped by every write
+        self.folders = 0
+        self.keys = {}  # Idempotency key -> (id, link) of what was created with it
+        self.uploaded_bytes = 0
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def _call(self, api, op):
+        """Runs on a bot worker thread: sleep like the real API, then maybe fail"""
+        with self.lock:
+            self.calls[(api, op)] += 1
+            delay = getattr(self.args, f"{api}_latency") * self.rng.lognormvariate(0, 0.5)
+            allowed = self.quota[api].take()
+            failed = self.rng.random() < self.args.error_rate
+        time.sleep(delay)
+        make_error = _drive_error if api == 'drive' else _sheets_error
+        if not allowed:
+            with self.lock:
+                self.errors[(api, 'quota')] += 1
+            raise make_error(429, "Quota exceeded (fake)")
+        if failed:
+            with self.lock:
+                self.errors[(api, 'error')] += 1
+            raise make_error(503, "Backend error (fake)")
+
+    def create_drive_folder(self, name, key=None):
+        self._call('drive', 'create_folder')
+        with self.lock:
+            self.folders += 1
+            folder_id = f"folder{self.folders}"
+            if key:
+                self.keys[key] = (folder_id, f"https://drive.example/{folder_id}")
+        return folder_id, f"https://drive.example/{folder_id}"
+
+    def find_drive_file(self, key, folder_id=None):
+        self._call('drive', 'list')
+        with self.lock:
+            return self.keys.get(key)
+
+    def rename_drive_folder(self, folder_id, name):
+        self._call('drive', 'rename_folder')
+
+    def upload_file(self, stream, filename, folder_id, size=None, key=None):
+        self._call('drive', 'upload')
+        data = stream.read()
+        with self.lock:
+            self.uploaded_bytes += len(data)
+            if key:
+                self.keys[key] = (f"file{len(self.keys)}", None)
+
+    def append_sheet_rows(self, rows):
+        self._call('sheets', 'append')
+        with self.lock:
+            first = len(self.rows) + 1
+            self.rows.extend([list(row) + [''] * (9 - len(row)) for row in rows])
+            self.version += 1
+        return first
+
+    def get_sheet_values(self):
+        self._call('sheets', 'get_all_values')
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+    def get_sheet_names(self, rows):
+        self._call('sheets', 'batch_get')
+        with self.lock:
+            return [tuple(self.rows[row - 1][:2]) if row <= len(self.rows) else ('', '') for row in rows]
+
+    def update_sheet_statuses(self, statuses):
+        self._call('sheets', 'batch_update')
+        with self.lock:
+            for row, status in statuses:
+                self.rows[row - 1][8] = status
+            self.version += 1
+
+    def get_sheet_version(self):
+        self._call('drive', 'get_version')
+        with self.lock:
+            return self.version
+
+    def get_sheet_statuses(self):
+        self._call('sheets', 'batch_get')
+        with self.lock:
+            return [(i + 1, row[0], row[1], row[8]) for i, row in enumerate(self.rows)]
+
+    def has_row(self, phone):
+        with self.lock:
+            return any(row[1] == phone for row in self.rows)
+
+    def status(self, phone):
+        with self.lock:
+            return next((row[8] for row in self.rows if row[1] == phone), None)
+
+    def install(self):
+        """Swap bot.py's Google helpers for this fake"""
+        bot.create_drive_folder = self.create_drive_folder
+        bot.rename_drive_folder = self.rename_drive_folder
+        bot.find_drive_file = self.find_drive_file
+        bot._upload_file = self.upload_file
+        bot.append_sheet_rows = self.append_sheet_rows
+        bot.get_sheet_values = self.get_sheet_values
+        bot.get_sheet_names = self.get_sheet_names
+        bot.update_sheet_statuses = self.update_sheet_statuses
+        bot.get_sheet_version = self.get_sheet_version
+        bot.get_sheet_statuses = self.get_sheet_statuses
+        bot.get_sheet = bot.get_drive_service = lambda: None  # Nothing to warm up
+
+# ---------- Fake Telegram ----------
+class FakeFile:
+    def __init__(self, tg, file_id, size):
+        self.tg = tg
+        self.file_id = file_id
+        self.file_size = size
+        self.file_path = "documents/fake.jpg"  # Not a URL: read through download_to_memory
+
+    async def download_to_memory(self, out):
+        await asyncio.sleep(self.tg.latency() + self.file_size / (20 * 1024 * 1024))
+        out.write(self.file_id.encode().ljust(self.file_size, b'\0'))  # Distinct content per file
+
+class FakeTelegram:
+    """The parts of telegram.Bot the Application and handlers use, with Telegram-like flood limits"""
+
+    id = 1
+    username = "formcare_bench_bot"
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.sent = deque()  # Send times, for the global limit
+        self.sent_to = defaultdict(deque)  # chat_id -> send times
+        self.last_text = {}
+        self.replied = defaultdict(asyncio.Event)  # chat_id -> set by every message to the chat
+        self.admitted = defaultdict(asyncio.Event)
+        self.files = {}
+        self.calls = defaultdict(int)
+        self.flood_errors = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def latency(self):
+        return self.args.telegram_latency * self.rng.lognormvariate(0, 0.5)
+
+    async def _send(self, op, chat_id):
+        self.calls[op] += 1
+        now = time.monotonic()
+        for times in (self.sent, self.sent_to[chat_id]):
+            while times and now - times[0] > 1.0:
+                times.popleft()
+        if len(self.sent) >= self.args.telegram_global_limit or len(self.sent_to[chat_id]) >= self.args.telegram_chat_limit:
+            self.flood_errors += 1
+            raise RetryAfter(1)
+        self.sent.append(now)
+        self.sent_to[chat_id].append(now)
+        await asyncio.sleep(self.latency())
+        self.replied[chat_id].set()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._send('send_message', chat_id)
+        self.last_text[chat_id] = text
+        if text.startswith("🎉"):  # "आपकी बारी आ गई है!" (the queue message also says "आपकी बारी")
+            self.admitted[chat_id].set()
+
+    async def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._send('forward_message', chat_id)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._send('send_media_group', chat_id)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._send('send_document', chat_id)
+        self.last_text[chat_id] = kwargs.get('caption', '')
+
+    async def get_file(self, file_id):
+        self.calls['get_file'] += 1
+        await asyncio.sleep(self.latency())
+        return FakeFile(self, file_id, self.files[file_id])
+
+# ---------- Simulation ----------
+def find_menu_path(node, path=()):
+    """Button labels from the main menu to the first form that asks for the mobile number"""
+    for b in node['buttons']:
+        route = bot.MENU_ROUTES[(node['state'], b['label'])]
+        if route['action'] == 'request_mobile':
+            return list(path) + [b['label']]
+        if route['action'] == 'menu':
+            found = find_menu_path(route['next'], path + (b['label'],))
+            if found:
+                return found
+    return None
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.tg = FakeTelegram(args, random.Random(args.seed + 1))
+        self.google = FakeGoogle(args, random.Random(args.seed + 2))
+        self.app = bot.create_app(updater=False)
+        self.app.bot = self.tg
+        self.app.add_handler(TypeHandler(Update, self.handled), group=1)  # Runs once the bot's handler is done
+        self.pending = {}  # update_id -> future resolved when the update has been handled
+        self.samples = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.doc_errors = 0
+        self.resends = 0
+        self.completed = 0
+        self.update_ids = 0
+        self.queue_samples = []
+        self.verify_waiting = []  # (phone, name, future) for bulk mode
+        self.menu_path = find_menu_path(bot.MENU_TREE)
+
+    def update(self, chat_id, text=None, **fields):
+        """A private-chat message from chat_id, as Telegram would deliver it"""
+        self.update_ids += 1
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))] if text and text.startswith('/') else None
+        message = Message(self.update_ids, datetime.now(timezone.utc), Chat(chat_id, Chat.PRIVATE),
+                          from_user=User(chat_id, f"User{chat_id}", is_bot=False), text=text, entities=entities, **fields)
+        message.set_bot(self.tg)
+        return Update(self.update_ids, message=message)
+
+    async def handled(self, update, context):
+        future = self.pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def step(self, name, update):
+        """Put an update on the Application's queue and wait until it has been handled"""
+        future = self.pending[update.update_id] = asyncio.get_running_loop().create_future()
+        started = time.monotonic()
+        await self.app.update_queue.put(update)
+        await future
+        if name:
+            self.samples[name].append(time.monotonic() - started)
+
+    def photo(self, uid, d):
+        file_id = f"{uid}-{d}"
+        self.tg.files[file_id] = max(1024, int(self.rng.expovariate(1.0 / (self.args.doc_kb * 1024))))
+        return [PhotoSize(file_id, file_id, 1280, 960, file_size=self.tg.files[file_id])]
+
+    async def student(self, i, arrival):
+        await asyncio.sleep(arrival)
+        uid = 1_000_000 + i
+        phone = f"9{i:09d}"
+        name = f"Student {i}"
+        album = self.rng.random() < self.args.album_rate
+        started = time.monotonic()
+        stage = 'start'
+        try:
+            await self.step('start', self.update(uid, text='/start'))
+            if not await bot.run_db(bot.is_active_user, uid):
+                stage = 'queue_wait'
+                waited = time.monotonic()
+                await self.tg.admitted[uid].wait()
+                self.samples['queue_wait'].append(time.monotonic() - waited)
+                await self.step('start', self.update(uid, text=bot.RESTART_BUTTON))
+            stage = 'menu'
+            for label in self.menu_path:
+                await self.step('menu', self.update(uid, text=label))
+            stage = 'contact'
+            await self.step('contact', self.update(uid, contact=Contact(phone, f"User{uid}", user_id=uid)))
+            stage = 'name'
+            await self.step('name', self.update(uid, text=name))
+            if not self.app.user_data.get(uid, {}).get('waiting_docs'):
+                raise RuntimeError(self.tg.last_text.get(uid))
+            if album:
+                # One album: its items are collected and handled together after MEDIA_GROUP_WINDOW,
+                # so the step lasts until the bot's single reply
+                stage = 'album'
+                self.tg.replied[uid].clear()
+                waited = time.monotonic()
+                for d in range(self.args.docs):
+                    await self.step(None, self.update(uid, photo=self.photo(uid, d), media_group_id=f"album-{uid}"))
+                await self.tg.replied[uid].wait()
+                self.samples['album'].append(time.monotonic() - waited)
+                if self.tg.last_text.get(uid, '').startswith("⚠️"):
+                    self.doc_errors += 1
+            stage = 'document'
+            for d in range(0 if album else self.args.docs):
+                photo = self.photo(uid, d)
+                await self.step('document', self.update(uid, photo=photo))
+                if self.tg.last_text.get(uid, '').startswith("⚠️"):
+                    self.doc_errors += 1
+                if self.rng.random() < self.args.resend_rate:
+                    self.resends += 1
+                    await self.step('resend', self.update(uid, photo=photo))
+            stage = 'sheet_delay'
+            waited = time.monotonic()
+            while not self.google.has_row(phone):  # Rows reach the sheet through the write-behind writer
+                await asyncio.sleep(0.2)
+            self.samples['sheet_delay'].append(time.monotonic() - waited)
+            stage = 'verify'
+            await self.verify(phone, name)
+            mirrored = await bot.run_db(bot.db_fetchone, "SELECT status FROM sheet_mirror WHERE phone = ?", (phone,))
+            if not (mirrored and mirrored[0] == bot.VERIFIED_STATUS):
+                raise RuntimeError(self.tg.last_text.get(bot.ADMIN_ID))
+            stage = 'status_delay'
+            waited = time.monotonic()
+            while self.google.status(phone) != bot.VERIFIED_STATUS:  # A failed status write is retried from the outbox
+                await asyncio.sleep(0.5)
+            self.samples['status_delay'].append(time.monotonic() - waited)
+            self.samples['funnel'].append(time.monotonic() - started)
+            self.completed += 1
+        except Exception as e:
+            self.failures[stage] += 1
+            if self.failures[stage] <= 3:
+                print(f"student {i} failed at {stage}: {e}", file=sys.stderr)
+
+    async def verify(self, phone, name):
+        started = time.monotonic()
+        if self.args.verify == 'single':
+            await self.step(None, self.update(bot.ADMIN_ID, text=f"/verify {phone} {name}"))
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.verify_waiting.append((phone, name, future))
+            await future
+        self.samples['verify'].append(time.monotonic() - started)
+
+    async def bulk_verifier(self):
+        """The admin runs /verifybulk once a second for everyone who is ready"""
+        while True:
+            await asyncio.sleep(1.0)
+            batch, self.verify_waiting = self.verify_waiting, []
+            if not batch:
+                continue
+            text = "/verifybulk " + "\n".join(f"{phone} {name}" for phone, name, _ in batch)
+            try:
+                await self.step(None, self.update(bot.ADMIN_ID, text=text))
+            finally:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def sample_queue(self):
+        started = time.monotonic()
+        while True:
+            active = await bot.run_db(bot.get_active_user_count)
+            self.queue_samples.append((time.monotonic() - started, len(bot.waiting_index), active, bot.admission_control.limit))
+            await asyncio.sleep(0.5)
+
+    async def run(self):
+        self.google.install()
+        if self.args.global_rate:
+            bot.outbound._global = bot.RatePacer(self.args.global_rate * 60, burst=max(1, int(self.args.global_rate)))
+        await self.app.initialize()
+        await bot.on_startup(self.app)  # post_init only runs from run_polling/run_webhook
+        await self.app.start()
+        helpers = [asyncio.create_task(self.sample_queue())]
+        if self.args.verify == 'bulk':
+            helpers.append(asyncio.create_task(self.bulk_verifier()))
+        arrivals, t = [], 0.0
+        for _ in range(self.args.users):
+            t += self.rng.expovariate(self.args.users / self.args.ramp) if self.args.ramp > 0 else 0.0
+            arrivals.append(t)
+        started = time.monotonic()
+        students = [asyncio.wait_for(self.student(i, arrival), self.args.timeout) for i, arrival in enumerate(arrivals)]
+        results = await asyncio.gather(*students, return_exceptions=True)
+        timeouts = sum(isinstance(r, asyncio.TimeoutError) for r in results)
+        if timeouts:
+            self.failures['timeout'] += timeouts
+        self.elapsed = time.monotonic() - started
+        self.outbox = await bot.run_db(bot.get_outbox_counts)
+        for task in helpers:
+            task.cancel()
+        await self.app.stop()
+        await bot.on_shutdown(self.app)
+        await self.app.shutdown()
+
+    def report(self, peak_memory):
+        a = self.args
+        lines = [
+            f"FormCare bench: users={a.users} ramp={a.ramp}s docs={a.docs} doc_kb={a.doc_kb} seed={a.seed} verify={a.verify}",
+            f"fakes: telegram {a.telegram_latency}s (limits {a.telegram_chat_limit}/s per chat, {a.telegram_global_limit}/s total), "
+            f"drive {a.drive_latency}s ({a.drive_quota}/min), sheets {a.sheets_latency}s ({a.sheets_quota}/min), error rate {a.error_rate}, "
+            f"resend rate {a.resend_rate}, album rate {a.album_rate}",
+            "",
+            f"completed {self.completed}/{a.users} in {self.elapsed:.1f}s: "
+            f"{self.completed / self.elapsed:.2f} students/s, {self.completed * a.docs / self.elapsed:.2f} documents/s",
+        ]
+        if self.failures or self.doc_errors:
+            failed = ", ".join(f"{stage} {n}" for stage, n in sorted(self.failures.items()))
+            lines.append(f"failed: {failed or 'none'}; document uploads reported as failed: {self.doc_errors}")
+        if self.resends:
+            lines.append(f"documents sent twice: {self.resends}")
+        lines += ["", f"{'step':<12}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        for name in STEPS:
+            values = self.samples.get(name, [])
+            if values:
+                lines.append(f"{name:<12}{len(values):>7}" + "".join(f"{percentile(values, q):>8.3f}s" for q in (0.5, 0.95, 0.99, 1.0)))
+        lines.append("")
+        lines.append(f"peak Python memory (tracemalloc): {peak_memory / (1024 * 1024):.1f} MB")
+        if self.queue_samples:
+            waiting = [s[1] for s in self.queue_samples]
+            active = [s[2] for s in self.queue_samples]
+            limits = [s[3] for s in self.queue_samples]
+            drained = next((s[0] for s in self.queue_samples if s[0] > a.ramp and s[1] == 0), None)
+            lines.append(f"queue: max waiting {max(waiting)}, max active {max(active)}, "
+                         f"admission limit {limits[0]} -> {limits[-1]} (range {min(limits)}-{max(limits)}), "
+                         f"queue empty after ramp at {'%.1fs' % drained if drained is not None else 'never'}")
+        tg_calls = ", ".join(f"{op} {n}" for op, n in sorted(self.tg.calls.items()))
+        lines.append(f"telegram: {tg_calls}; RetryAfter from fake API: {self.tg.flood_errors}")
+        google_calls = ", ".join(f"{api}.{op} {n}" for (api, op), n in sorted(self.google.calls.items()))
+        google_errors = ", ".join(f"{api} {kind} {n}" for (api, kind), n in sorted(self.google.errors.items())) or "none"
+        lines.append(f"google: {google_calls}; errors: {google_errors}")
+        lines.append(f"uploaded {self.google.uploaded_bytes / (1024 * 1024):.1f} MB into {self.google.folders} folders; "
+                     f"left in the outbox: {self.outbox.get('pending', 0)} pending, {self.outbox.get('stuck', 0)} stuck")
+        return "\n".join(lines)
+
+    def results(self, peak_memory):
+        """The numbers behind the report, keyed for diffing two runs"""
+        return {
+            'args': vars(self.args),
+            'elapsed': self.elapsed,
+            'completed': self.completed,
+            'students_per_second': self.completed / self.elapsed,
+            'failures': dict(self.failures),
+            'document_errors': self.doc_errors,
+            'resends': self.resends,
+            'steps': {name: {'count': len(values), **{f"p{int(q * 100)}": percentile(values, q) for q in (0.5, 0.95, 0.99)},
+                             'max': max(values)}
+                      for name in STEPS if (values := self.samples.get(name))},
+            'peak_memory': peak_memory,
+            'queue': [{'t': t, 'waiting': w, 'active': a, 'limit': l} for t, w, a, l in self.queue_samples],
+            'telegram_calls': dict(self.tg.calls),
+            'telegram_flood_errors': self.tg.flood_errors,
+            'google_calls': {f"{api}.{op}": n for (api, op), n in self.google.calls.items()},
+            'google_errors': {f"{api}.{kind}": n for (api, kind), n in self.google.errors.items()},
+            'outbox': self.outbox,
+        }
+
+def load_bot(workdir):
+    """Import bot.py with queue.db in a scratch directory and no real credentials"""
+    global bot
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.chdir(workdir)
+    sys.path.insert(0, BOT_DIR)
+    bot = importlib.import_module('bot')
+    bot.init_queue_db()
+    logging.getLogger().setLevel(logging.WARNING)  # Keep per-request INFO logs out of the timings
+    return bot
+
+COLD_START_PROBE = """
+import sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import bot
+imported = time.perf_counter()
+bot.create_app()
+print(imported - started, time.perf_counter() - imported)
+"""
+
+def measure_cold_start(runs):
+    """Median seconds to import bot.py and to run create_app() in fresh interpreters,
+    checked against COLD_START_BUDGET; returns the process exit code"""
+    timings = {'import': [], 'create_app': []}
+    for _ in range(runs):
+        workdir = tempfile.mkdtemp(prefix='formcare_cold_')
+        env = dict(os.environ, BOT_TOKEN=os.environ.get("BOT_TOKEN", "0:bench"))
+        out = subprocess.run([sys.executable, '-c', COLD_START_PROBE, BOT_DIR], cwd=workdir, env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        timings['import'].append(float(out[-2]))
+        timings['create_app'].append(float(out[-1]))
+    over = False
+    for stage, values in timings.items():
+        median = statistics.median(values)
+        budget = COLD_START_BUDGET[stage]
+        over |= median > budget
+        print(f"{stage:<12} median {median:.3f}s  max {max(values):.3f}s  budget {budget:.3f}s"
+              f"{'  OVER BUDGET' if median > budget else ''}")
+    return 1 if over else 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.cold_start:
+        return measure_cold_start(args.cold_start)
+    json_path = os.path.abspath(args.json) if args.json else None  # Before load_bot() changes directory
+    workdir = tempfile.mkdtemp(prefix='formcare_bench_')
+    tracemalloc.start()
+    load_bot(workdir)
+    bench = Bench(args)
+    with contextlib.redirect_stdout(sys.stderr):  # bot.py prints its errors; keep stdout for the report
+        asyncio.run(bench.run())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(bench.report(peak))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(bench.results(peak), f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,17 +3,34 @@ import logging
 import datetime
 import asyncio
 import io
-import gspread
 import time
 import sqlite3
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InputMediaDocument, InputMediaPhoto
+from telegram.error import RetryAfter
+from telegram.ext import Application, BasePersistence, CommandHandler, MessageHandler, ContextTypes, PersistenceInput, filters
+import telegram
+from telegram.ext import _application as _ptb_application  # Internals used by OrderedApplication
 from dotenv import load_dotenv
 import json
+import html
+import csv
+import re
 import threading
+import functools
+import itertools
+import heapq
+import collections
+import contextlib
+import contextvars
+import tempfile
+import hashlib
+import hmac
+import httpx
+import signal
+import socket
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIGURATION ---
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -25,210 +42,2630 @@ ADMIN_ID = 8586560620  # ✅ आपका एडमिन आईडी
 # ✅ NEW: Change this to your new parent folder ID
 PARENT_FOLDER_ID = "1gF_W7CGNvOrxEf2greV7UylR_b0bp3ez"  # Replace with your new folder ID
 
+# Update delivery: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))  # Updates handled at once, across all users
+
+# Multi-worker mode: BOT_WORKERS > 1 runs a dispatcher that receives updates (webhook
+# or polling) and shards them by user id across that many worker processes, which
+# share queue.db. WORKER_INDEX is set by the dispatcher for its workers.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.getenv("WORKER_INDEX") else None
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8600"))  # Worker i listens on 127.0.0.1:WORKER_BASE_PORT + i
+SHARED_STATE = BOT_WORKERS > 1  # Other processes change queue.db too: no per-process caches of shared state
+
+# --- METRICS ---
+# In-process counters, gauges and latency histograms. They are served in
+# Prometheus text format on METRICS_PORT (0 = off) and summarised by /stats.
+# With TRACE_IDS=1 every log line carries the id of the update it belongs to,
+# so one slow registration can be followed end to end.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+if METRICS_PORT and WORKER_INDEX is not None:
+    METRICS_PORT += WORKER_INDEX  # One scrape target per worker
+TRACE_IDS = os.getenv("TRACE_IDS", "0") == "1"
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+
+_metrics = []
+_metrics_lock = threading.Lock()
+_started_at = time.time()
+
+def _label_text(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+class Counter:
+    def __init__(self, name, doc):
+        self.name, self.doc, self.kind = name, doc, 'counter'
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _metrics_lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    """Gauge set directly, or read from a callback when scraped"""
+
+    def __init__(self, name, doc, func=None):
+        super().__init__(name, doc)
+        self.kind = 'gauge'
+        self.func = func
+
+    def set(self, value, **labels):
+        with _metrics_lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.func is not None:
+            return [(self.name, (), self.func())]
+        return super().samples()
+
+class Histogram:
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.kind = name, doc, 'histogram'
+        self.buckets = buckets
+        self.values = {}  # labels -> [per-bucket counts (+inf last), sum, count]
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _metrics_lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def quantile(self, q, key):
+        """Estimate a quantile from the bucket counts (upper bucket bound)"""
+        counts, _, total = self.values[key]
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        result = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                result.append((f"{self.name}_bucket", key + (('le', bound),), cumulative))
+            result.append((f"{self.name}_sum", key, round(total, 6)))
+            result.append((f"{self.name}_count", key, count))
+        return result
+
+HANDLER_SECONDS = Histogram('formcare_handler_seconds', 'Time spent in each update handler')
+HANDLER_ERRORS = Counter('formcare_handler_errors_total', 'Handler calls that raised')
+GOOGLE_SECONDS = Histogram('formcare_google_call_seconds', 'Latency of Google API calls by operation')
+GOOGLE_ERRORS = Counter('formcare_google_call_errors_total', 'Failed Google API calls by operation')
+TELEGRAM_SECONDS = Histogram('formcare_telegram_call_seconds', 'Latency of Telegram downloads and sends by operation')
+UPLOAD_BYTES = Counter('formcare_upload_bytes_total', 'Bytes uploaded to Drive')
+UPLOADS = Counter('formcare_uploads_total', 'Files uploaded to Drive')
+DUPLICATE_DOCUMENTS = Counter('formcare_duplicate_documents_total', 'Resent documents skipped, by how they were recognised')
+ACTIVE_USERS = Gauge('formcare_active_users', 'Users currently filling forms')
+
+def render_metrics():
+    """All metrics in Prometheus text exposition format"""
+    lines = []
+    with _metrics_lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{_label_text(labels)} {value}" for name, labels, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+def timed(callback):
+    """Wrap a handler callback so its latency and failures are recorded"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.monotonic()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=callback.__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.monotonic() - started, handler=callback.__name__)
+    return wrapper
+
+async def _serve_metrics(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 10)
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logging.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """Serve /metrics on METRICS_LISTEN:METRICS_PORT (only when METRICS_PORT is set)"""
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(_serve_metrics, METRICS_LISTEN, METRICS_PORT)
+    logging.info(f"Metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+# Trace ids: set per update in OrderedApplication.process_update and inherited by
+# the tasks and Google worker calls started while handling it.
+trace_id = contextvars.ContextVar('trace_id', default='-')
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id.get()
+        return True
+
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TraceIdFilter())
+    if TRACE_IDS:
+        _handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'))
+
 # --- QUEUE SYSTEM SETUP ---
+# One long-lived connection to queue.db in WAL mode, shared by every thread behind
+# a lock. Handlers use the async wrapper run_db(), which runs queries on a single
+# dedicated DB thread so the event loop never waits on disk I/O.
+QUEUE_DB = os.getenv("QUEUE_DB", 'queue.db')  # Shared by all workers in multi-worker mode
+
+_db_lock = threading.RLock()
+_db_conn = None
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue-db')
+
+def get_db():
+    """Get the shared queue.db connection"""
+    global _db_conn
+    with _db_lock:
+        if _db_conn is None:
+            conn = sqlite3.connect(QUEUE_DB, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _db_conn = conn
+        return _db_conn
+
+@contextlib.contextmanager
+def db_transaction():
+    """Run a block of statements atomically on the shared connection"""
+    with _db_lock:
+        conn = get_db()
+        if conn.in_transaction:  # Nested call: join the outer transaction
+            yield conn.cursor()
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def db_fetchone(sql, params=()):
+    with _db_lock:
+        return get_db().execute(sql, params).fetchone()
+
+def db_fetchall(sql, params=()):
+    with _db_lock:
+        return get_db().execute(sql, params).fetchall()
+
+def db_execute(sql, params=()):
+    with _db_lock:
+        get_db().execute(sql, params)
+
+async def run_db(func, *args, **kwargs):
+    """Run a queue.db helper on the DB thread and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+# Schema migrations, applied in order; PRAGMA user_version records the last one applied
+DB_MIGRATIONS = [
+    # 1: tables as they existed before versioning
+    ['''CREATE TABLE IF NOT EXISTS queue 
+        (id INTEGER PRIMARY KEY, telegram_id TEXT, position INTEGER, status TEXT, timestamp REAL)''',
+     '''CREATE TABLE IF NOT EXISTS active_users 
+        (id INTEGER PRIMARY KEY, telegram_id TEXT, start_time REAL)''',
+     '''CREATE TABLE IF NOT EXISTS doc_counts 
+        (id INTEGER PRIMARY KEY, telegram_id TEXT, count INTEGER, last_update REAL)''',
+     '''CREATE TABLE IF NOT EXISTS sheet_rows 
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, row_key TEXT UNIQUE, row_data TEXT, status TEXT, 
+         created REAL, sent_time REAL, sheet_row INTEGER)''',
+     '''CREATE TABLE IF NOT EXISTS sheet_mirror 
+        (row_number INTEGER PRIMARY KEY, name TEXT, name_norm TEXT, phone TEXT, status TEXT)''',
+     "CREATE INDEX IF NOT EXISTS idx_sheet_mirror_phone ON sheet_mirror (phone, name_norm)",
+     "CREATE INDEX IF NOT EXISTS idx_sheet_mirror_name ON sheet_mirror (name_norm)"],
+    # 2: drop the duplicate rows INSERT OR REPLACE used to pile up, then enforce one row per user
+    ["DELETE FROM active_users WHERE id NOT IN (SELECT MAX(id) FROM active_users GROUP BY telegram_id)",
+     "DELETE FROM doc_counts WHERE id NOT IN (SELECT MAX(id) FROM doc_counts GROUP BY telegram_id)",
+     """UPDATE queue SET status = 'completed' WHERE status = 'waiting' AND id NOT IN 
+        (SELECT MIN(id) FROM queue WHERE status = 'waiting' GROUP BY telegram_id)""",
+     "CREATE UNIQUE INDEX IF NOT EXISTS idx_active_users_telegram_id ON active_users (telegram_id)",
+     "CREATE UNIQUE INDEX IF NOT EXISTS idx_doc_counts_telegram_id ON doc_counts (telegram_id)",
+     "CREATE UNIQUE INDEX IF NOT EXISTS idx_queue_waiting_telegram_id ON queue (telegram_id) WHERE status = 'waiting'",
+     "CREATE INDEX IF NOT EXISTS idx_queue_telegram_id ON queue (telegram_id)",
+     "CREATE INDEX IF NOT EXISTS idx_queue_status_position ON queue (status, position)",
+     "CREATE INDEX IF NOT EXISTS idx_sheet_rows_status ON sheet_rows (status, id)"],
+    # 3: phone -> chat_id mapping (replaces user_mapping.json) and a small key/value table
+    ["CREATE TABLE IF NOT EXISTS user_mapping (phone TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, updated REAL)",
+     "CREATE INDEX IF NOT EXISTS idx_user_mapping_chat_id ON user_mapping (chat_id)",
+     "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"],
+    # 4: per-user conversation state (context.user_data), one row per user
+    ["CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL)",
+     "CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state (updated)"],
+    # 5: documents already uploaded to each student folder, for skipping resends
+    ["""CREATE TABLE IF NOT EXISTS uploaded_files 
+        (folder_id TEXT NOT NULL, file_unique_id TEXT NOT NULL, sha256 TEXT, created REAL, PRIMARY KEY (folder_id, file_unique_id))""",
+     "CREATE INDEX IF NOT EXISTS idx_uploaded_files_sha256 ON uploaded_files (folder_id, sha256)"],
+    # 6: one Drive folder per (phone, student name), and spare folders created ahead of time
+    ["""CREATE TABLE IF NOT EXISTS drive_folders 
+        (phone TEXT NOT NULL, name_norm TEXT NOT NULL, folder_id TEXT NOT NULL, link TEXT, name TEXT, 
+         renamed INTEGER NOT NULL DEFAULT 1, created REAL, PRIMARY KEY (phone, name_norm))""",
+     "CREATE INDEX IF NOT EXISTS idx_drive_folders_renamed ON drive_folders (renamed) WHERE renamed = 0",
+     "CREATE TABLE IF NOT EXISTS folder_pool (folder_id TEXT PRIMARY KEY, link TEXT, created REAL)"],
+    # 7: Google side-effects waiting to be retried (the outbox)
+    ["""CREATE TABLE IF NOT EXISTS outbox 
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key TEXT NOT NULL UNIQUE, payload TEXT NOT NULL, 
+         status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL, 
+         last_error TEXT, created REAL, updated REAL)""",
+     "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt)"],
+    # 8: history moves out of the live tables into compact archives; indexes for TTL cleanup
+    ["""CREATE TABLE IF NOT EXISTS queue_archive 
+        (id INTEGER PRIMARY KEY, telegram_id TEXT, queued REAL, finished REAL, outcome TEXT)""",
+     "CREATE INDEX IF NOT EXISTS idx_queue_archive_finished ON queue_archive (finished)",
+     """CREATE TABLE IF NOT EXISTS session_archive 
+        (id INTEGER PRIMARY KEY, telegram_id TEXT, start_time REAL, end_time REAL, outcome TEXT)""",
+     "CREATE INDEX IF NOT EXISTS idx_session_archive_end_time ON session_archive (end_time)",
+     "CREATE INDEX IF NOT EXISTS idx_active_users_start_time ON active_users (start_time)",
+     "CREATE INDEX IF NOT EXISTS idx_doc_counts_last_update ON doc_counts (last_update)",
+     "CREATE INDEX IF NOT EXISTS idx_outbox_done ON outbox (updated) WHERE status = 'done'",
+     "CREATE INDEX IF NOT EXISTS idx_sheet_rows_sent ON sheet_rows (sent_time) WHERE status = 'sent' AND row_data IS NOT NULL"],
+    # 9: leases for electing the worker that runs the singleton background jobs
+    ["CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)"],
+    # 10: last status seen in the sheet (and last one the student was told) per registration
+    ["""CREATE TABLE IF NOT EXISTS status_feed 
+        (phone TEXT, name_norm TEXT, status TEXT, notified TEXT, seen REAL, PRIMARY KEY (phone, name_norm))""",
+     "CREATE INDEX IF NOT EXISTS idx_status_feed_seen ON status_feed (seen)"],
+    # 11: followers' admission-control windows, summed by the leader before it adjusts
+    ["CREATE TABLE IF NOT EXISTS admission_windows (id INTEGER PRIMARY KEY, worker TEXT, data TEXT, created REAL)"],
+    # 12: last queue position each waiting user was told, so a restart or a new leader doesn't repeat it
+    ["ALTER TABLE queue ADD COLUMN notified_position INTEGER"],
+]
+
 def init_queue_db():
-    """Initialize queue database"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS queue 
-                 (id INTEGER PRIMARY KEY, telegram_id TEXT, position INTEGER, status TEXT, timestamp REAL)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS active_users 
-                 (id INTEGER PRIMARY KEY, telegram_id TEXT, start_time REAL)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS doc_counts 
-                 (id INTEGER PRIMARY KEY, telegram_id TEXT, count INTEGER, last_update REAL)''')
-    conn.commit()
-    conn.close()
+    """Initialize queue database and apply pending migrations"""
+    with db_transaction() as c:
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(DB_MIGRATIONS[version:], start=version + 1):
+            for sql in statements:
+                c.execute(sql)
+            c.execute(f"PRAGMA user_version = {number}")
+            logging.info(f"queue.db migrated to version {number}")
+    import_user_mapping_json()
+
+def get_active_user_count():
+    """Get count of currently active users"""
+    return db_fetchone("SELECT COUNT(*) FROM active_users")[0]
+
+def add_to_active_users(telegram_id):
+    """Add user to active users list, taking them out of the queue if they were waiting;
+    returns the queue tickets that were removed"""
+    now = time.time()
+    with db_transaction() as c:
+        c.execute("""INSERT INTO active_users (telegram_id, start_time) VALUES (?, ?) 
+                     ON CONFLICT (telegram_id) DO UPDATE SET start_time = excluded.start_time""", 
+                  (str(telegram_id), now))
+        waiting = c.execute("SELECT id, position FROM queue WHERE telegram_id = ? AND status = 'waiting'", 
+                            (str(telegram_id),)).fetchall()
+        _archive_queue_rows(c, [row_id for row_id, _ in waiting], 'admitted', now)
+    return [position for _, position in waiting]
+
+def remove_from_active_users(telegram_id, outcome='verified'):
+    """Remove user from active users list (archiving the session), return how long it lasted"""
+    now = time.time()
+    with db_transaction() as c:
+        row = c.execute("SELECT start_time FROM active_users WHERE telegram_id = ?", (str(telegram_id),)).fetchone()
+        if row is None:
+            return None
+        c.execute("DELETE FROM active_users WHERE telegram_id = ?", (str(telegram_id),))
+        c.execute("INSERT INTO session_archive (telegram_id, start_time, end_time, outcome) VALUES (?, ?, ?, ?)", 
+                  (str(telegram_id), row[0], now, outcome))
+    return now - row[0]
+
+def get_doc_count(telegram_id):
+    """Get document count for user"""
+    result = db_fetchone("SELECT count FROM doc_counts WHERE telegram_id = ?", (str(telegram_id),))
+    return result[0] if result else 0
+
+def increment_doc_count(telegram_id, amount=1):
+    """Increment document count for user"""
+    with db_transaction() as c:
+        c.execute("""INSERT INTO doc_counts (telegram_id, count, last_update) VALUES (?, ?, ?) 
+                     ON CONFLICT (telegram_id) DO UPDATE SET count = count + excluded.count, last_update = excluded.last_update""", 
+                  (str(telegram_id), amount, time.time()))
+        return c.execute("SELECT count FROM doc_counts WHERE telegram_id = ?", (str(telegram_id),)).fetchone()[0]
+
+def reset_doc_count(telegram_id):
+    """Reset document count for user"""
+    db_execute("DELETE FROM doc_counts WHERE telegram_id = ?", (str(telegram_id),))
+
+def add_to_queue(telegram_id):
+    """Add user to queue (or return their current position if already waiting)"""
+    with db_transaction() as c:
+        c.execute("SELECT position FROM queue WHERE telegram_id = ? AND status = 'waiting'", (str(telegram_id),))
+        existing = c.fetchone()
+        if existing:
+            return existing[0]
+        c.execute("SELECT MAX(position) FROM queue WHERE status = 'waiting'")
+        max_pos = c.fetchone()[0]
+        position = (max_pos or 0) + 1
+        c.execute("INSERT INTO queue (telegram_id, position, status, timestamp) VALUES (?, ?, 'waiting', ?)", 
+                  (str(telegram_id), position, time.time()))
+        return position
+
+def _archive_queue_rows(c, row_ids, outcome, now):
+    """Move finished queue rows to queue_archive (the queue table only keeps waiting users)"""
+    c.executemany("""INSERT INTO queue_archive (telegram_id, queued, finished, outcome) 
+                     SELECT telegram_id, timestamp, COALESCE(?, timestamp), ? FROM queue WHERE id = ?""", 
+                  [(now, outcome, i) for i in row_ids])
+    c.executemany("DELETE FROM queue WHERE id = ?", [(i,) for i in row_ids])
+
+def remove_from_queue(telegram_id):
+    """Remove user from queue"""
+    with db_transaction() as c:
+        rows = c.execute("SELECT id FROM queue WHERE telegram_id = ? AND status = 'waiting'", (str(telegram_id),)).fetchall()
+        _archive_queue_rows(c, [row_id for row_id, in rows], 'left', time.time())
+
+def get_queue_position(telegram_id):
+    """Get user's position in queue"""
+    result = db_fetchone("SELECT position FROM queue WHERE telegram_id = ? AND status = 'waiting'", (str(telegram_id),))
+    return result[0] if result else None
+
+def count_waiting_up_to(ticket):
+    """Live place of a ticket counted in queue.db (used when other workers share the queue)"""
+    return db_fetchone("SELECT COUNT(*) FROM queue WHERE status = 'waiting' AND position <= ?", (ticket,))[0]
+
+def get_estimated_wait_time(position):
+    """Calculate estimated wait time from the observed session length and current limit"""
+    # One of the `limit` slots frees up every (session time / limit) seconds on average
+    estimated_minutes = position * admission_control.service_time / admission_control.limit / 60
+    return int(estimated_minutes + 0.5)
+
+def is_active_user(telegram_id):
+    """Check if user currently holds an active slot"""
+    return db_fetchone("SELECT 1 FROM active_users WHERE telegram_id = ?", (str(telegram_id),)) is not None
+
+def admit_next_users(limit):
+    """Move waiting users into free active slots, return their (telegram_id, position)"""
+    with db_transaction() as c:
+        active_count = c.execute("SELECT COUNT(*) FROM active_users").fetchone()[0]
+        free_slots = limit - active_count
+        if free_slots <= 0:
+            return []
+        c.execute("SELECT id, telegram_id, position FROM queue WHERE status = 'waiting' ORDER BY position LIMIT ?", (free_slots,))
+        admitted = c.fetchall()
+        now = time.time()
+        _archive_queue_rows(c, [row_id for row_id, _, _ in admitted], 'admitted', now)
+        for row_id, telegram_id, _ in admitted:
+            c.execute("""INSERT INTO active_users (telegram_id, start_time) VALUES (?, ?) 
+                         ON CONFLICT (telegram_id) DO UPDATE SET start_time = excluded.start_time""", (telegram_id, now))
+        return [(telegram_id, position) for _, telegram_id, position in admitted]
+
+def get_waiting_users():
+    """Get (telegram_id, position) of everyone waiting, in queue order"""
+    return db_fetchall("SELECT telegram_id, position FROM queue WHERE status = 'waiting' ORDER BY position")
+
+def get_notified_positions():
+    """Get (telegram_id, position, last position they were told) of everyone waiting, in queue order"""
+    return db_fetchall("SELECT telegram_id, position, notified_position FROM queue WHERE status = 'waiting' ORDER BY position")
+
+def set_notified_positions(positions):
+    """Record the (telegram_id, position) each waiting user was just told"""
+    with db_transaction() as c:
+        c.executemany("UPDATE queue SET notified_position = ? WHERE telegram_id = ? AND status = 'waiting'", 
+                      [(position, str(telegram_id)) for telegram_id, position in positions])
+
+def cleanup_old_records():
+    """Clean up old records, return how many active sessions expired"""
+    now = time.time()
+    with db_transaction() as c:
+        # Clean up old active users (older than 1 hour), keeping the session in the archive
+        cutoff_time = now - 3600
+        c.execute("""INSERT INTO session_archive (telegram_id, start_time, end_time, outcome) 
+                     SELECT telegram_id, start_time, ?, 'expired' FROM active_users WHERE start_time < ?""", (now, cutoff_time))
+        c.execute("DELETE FROM active_users WHERE start_time < ?", (cutoff_time,))
+        expired = c.rowcount
+        
+        # Clean up old doc counts (older than 30 minutes)
+        cutoff_time = time.time() - 1800
+        c.execute("DELETE FROM doc_counts WHERE last_update < ?", (cutoff_time,))
+    return expired
+
+# --- USER MAPPING STORE ---
+# ✅ फ़ोन और chat_id का mapping: one indexed row per phone in queue.db, with a
+# bounded in-memory cache in front of it for both directions of lookup.
+USER_MAPPING_JSON = 'user_mapping.json'  # Legacy file, imported once
+USER_MAPPING_CACHE_SIZE = 50000
+
+_chat_id_cache = {}  # phone -> chat_id
+_phone_cache = {}  # chat_id -> phone
+
+def _cache_mapping(phone, chat_id):
+    if SHARED_STATE:
+        return  # Another worker may change the mapping at any time
+    for cache, key, value in ((_chat_id_cache, phone, chat_id), (_phone_cache, chat_id, phone)):
+        if len(cache) >= USER_MAPPING_CACHE_SIZE:
+            cache.pop(next(iter(cache)))  # Drop the oldest entry
+        cache[key] = value
+
+def save_user_mapping(phone, chat_id):
+    """Insert or update one phone -> chat_id entry"""
+    chat_id = int(chat_id)
+    with _db_lock:
+        old_chat_id = _chat_id_cache.get(phone)
+        db_execute("""INSERT INTO user_mapping (phone, chat_id, updated) VALUES (?, ?, ?) 
+                      ON CONFLICT (phone) DO UPDATE SET chat_id = excluded.chat_id, updated = excluded.updated""", 
+                   (phone, chat_id, time.time()))
+        if old_chat_id is not None and old_chat_id != chat_id:
+            _phone_cache.pop(old_chat_id, None)
+        _cache_mapping(phone, chat_id)
+
+def get_chat_id_for_phone(phone):
+    """Look up the chat_id saved for a phone number"""
+    with _db_lock:
+        if phone in _chat_id_cache:
+            return _chat_id_cache[phone]
+        row = db_fetchone("SELECT chat_id FROM user_mapping WHERE phone = ?", (phone,))
+        if row:
+            _cache_mapping(phone, row[0])
+        return row[0] if row else None
+
+def get_chat_ids_for_phones(phones):
+    """Look up many phone numbers at once; returns {phone: chat_id} for the known ones"""
+    return {phone: chat_id for phone in set(phones) if (chat_id := get_chat_id_for_phone(phone))}
+
+def get_phone_for_chat_id(chat_id):
+    """Look up the phone number saved for a chat_id (latest registration wins)"""
+    chat_id = int(chat_id)
+    with _db_lock:
+        if chat_id in _phone_cache:
+            return _phone_cache[chat_id]
+        row = db_fetchone("SELECT phone FROM user_mapping WHERE chat_id = ? ORDER BY updated DESC LIMIT 1", (chat_id,))
+        if row:
+            _cache_mapping(row[0], chat_id)
+        return row[0] if row else None
+
+def import_user_mapping_json(path=USER_MAPPING_JSON):
+    """One-time import of the old user_mapping.json (existing rows in queue.db win)"""
+    if db_fetchone("SELECT 1 FROM meta WHERE key = 'user_mapping_imported'") or not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        data = json.load(f)
+    now = time.time()
+    with db_transaction() as c:
+        c.executemany("INSERT OR IGNORE INTO user_mapping (phone, chat_id, updated) VALUES (?, ?, ?)", 
+                      [(phone, int(chat_id), now) for phone, chat_id in data.items()])
+        c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('user_mapping_imported', ?)", (str(now),))
+    logging.info(f"Imported {len(data)} phone mappings from {path}")
+
+# --- ADMISSION SCHEDULER ---
+# Runs on the Application's job queue. Whenever a slot frees up the next waiting
+# users are admitted at once and told it is their turn; waiting users get their
+# live position in periodic batches.
+QUEUE_MAINTENANCE_INTERVAL = 30
+POSITION_UPDATE_INTERVAL = 120
+POSITION_UPDATE_STEP = 5  # Only message a waiting user once they moved up this many places
+
+# Adaptive admission limit
+INITIAL_ACTIVE_USERS = 50
+MIN_ACTIVE_USERS = 10
+MAX_ACTIVE_USERS = 300
+LATENCY_TARGETS = {'drive': 8.0, 'sheets': 3.0}  # Mean seconds per call in a window before we back off
+UNTIMED_OPS = {'_upload_file'}  # Upload time grows with file size, so it says nothing about Google's health
+MAX_ERROR_RATE = 0.1
+DECREASE_FACTOR = 0.75
+INCREASE_STEP = 2
+SESSION_ALPHA = 0.1
+
+class AdmissionController:
+    """AIMD controller for the number of users allowed to fill forms at once.
+
+    Every maintenance tick it looks at the Google calls made since the last tick
+    (only those: a quiet window says nothing): quota errors, a high error rate or
+    a mean latency above target cut the limit multiplicatively; otherwise, if all
+    slots are busy and people are waiting, the limit grows by a few slots. Uploads
+    count for errors but not latency. Session times feed the wait estimate."""
+
+    def __init__(self, initial=50, minimum=10, maximum=300):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.service_time = 30.0  # EWMA of session length in seconds
+        self._reset_window()
+
+    def _reset_window(self):
+        self.calls = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.latency = {}  # api -> [total seconds, timed calls] in this window
+        self.sessions = []  # Session lengths recorded in this window
+
+    def record_call(self, api, seconds, error=False, quota=False, timed=True):
+        if timed:
+            total = self.latency.setdefault(api, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        self.calls += 1
+        self.errors += bool(error)
+        self.quota_errors += bool(quota)
+
+    def record_session(self, seconds):
+        if seconds:
+            self.service_time += SESSION_ALPHA * (seconds - self.service_time)
+            self.sessions.append(seconds)
+
+    def take_window(self):
+        """This window's counts as a dict (a follower ships them to the leader); starts a new window"""
+        window = {'calls': self.calls, 'errors': self.errors, 'quota_errors': self.quota_errors, 
+                  'latency': self.latency, 'sessions': self.sessions}
+        self._reset_window()
+        return window
+
+    def merge_window(self, window):
+        """Add another worker's window to this one"""
+        self.calls += window['calls']
+        self.errors += window['errors']
+        self.quota_errors += window['quota_errors']
+        for api, (seconds, calls) in window['latency'].items():
+            total = self.latency.setdefault(api, [0.0, 0])
+            total[0] += seconds
+            total[1] += calls
+        for seconds in window['sessions']:
+            self.record_session(seconds)
+
+    def adjust(self, active_count, waiting_count):
+        """Recompute the limit from the last window, return the new limit"""
+        latency = {api: seconds / calls for api, (seconds, calls) in self.latency.items() if calls}
+        slow = any(latency.get(api, 0) > target for api, target in LATENCY_TARGETS.items())
+        error_rate = self.errors / self.calls if self.calls else 0.0
+        old = self.limit
+        if self.quota_errors or error_rate > MAX_ERROR_RATE or slow:
+            self.limit = max(self.minimum, int(self.limit * DECREASE_FACTOR))
+        elif waiting_count and active_count >= self.limit:
+            self.limit = min(self.maximum, self.limit + INCREASE_STEP)
+        if self.limit != old:
+            logging.info(f"Admission limit {old} -> {self.limit} (error rate {error_rate:.0%}, "
+                         f"quota errors {self.quota_errors}, latency {latency})")
+        self._reset_window()
+        return self.limit
+
+class WaitingIndex:
+    """Fenwick tree over queue positions (tickets): a user's live place in the
+    queue is the number of waiting tickets up to theirs, found in O(log n)"""
+
+    def __init__(self, size=1024):
+        self._tree = [0] * (size + 1)
+        self._tickets = set()
+
+    def _update(self, ticket, delta):
+        while ticket < len(self._tree):
+            self._tree[ticket] += delta
+            ticket += ticket & -ticket
+
+    def _grow(self, ticket):
+        size = len(self._tree) - 1
+        while size < ticket:
+            size *= 2
+        self._tree = [0] * (size + 1)
+        for t in self._tickets:
+            self._update(t, 1)
+
+    def add(self, ticket):
+        if ticket in self._tickets:
+            return
+        if ticket >= len(self._tree):
+            self._grow(ticket)
+        self._tickets.add(ticket)
+        self._update(ticket, 1)
+
+    def remove(self, ticket):
+        if ticket in self._tickets:
+            self._tickets.discard(ticket)
+            self._update(ticket, -1)
+
+    def rank(self, ticket):
+        if ticket not in self._tickets:
+            return None
+        total = 0
+        while ticket > 0:
+            total += self._tree[ticket]
+            ticket -= ticket & -ticket
+        return total
+
+    def clear(self):
+        self._tree = [0] * len(self._tree)
+        self._tickets.clear()
+
+    def __len__(self):
+        return len(self._tickets)
+
+waiting_index = WaitingIndex()
+admission_control = AdmissionController(initial=INITIAL_ACTIVE_USERS, minimum=MIN_ACTIVE_USERS, maximum=MAX_ACTIVE_USERS)
+QUEUE_WAITING = Gauge('formcare_queue_waiting', 'Users waiting in the queue', lambda: len(waiting_index))
+ADMISSION_LIMIT = Gauge('formcare_admission_limit', 'Current limit of active users', lambda: admission_control.limit)
+_queue_lock = None
+
+def queue_lock():
+    """Held while queue tickets are read or changed, so the index and queue.db agree
+    (retention renumbers the tickets under it)"""
+    global _queue_lock
+    if _queue_lock is None:
+        _queue_lock = asyncio.Lock()
+    return _queue_lock
+
+async def rebuild_waiting_index():
+    """Load every waiting ticket from queue.db into the in-memory index"""
+    tickets = await run_db(get_waiting_users)
+    waiting_index.clear()
+    for _, position in tickets:
+        waiting_index.add(position)
+
+async def refresh_waiting_index():
+    """In multi-worker mode other workers enqueue users too: reload the index from queue.db"""
+    if SHARED_STATE:
+        await rebuild_waiting_index()
+
+async def admit_user(telegram_id):
+    """Give a user a slot right away (a waiting user gives up their queue ticket)"""
+    async with queue_lock():
+        for ticket in await run_db(add_to_active_users, telegram_id):
+            waiting_index.remove(ticket)
+
+async def enqueue_user(telegram_id):
+    """Put a user in the queue and return their live position"""
+    async with queue_lock():
+        ticket = await run_db(add_to_queue, telegram_id)
+        if SHARED_STATE:
+            position = await run_db(count_waiting_up_to, ticket)
+        else:
+            waiting_index.add(ticket)
+            position = waiting_index.rank(ticket)
+    await run_db(set_notified_positions, [(telegram_id, position)])
+    return position
+
+async def get_live_position(telegram_id):
+    """Live place in the queue (1 = next), or None if not waiting"""
+    async with queue_lock():
+        ticket = await run_db(get_queue_position, telegram_id)
+        if ticket is None:
+            return None
+        return await run_db(count_waiting_up_to, ticket) if SHARED_STATE else waiting_index.rank(ticket)
+
+def request_admission(application):
+    """Ask the scheduler to fill free slots right away (e.g. after a slot was released)"""
+    if application.job_queue is None or application.job_queue.get_jobs_by_name('admission'):
+        return
+    application.job_queue.run_once(admit_waiting_users, 0, name='admission')
+
+async def admit_waiting_users(context: ContextTypes.DEFAULT_TYPE):
+    """Fill every free slot from the head of the queue and tell those users"""
+    async with queue_lock():
+        admitted = await run_db(admit_next_users, admission_control.limit)
+        for telegram_id, ticket in admitted:
+            waiting_index.remove(ticket)
+    # Notifications go out together; the outbound scheduler paces them
+    results = await asyncio.gather(*[
+        notify(context.bot, int(telegram_id),
+               "🎉 <b>आपकी बारी आ गई है!</b>\n\nफॉर्म भरना शुरू करने के लिए नीचे दिए गए बटन पर क्लिक करें। 👇",
+               reply_markup=restart_kb(), parse_mode="HTML")
+        for telegram_id, _ in admitted], return_exceptions=True)
+    for (telegram_id, _), result in zip(admitted, results):
+        if isinstance(result, Exception):
+            logging.error(f"Could not notify admitted user {telegram_id}: {result}")
+    if admitted:
+        logging.info(f"Admitted {len(admitted)} users from the queue")
+
+async def queue_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """Expire stale sessions and admit users into any free slots"""
+    try:
+        expired = await run_db(cleanup_old_records)
+        if expired:
+            logging.info(f"{expired} sessions expired")
+        active_count = await run_db(get_active_user_count)
+        ACTIVE_USERS.set(active_count)
+        async with queue_lock():
+            await refresh_waiting_index()
+        if SHARED_STATE:
+            # The other workers' Google calls and sessions count as much as ours
+            for window in await run_db(pop_admission_windows, time.time() - ADMISSION_WINDOW_MAX_AGE):
+                admission_control.merge_window(window)
+        admission_control.adjust(active_count, len(waiting_index))
+        await admit_waiting_users(context)
+    except Exception as e:
+        logging.error(f"Queue maintenance error: {e}")
+
+async def send_position_updates(context: ContextTypes.DEFAULT_TYPE):
+    """Tell waiting users their new place in the queue once they moved up enough"""
+    updates = []
+    async with queue_lock():
+        await refresh_waiting_index()
+        for telegram_id, ticket, last in await run_db(get_notified_positions):
+            position = waiting_index.rank(ticket)
+            if position is None:
+                continue
+            if last is None or last - position >= POSITION_UPDATE_STEP:
+                updates.append((telegram_id, position))
+    results = await asyncio.gather(*[
+        notify(context.bot, int(telegram_id),
+               f"📍 कतार में आपका नया नंबर: {position}\n⏰ आपकी बारी आने में: {get_estimated_wait_time(position)} मिनट")
+        for telegram_id, position in updates], return_exceptions=True)
+    for (telegram_id, position), result in zip(updates, results):
+        if isinstance(result, Exception):
+            logging.error(f"Could not send queue update to {telegram_id}: {result}")
+    await run_db(set_notified_positions, [update for update, result in zip(updates, results) 
+                                          if not isinstance(result, Exception)])
+
+async def start_admission_scheduler(application):
+    await rebuild_waiting_index()
+    if SHARED_STATE:
+        application.job_queue.run_repeating(elect_leader, interval=LEASE_RENEW_INTERVAL, first=0, name='elect_leader')
+    application.job_queue.run_repeating(leader_only(queue_maintenance), interval=QUEUE_MAINTENANCE_INTERVAL, first=1, name='queue_maintenance')
+    application.job_queue.run_repeating(leader_only(send_position_updates), interval=POSITION_UPDATE_INTERVAL, name='position_updates')
+    application.job_queue.run_repeating(leader_only(run_retention), interval=RETENTION_INTERVAL, first=60, name='retention')
+
+# --- LEADER ELECTION ---
+# With BOT_WORKERS > 1 every worker serves its own share of the users, but the jobs
+# that must run once (admission ticks, position updates, retention, the folder pool,
+# sheet flushes and outbox replays) only run on the worker holding the 'leader'
+# lease in queue.db. A worker that dies stops renewing it and another takes over.
+# The leader publishes the admission limit so every worker quotes the same waits;
+# followers send it their Google call and session counts, so the limit follows
+# the traffic of all workers.
+LEADER_LEASE = 'leader'
+LEASE_TTL = 30
+LEASE_RENEW_INTERVAL = 10
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+ADMISSION_WINDOW_MAX_AGE = 2 * QUEUE_MAINTENANCE_INTERVAL  # Older follower windows are dropped unread
+
+_leader = not SHARED_STATE  # A single process always runs everything
+
+def acquire_lease(name, owner, ttl):
+    """Take or renew a lease unless someone else holds it unexpired, return True if we hold it"""
+    now = time.time()
+    with db_transaction() as c:
+        c.execute("INSERT OR IGNORE INTO leases (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + ttl))
+        updated = c.execute("UPDATE leases SET owner = ?, expires = ? WHERE name = ? AND (owner = ? OR expires < ?)",
+                            (owner, now + ttl, name, owner, now))
+        return updated.rowcount == 1
+
+def release_lease(name, owner):
+    with db_transaction() as c:
+        c.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+def push_admission_window(worker, window):
+    db_execute("INSERT INTO admission_windows (worker, data, created) VALUES (?, ?, ?)", 
+               (worker, json.dumps(window), time.time()))
+
+def pop_admission_windows(since):
+    """Remove every queued follower window, return those created after `since`"""
+    with db_transaction() as c:
+        rows = c.execute("SELECT data, created FROM admission_windows ORDER BY id").fetchall()
+        c.execute("DELETE FROM admission_windows")
+    return [json.loads(data) for data, created in rows if created >= since]
+
+def get_meta(key):
+    row = db_fetchone("SELECT value FROM meta WHERE key = ?", (key,))
+    return row[0] if row else None
+
+def set_meta(key, value):
+    db_execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+def is_leader():
+    return _leader
+
+def leader_only(callback):
+    """Wrap a job callback so it only runs on the leader"""
+    @functools.wraps(callback)
+    async def wrapper(context):
+        if _leader:
+            await callback(context)
+    return wrapper
+
+async def elect_leader(context: ContextTypes.DEFAULT_TYPE):
+    """Renew (or try to take) the leader lease and share the admission state"""
+    global _leader, _sheet_recovery_needed
+    try:
+        leader = await run_db(acquire_lease, LEADER_LEASE, WORKER_ID, LEASE_TTL)
+    except Exception as e:
+        logging.error(f"Leader lease error: {e}")
+        leader = False  # Can't prove we still hold it
+    if leader and not _leader:
+        logging.info(f"Worker {WORKER_INDEX} ({WORKER_ID}) is now the leader")
+        _sheet_recovery_needed = True  # Settle rows the previous leader left inflight
+    elif _leader and not leader:
+        logging.warning(f"Worker {WORKER_INDEX} ({WORKER_ID}) lost the leader lease")
+    _leader = leader
+    try:
+        if leader:
+            state = {'limit': admission_control.limit, 'service_time': admission_control.service_time}
+            await run_db(set_meta, 'admission_state', json.dumps(state))
+        else:
+            window = admission_control.take_window()
+            if window['calls'] or window['sessions']:
+                await run_db(push_admission_window, WORKER_ID, window)
+            ACTIVE_USERS.set(await run_db(get_active_user_count))
+            state = await run_db(get_meta, 'admission_state')
+            if state:
+                state = json.loads(state)
+                admission_control.limit = state['limit']
+                admission_control.service_time = state['service_time']
+    except Exception as e:
+        logging.error(f"Admission state sync failed: {e}")
+
+# --- RETENTION ---
+# Live tables only hold live state; history goes to compact archive tables that
+# stay queryable for capacity planning (queue_archive: when people queued and got
+# in, session_archive: how long sessions lasted). A periodic job moves legacy
+# rows in small batches, prunes expired history by TTL through indexes, renumbers
+# waiting tickets once they drifted far, and vacuums incrementally when quiet.
+RETENTION_INTERVAL = 10 * 60
+RETENTION_BATCH = 5000  # Rows per transaction, so no step holds the DB lock for long
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "400"))
+OUTBOX_DONE_RETENTION_DAYS = 7
+SHEET_ROW_DATA_RETENTION_DAYS = 30  # Sent rows keep their key (dedup) but drop their data after this
+USER_STATE_RETENTION_DAYS = 30  # check_timeout() resets a session after 24 h anyway
+RENUMBER_AFTER = 10000  # Renumber waiting tickets once the lowest one is above this
+QUIET_ACTIVE_USERS = 5  # Vacuum only when at most this many users are active and nobody waits
+VACUUM_PAGES = 500
+
+def _in_batches(sql, params):
+    """Run a DELETE/UPDATE ... WHERE rowid IN (... LIMIT ?) until nothing is left, return the row count"""
+    total = 0
+    while True:
+        with db_transaction() as c:
+            c.execute(sql, params + (RETENTION_BATCH,))
+            total += c.rowcount
+        if c.rowcount < RETENTION_BATCH:
+            return total
+
+def archive_completed_queue_rows():
+    """Move 'completed' rows left by older versions into queue_archive"""
+    total = 0
+    while True:
+        with db_transaction() as c:
+            ids = [i for i, in c.execute("SELECT id FROM queue WHERE status = 'completed' LIMIT ?", (RETENTION_BATCH,))]
+            _archive_queue_rows(c, ids, 'completed', None)
+        total += len(ids)
+        if len(ids) < RETENTION_BATCH:
+            return total
+
+def prune_history():
+    """Delete history past its TTL, return {table: rows}"""
+    now = time.time()
+    day = 24 * 3600
+    archive_cutoff = now - ARCHIVE_RETENTION_DAYS * day
+    return {
+        'queue_archive': _in_batches("""DELETE FROM queue_archive WHERE id IN 
+            (SELECT id FROM queue_archive WHERE finished < ? LIMIT ?)""", (archive_cutoff,)),
+        'session_archive': _in_batches("""DELETE FROM session_archive WHERE id IN 
+            (SELECT id FROM session_archive WHERE end_time < ? LIMIT ?)""", (archive_cutoff,)),
+        'outbox': _in_batches("""DELETE FROM outbox WHERE id IN 
+            (SELECT id FROM outbox WHERE status = 'done' AND updated < ? LIMIT ?)""", (now - OUTBOX_DONE_RETENTION_DAYS * day,)),
+        'sheet_rows': _in_batches("""UPDATE sheet_rows SET row_data = NULL WHERE id IN 
+            (SELECT id FROM sheet_rows WHERE status = 'sent' AND row_data IS NOT NULL AND sent_time < ? LIMIT ?)""", 
+            (now - SHEET_ROW_DATA_RETENTION_DAYS * day,)),
+        'user_state': _in_batches("""DELETE FROM user_state WHERE user_id IN 
+            (SELECT user_id FROM user_state WHERE updated < ? LIMIT ?)""", (now - USER_STATE_RETENTION_DAYS * day,)),
+    }
+
+def renumber_waiting_positions():
+    """Give waiting users tickets 1..n again (same order); True if anything changed"""
+    with db_transaction() as c:
+        lowest = c.execute("SELECT MIN(position) FROM queue WHERE status = 'waiting'").fetchone()[0]
+        if lowest is None or lowest <= RENUMBER_AFTER:
+            return False
+        ids = [i for i, in c.execute("SELECT id FROM queue WHERE status = 'waiting' ORDER BY position")]
+        c.executemany("UPDATE queue SET position = ? WHERE id = ?", [(n, i) for n, i in enumerate(ids, start=1)])
+    return True
+
+def compact_queue_db():
+    """Return free pages to the file system; the first call switches queue.db to incremental auto-vacuum"""
+    with _db_lock:
+        conn = get_db()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")  # One-time rebuild, needed for the setting to take effect
+            return 'vacuum'
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free:
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        return free
+
+async def run_retention(context: ContextTypes.DEFAULT_TYPE):
+    """Job: archive, prune, renumber and (when quiet) vacuum queue.db"""
+    try:
+        archived = await run_db(archive_completed_queue_rows)
+        pruned = await run_db(prune_history)
+        async with queue_lock():
+            if await run_db(renumber_waiting_positions):
+                await rebuild_waiting_index()
+                logging.info("Waiting queue tickets renumbered")
+        if archived or any(pruned.values()):
+            logging.info(f"Retention: archived {archived} queue rows, pruned {pruned}")
+        if len(waiting_index) == 0 and await run_db(get_active_user_count) <= QUIET_ACTIVE_USERS:
+            await run_db(compact_queue_db)
+    except Exception as e:
+        logging.error(f"Retention error: {e}")
+
+def get_capacity_history(days=7):
+    """Per-day queue joins, average wait, sessions and average session length (from the archives)"""
+    since = time.time() - days * 24 * 3600
+    queued = db_fetchall("""SELECT date(finished, 'unixepoch', 'localtime'), COUNT(*), 
+                                   AVG(CASE WHEN outcome != 'completed' THEN finished - queued END) FROM queue_archive 
+                            WHERE finished >= ? GROUP BY 1""", (since,))
+    sessions = db_fetchall("""SELECT date(end_time, 'unixepoch', 'localtime'), COUNT(*), AVG(end_time - start_time) FROM session_archive 
+                              WHERE end_time >= ? GROUP BY 1""", (since,))
+    history = {}
+    for day, count, wait in queued:
+        history.setdefault(day, {})['queued'] = (count, wait)
+    for day, count, length in sessions:
+        history.setdefault(day, {})['sessions'] = (count, length)
+    return sorted(history.items())
+
+# --- API HELPERS (UPDATED) ---
+# Credentials, the gspread client, the worksheet handle and the Drive service are
+# built once per process and shared by every handler (and executor thread).
+# The Google client libraries are imported on first use, so importing bot.py (and
+# tools that only need the DB helpers) doesn't pay for them.
+TOKEN_FILE = 'user_token.json'
+SHEET_NAME = "FormCare_Data"  # ✅ NEW: Change this to your new sheet name
+TOKEN_REFRESH_MARGIN = 300  # Refresh the access token 5 minutes before it expires
+DRIVE_HTTP_TIMEOUT = 120
+SHEETS_HTTP_TIMEOUT = 60  # Bounds how long an abandoned Sheets call can keep its worker thread
+DRIVE_DISCOVERY_FILE = 'drive_v3_discovery.json'  # Local copy, only used if the client library has none bundled
+DRIVE_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+
+_google_lock = threading.RLock()
+_creds = None
+_auth_session = None
+_sheet_client = None
+_worksheet = None
+_drive_local = threading.local()  # httplib2 is not thread-safe, so one Drive service per thread
+_drive_discovery = None
+
+def _token_expiring(creds):
+    """Check if the access token is missing or about to expire"""
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    remaining = creds.expiry - datetime.datetime.utcnow()
+    return remaining.total_seconds() < TOKEN_REFRESH_MARGIN
+
+def get_creds():
+    """Load credentials once and refresh them before they expire"""
+    global _creds, _auth_session
+    from google.auth.transport.requests import Request
+    with _google_lock:
+        if _creds is None:
+            import requests
+            from google.oauth2.credentials import Credentials
+            with open(TOKEN_FILE, 'r') as f:
+                token_data = json.load(f)
+            _creds = Credentials.from_authorized_user_info(token_data)
+            _auth_session = requests.Session()  # Pooled connections for token refreshes
+        if _token_expiring(_creds):
+            _creds.refresh(Request(session=_auth_session))
+            logging.info("Google access token refreshed")
+        return _creds
+
+def get_sheet():
+    """Get the cached FormCare_Data worksheet handle"""
+    global _sheet_client, _worksheet
+    creds = get_creds()
+    with _google_lock:
+        if _worksheet is None:
+            import gspread
+            # gspread keeps one AuthorizedSession (pooled HTTP connections) per client
+            _sheet_client = gspread.authorize(creds)
+            _sheet_client.set_timeout(SHEETS_HTTP_TIMEOUT)
+            _worksheet = _sheet_client.open(SHEET_NAME).sheet1
+        return _worksheet
+
+def get_drive_discovery():
+    """Drive v3 discovery document, parsed once per process: the copy bundled with
+    google-api-python-client, else a local file fetched once from Google"""
+    global _drive_discovery
+    with _google_lock:
+        if _drive_discovery is None:
+            from googleapiclient import discovery_cache
+            doc = discovery_cache.get_static_doc('drive', 'v3')
+            if doc is None:
+                if not os.path.exists(DRIVE_DISCOVERY_FILE):
+                    import requests
+                    response = requests.get(DRIVE_DISCOVERY_URL, timeout=30)
+                    response.raise_for_status()
+                    with open(DRIVE_DISCOVERY_FILE, 'w') as f:
+                        f.write(response.text)
+                with open(DRIVE_DISCOVERY_FILE, 'r') as f:
+                    doc = f.read()
+            _drive_discovery = json.loads(doc)
+        return _drive_discovery
+
+def get_drive_service():
+    """Get the Drive service for the current thread"""
+    creds = get_creds()
+    service = getattr(_drive_local, 'service', None)
+    if service is None:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build_from_document
+        # AuthorizedHttp reuses its httplib2 connections between requests
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+        service = build_from_document(get_drive_discovery(), http=http)
+        _drive_local.service = service
+    return service
+
+def _app_properties(key):
+    """Tag a Drive file with an idempotency key (hashed: key + value must fit in 124 bytes)"""
+    return {'formcare_key': hashlib.sha256(key.encode()).hexdigest()[:40]} if key else {}
+
+def create_drive_folder(name, key=None):
+    service = get_drive_service()
+    meta = {
+        'name': name,
+        'mimeType': 'application/vnd.google-apps.folder',
+        'parents': [PARENT_FOLDER_ID]
+    }
+    if key:
+        meta['appProperties'] = _app_properties(key)
+    file = service.files().create(
+        body=meta,
+        fields='id, webViewLink',
+        supportsAllDrives=True
+    ).execute()
+    return file.get('id'), file.get('webViewLink')
+
+def find_drive_file(key, folder_id=None):
+    """(id, webViewLink) of the file created with this idempotency key, or None"""
+    service = get_drive_service()
+    value = _app_properties(key)['formcare_key']
+    query = f"appProperties has {{ key='formcare_key' and value='{value}' }} and trashed = false"
+    if folder_id:
+        query += f" and '{folder_id}' in parents"
+    files = service.files().list(
+        q=query,
+        fields='files(id, webViewLink)',
+        pageSize=1,
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True
+    ).execute().get('files', [])
+    return (files[0]['id'], files[0].get('webViewLink')) if files else None
+
+def rename_drive_folder(folder_id, name):
+    service = get_drive_service()
+    service.files().update(
+        fileId=folder_id,
+        body={'name': name},
+        fields='id',
+        supportsAllDrives=True
+    ).execute()
+
+def _upload_file(stream, filename, folder_id, size=None, key=None):
+    from googleapiclient.http import MediaIoBaseUpload
+    service = get_drive_service()
+    
+    meta = {'name': filename, 'parents': [folder_id]}
+    if key:
+        meta['appProperties'] = _app_properties(key)
+    
+    if size is not None and size <= SPOOL_THRESHOLD:
+        # Small in-memory file: a single multipart request is cheaper than a resumable session
+        media = MediaIoBaseUpload(stream, mimetype='application/octet-stream', resumable=False)
+        service.files().create(
+            body=meta,
+            media_body=media,
+            fields='id',
+            supportsAllDrives=True
+        ).execute(num_retries=UPLOAD_MAX_RETRIES)
+        return
+    
+    # Large (spooled) file: chunked resumable upload, only one chunk is in memory at a time.
+    # next_chunk() retries transient errors and resumes from the last byte Drive confirmed.
+    media = MediaIoBaseUpload(stream, mimetype='application/octet-stream', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+    request = service.files().create(
+        body=meta,
+        media_body=media,
+        fields='id',
+        supportsAllDrives=True
+    )
+    response = None
+    while response is None:
+        _, response = request.next_chunk(num_retries=UPLOAD_MAX_RETRIES)
+
+def append_sheet_rows(rows):
+    """Append many registration rows in one request, return the first sheet row written"""
+    response = get_sheet().append_rows(rows)
+    updated_range = response.get('updates', {}).get('updatedRange', '')  # e.g. "Sheet1!A12:I20"
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+def get_sheet_values():
+    """Read every row of the sheet"""
+    return get_sheet().get_all_values()
+
+def update_sheet_statuses(statuses):
+    """Write many (row, status) pairs into column I with one batch request"""
+    get_sheet().batch_update([{'range': f"I{row}", 'values': [[status]]} for row, status in statuses])
+
+def get_sheet_names(rows):
+    """(name, phone) of each given sheet row, read in one request"""
+    ranges = get_sheet().batch_get([f"A{row}:B{row}" for row in rows])
+    names = []
+    for values in ranges:
+        cells = (list(values[0]) if values else []) + ['', '']
+        names.append((cells[0], str(cells[1])))
+    return names
+
+def get_sheet_version():
+    """Drive's version number of the spreadsheet, which goes up with every edit"""
+    file = get_drive_service().files().get(
+        fileId=get_sheet().spreadsheet.id,
+        fields='version',
+        supportsAllDrives=True
+    ).execute()
+    return int(file['version'])
+
+def get_sheet_statuses():
+    """(row_number, name, phone, status) for every row, reading only columns A:B and I in one request"""
+    names, statuses = get_sheet().batch_get(['A:B', 'I:I'])
+    rows = []
+    for i in range(max(len(names), len(statuses))):
+        cells = (list(names[i]) if i < len(names) else []) + ['', '']
+        status = statuses[i][0] if i < len(statuses) and statuses[i] else ''
+        rows.append((i + 1, cells[0], str(cells[1]), status))
+    return rows
+
+# --- GOOGLE API EXECUTOR ---
+# Blocking Google calls run on a dedicated, size-limited thread pool so that one
+# slow upload never stalls the bot's event loop. Each API gets its own slot limit
+# and the pool is exactly as big as the sum of the limits, so Drive uploads can
+# never starve Sheets writes (and calls never queue inside the pool itself).
+GOOGLE_CONCURRENCY = {'drive': 8, 'sheets': 4}
+GOOGLE_TIMEOUTS = {'drive': 180, 'sheets': 30}  # Seconds per call
+
+_google_executor = ThreadPoolExecutor(max_workers=sum(GOOGLE_CONCURRENCY.values()), thread_name_prefix='google-api')
+_google_semaphores = {}
+
+def _google_semaphore(api):
+    sem = _google_semaphores.get(api)
+    if sem is None:
+        sem = _google_semaphores[api] = asyncio.Semaphore(GOOGLE_CONCURRENCY[api])
+    return sem
+
+def _release_slot(loop, sem):
+    try:
+        loop.call_soon_threadsafe(sem.release)
+    except RuntimeError:  # Event loop already closed during shutdown
+        pass
+
+class GoogleCallTimeout(asyncio.TimeoutError):
+    """We stopped waiting for a Google call; `future` completes once its worker thread really returns"""
+
+    def __init__(self, future):
+        super().__init__()
+        self.future = future
+
+async def run_google(api, func, *args, timeout=None, **kwargs):
+    """Run a blocking Google API call ('drive' or 'sheets') on the worker pool"""
+    sem = _google_semaphore(api)
+    await sem.acquire()  # Cancelling while waiting here never reaches Google
+    loop = asyncio.get_running_loop()
+    op = getattr(func, '__name__', 'call')
+    try:
+        # The worker thread runs in a copy of this context, so its logs keep the trace id
+        future = _google_executor.submit(contextvars.copy_context().run, functools.partial(func, *args, **kwargs))
+    except BaseException:
+        sem.release()
+        raise
+    # The slot is only freed once the worker thread is really done, even if the
+    # caller timed out or was cancelled, so the pool is never oversubscribed.
+    future.add_done_callback(lambda _: _release_slot(loop, sem))
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), timeout or GOOGLE_TIMEOUTS[api])
+    except asyncio.TimeoutError:
+        logging.warning(f"Google {api} call {op} timed out")
+        _record_google_call(api, op, started, error=True)
+        raise GoogleCallTimeout(future) from None
+    except Exception as e:
+        _record_google_call(api, op, started, error=True, quota=is_quota_error(e))
+        raise
+    _record_google_call(api, op, started)
+    return result
+
+def _record_google_call(api, op, started, error=False, quota=False):
+    elapsed = time.monotonic() - started
+    admission_control.record_call(api, elapsed, error=error, quota=quota, timed=op not in UNTIMED_OPS)
+    GOOGLE_SECONDS.observe(elapsed, api=api, op=op)
+    if error:
+        GOOGLE_ERRORS.inc(api=api, op=op)
+
+def is_quota_error(error):
+    """True for Google 'rate limit / quota exceeded' responses"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)  # gspread
+    if status is None:
+        status = getattr(getattr(error, 'resp', None), 'status', None)  # googleapiclient
+    return status == 429 or (status == 403 and 'ateLimitExceeded' in str(error))
+
+async def upload_to_drive(stream, filename, folder_id, size=None, key=None, timeout=None):
+    await run_google('drive', _upload_file, stream, filename, folder_id, size, key, timeout=timeout)
+    UPLOADS.inc()
+    UPLOAD_BYTES.inc(size if size is not None else stream.tell())
+
+# --- DOCUMENT PIPELINE ---
+# Telegram files are streamed straight into the buffer that Drive reads from:
+# small files stay in one BytesIO, large ones are spooled to a temp file and
+# uploaded in resumable chunks. A global memory budget holds back new downloads
+# while too much file data is already in flight.
+SPOOL_THRESHOLD = 2 * 1024 * 1024  # Files bigger than this (or of unknown size) go to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Must be a multiple of 256 KB for Drive
+UPLOAD_MAX_RETRIES = 5
+UPLOAD_MEMORY_BUDGET = 64 * 1024 * 1024  # Bytes of file data held in memory across all uploads
+DOWNLOAD_TIMEOUT = 60
+
+class MemoryBudget:
+    """Async byte budget shared by all uploads in flight"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes):
+        nbytes = min(nbytes, self.limit)  # An oversized file may still run on its own
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_use + nbytes <= self.limit)
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            async with cond:
+                self.in_use -= nbytes
+                cond.notify_all()
+
+upload_budget = MemoryBudget(UPLOAD_MEMORY_BUDGET)
+_download_client = None
+
+def upload_memory_cost(size):
+    """Bytes of memory an upload of this size keeps alive"""
+    if size is not None and size <= SPOOL_THRESHOLD:
+        return size
+    return UPLOAD_CHUNK_SIZE
+
+def _download_http():
+    global _download_client
+    if _download_client is None:
+        _download_client = httpx.AsyncClient(timeout=httpx.Timeout(DOWNLOAD_TIMEOUT, connect=10.0))
+    return _download_client
+
+class HashingWriter:
+    """File-like wrapper that hashes everything written through it"""
+
+    def __init__(self, target):
+        self.target = target
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.target.write(data)
+
+async def download_telegram_file(tg_file, size=None):
+    """Stream a Telegram file into a BytesIO (small) or a spooled temp file (large).
+
+    Returns the stream (rewound) and the SHA-256 of its content."""
+    if size is not None and size <= SPOOL_THRESHOLD:
+        target = io.BytesIO()
+    else:
+        target = tempfile.TemporaryFile(prefix='formcare_')
+    try:
+        writer = HashingWriter(target)
+        with TELEGRAM_SECONDS.time(op='download'):
+            await _download_into(tg_file, writer)
+        target.seek(0)
+        return target, writer.sha256.hexdigest()
+    except BaseException:
+        target.close()
+        raise
+
+async def _download_into(tg_file, target):
+    if str(tg_file.file_path).startswith(('http://', 'https://')):
+        async with _download_http().stream('GET', tg_file.file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                target.write(chunk)
+    else:
+        # Local Bot API server: file_path is a path on this machine
+        await tg_file.download_to_memory(target)
+
+# --- DOCUMENT DEDUP ---
+# Students often resend the same photo or PDF. Every file stored in a student
+# folder is recorded by Telegram's file_unique_id (checked before downloading)
+# and by the SHA-256 of its content (catches the same file uploaded again).
+# A file is claimed before its upload and released if the upload fails.
+
+def pending_folder_scope(phone, name_norm):
+    """Dedup scope for a student's files while their folder is still being created"""
+    return f"pending:{phone}:{name_norm}"
+
+def is_uploaded_file(folder_id, file_unique_id):
+    """Check if this Telegram file is already stored in the folder"""
+    return db_fetchone("SELECT 1 FROM uploaded_files WHERE folder_id = ? AND file_unique_id = ?", 
+                       (folder_id, file_unique_id)) is not None
+
+def claim_uploaded_file(folder_id, file_unique_id, sha256):
+    """Record a file for the folder; returns 'file_id' or 'hash' if it is a duplicate, else None"""
+    with db_transaction() as c:
+        row = c.execute("""SELECT file_unique_id FROM uploaded_files 
+                           WHERE folder_id = ? AND (file_unique_id = ? OR sha256 = ?) LIMIT 1""", 
+                        (folder_id, file_unique_id, sha256)).fetchone()
+        if row:
+            return 'file_id' if row[0] == file_unique_id else 'hash'
+        c.execute("INSERT INTO uploaded_files (folder_id, file_unique_id, sha256, created) VALUES (?, ?, ?, ?)", 
+                  (folder_id, file_unique_id, sha256, time.time()))
+    return None
+
+def release_uploaded_file(folder_id, file_unique_id):
+    """Forget a claimed file whose upload failed, so a resend is stored"""
+    db_execute("DELETE FROM uploaded_files WHERE folder_id = ? AND file_unique_id = ?", (folder_id, file_unique_id))
+
+# --- DRIVE FOLDERS ---
+# Each (phone, student name) gets one Drive folder, remembered in queue.db, so a
+# student who restarts the flow keeps their folder (and sheet row). The name step
+# never waits for Drive: it reuses the registered folder or claims a spare one
+# from a small pool (renamed in the background); only when the pool is empty is
+# a folder created, when the first document arrives.
+FOLDER_POOL_SIZE = int(os.getenv("FOLDER_POOL_SIZE", "10"))  # Spare folders kept ready; 0 = no pool
+FOLDER_POOL_INTERVAL = 60  # Seconds between pool refills / rename retries
+POOL_FOLDER_PREFIX = "_spare_"
+
+_rename_tasks = {}  # folder_id -> background rename in progress
+
+def get_registered_folder(phone, name_norm):
+    """The (folder_id, link) registered for a student, or None"""
+    return db_fetchone("SELECT folder_id, link FROM drive_folders WHERE phone = ? AND name_norm = ?", (phone, name_norm))
+
+def register_folder(phone, name_norm, name, folder_id, link, renamed=True):
+    """Register a folder for a student; if one was registered meanwhile, that one wins.
+
+    Files recorded before the student had a folder move to it, so resends stay deduplicated."""
+    with db_transaction() as c:
+        c.execute("""INSERT OR IGNORE INTO drive_folders (phone, name_norm, folder_id, link, name, renamed, created) 
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""", (phone, name_norm, folder_id, link, name, int(renamed), time.time()))
+        folder = c.execute("SELECT folder_id, link FROM drive_folders WHERE phone = ? AND name_norm = ?", (phone, name_norm)).fetchone()
+        pending = pending_folder_scope(phone, name_norm)
+        c.execute("UPDATE OR IGNORE uploaded_files SET folder_id = ? WHERE folder_id = ?", (folder[0], pending))
+        c.execute("DELETE FROM uploaded_files WHERE folder_id = ?", (pending,))
+        return folder
+
+def claim_pool_folder(phone, name_norm, name):
+    """Move the oldest spare folder to a student, return its (folder_id, link) or None"""
+    with db_transaction() as c:
+        registered = c.execute("SELECT folder_id, link FROM drive_folders WHERE phone = ? AND name_norm = ?", 
+                               (phone, name_norm)).fetchone()
+        if registered is not None:
+            return registered  # Registered meanwhile: the spare stays in the pool
+        spare = c.execute("SELECT folder_id, link FROM folder_pool ORDER BY created LIMIT 1").fetchone()
+        if spare is None:
+            return None
+        c.execute("DELETE FROM folder_pool WHERE folder_id = ?", (spare[0],))
+        return register_folder(phone, name_norm, name, spare[0], spare[1], renamed=False)
+
+def add_pool_folder(folder_id, link):
+    db_execute("INSERT OR IGNORE INTO folder_pool (folder_id, link, created) VALUES (?, ?, ?)", (folder_id, link, time.time()))
+
+def get_pool_size():
+    return db_fetchone("SELECT COUNT(*) FROM folder_pool")[0]
+
+def get_unrenamed_folders():
+    return db_fetchall("SELECT folder_id, name FROM drive_folders WHERE renamed = 0")
+
+def mark_folder_renamed(folder_id):
+    db_execute("UPDATE drive_folders SET renamed = 1 WHERE folder_id = ?", (folder_id,))
+
+def import_folder_registry():
+    """One-time import of the folders behind already queued sheet rows (row_key is '<phone>:<folder_id>')"""
+    if db_fetchone("SELECT 1 FROM meta WHERE key = 'folder_registry_imported'"):
+        return
+    now = time.time()
+    folders = []
+    for row_key, data in db_fetchall("SELECT row_key, row_data FROM sheet_rows ORDER BY id"):
+        row = json.loads(data)
+        phone, _, folder_id = row_key.partition(':')
+        if folder_id and len(row) > 7:
+            folders.append((phone, normalize_name(row[0]), folder_id, row[7], f"{phone}_{row[0]}", now))
+    with db_transaction() as c:
+        c.executemany("""INSERT OR IGNORE INTO drive_folders (phone, name_norm, folder_id, link, name, renamed, created) 
+                         VALUES (?, ?, ?, ?, ?, 1, ?)""", folders)
+        c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('folder_registry_imported', ?)", (str(now),))
+    if folders:
+        logging.info(f"Imported {len(folders)} Drive folders into the folder registry")
+
+async def _rename_folder(folder_id, name):
+    try:
+        await run_google('drive', rename_drive_folder, folder_id, name)
+        await run_db(mark_folder_renamed, folder_id)
+    except Exception as e:
+        logging.warning(f"Renaming folder {folder_id} to {name} failed, will retry: {e}")
+
+async def _return_to_pool(folder_id, link):
+    """A folder made for a student who was given another one meanwhile becomes a spare"""
+    try:
+        await run_google('drive', rename_drive_folder, folder_id, f"{POOL_FOLDER_PREFIX}{int(time.time() * 1000)}")
+    except Exception as e:
+        logging.warning(f"Renaming unused folder {folder_id} failed: {e}")  # Renamed again when claimed
+    await run_db(add_pool_folder, folder_id, link)
+
+async def register_new_folder(phone, name_norm, name, folder_id, link):
+    """Register a folder this worker created; if another one won the race, return ours to the pool"""
+    folder = await run_db(register_folder, phone, name_norm, name, folder_id, link)
+    if folder[0] != folder_id:
+        await _return_to_pool(folder_id, link)
+    return folder
+
+async def provision_folder(phone, student_name, create=False):
+    """(folder_id, link) for a student: registered, else a spare one, else (create=True) a new one.
+
+    Returns None when there is no folder yet and create is False."""
+    name_norm = normalize_name(student_name)
+    name = f"{phone}_{student_name}"
+    folder = await run_db(get_registered_folder, phone, name_norm)
+    if folder:
+        return folder
+    folder = await run_db(claim_pool_folder, phone, name_norm, name)
+    if folder:
+        task = _rename_tasks[folder[0]] = asyncio.create_task(_rename_folder(folder[0], name))
+        task.add_done_callback(lambda _: _rename_tasks.pop(folder[0], None))
+        return folder
+    if not create:
+        return None
+    f_id, f_link = await run_google('drive', create_drive_folder, name)
+    return await register_new_folder(phone, name_norm, name, f_id, f_link)
+
+async def maintain_folder_pool(context: ContextTypes.DEFAULT_TYPE):
+    """Job: retry failed renames and top the spare folder pool back up"""
+    for folder_id, name in await run_db(get_unrenamed_folders):
+        if folder_id not in _rename_tasks:
+            await _rename_folder(folder_id, name)
+    try:
+        for _ in range(FOLDER_POOL_SIZE - await run_db(get_pool_size)):
+            f_id, f_link = await run_google('drive', create_drive_folder, f"{POOL_FOLDER_PREFIX}{int(time.time() * 1000)}")
+            await run_db(add_pool_folder, f_id, f_link)
+    except Exception as e:
+        logging.warning(f"Could not refill the folder pool: {e}")
+
+# --- OUTBOX ---
+# Google side-effects that failed (Drive or Sheets down, slow or over quota) are
+# not lost: the job goes into the outbox table - file bytes into the spool
+# directory - and the user is acknowledged right away. A background replayer
+# retries due jobs in order with exponential backoff. Every job has an
+# idempotency key; Drive files and folders carry it in their appProperties, so a
+# retry first checks whether an earlier attempt got through after all. Jobs that
+# keep failing are marked stuck and reported to the admin.
+OUTBOX_SPOOL_DIR = 'outbox_spool'
+OUTBOX_INTERVAL = 15  # Seconds between replay passes
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_BACKOFF_BASE = 30  # Seconds before the first retry, doubled on every failure
+OUTBOX_BACKOFF_MAX = 30 * 60
+OUTBOX_MAX_ATTEMPTS = 12  # About 4 hours of retries before a job is reported as stuck
+INLINE_UPLOAD_TIMEOUT = 60  # Seconds a student waits for an upload before it moves to the outbox
+
+OUTBOX_PENDING = Gauge('formcare_outbox_pending', 'Google side-effects waiting in the outbox')
+OUTBOX_STUCK = Gauge('formcare_outbox_stuck', 'Outbox jobs that gave up and need the admin')
+
+class OutboxNotReady(Exception):
+    """The job depends on another one that has not run yet (retried without counting an attempt)"""
+
+class OutboxBlocked(Exception):
+    """The job depends on another one that is stuck, so it is stuck as well"""
+
+def folder_job_key(phone, name_norm):
+    return f"folder:{phone}:{name_norm}"
+
+def enqueue_outbox(kind, key, payload, delay=0):
+    """Add a job (first run after `delay` seconds) unless one with this key exists; True if it was added"""
+    now = time.time()
+    with db_transaction() as c:
+        c.execute("""INSERT OR IGNORE INTO outbox (kind, key, payload, status, next_attempt, created, updated) 
+                     VALUES (?, ?, ?, 'pending', ?, ?, ?)""", 
+                  (kind, key, json.dumps(payload, ensure_ascii=False), now + delay, now, now))
+        return c.rowcount > 0
+
+def claim_due_outbox(limit=OUTBOX_BATCH_SIZE):
+    """Due pending jobs as (id, kind, key, payload, attempts), oldest first"""
+    rows = db_fetchall("""SELECT id, kind, key, payload, attempts FROM outbox 
+                          WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?""", (time.time(), limit))
+    return [(job_id, kind, key, json.loads(payload), attempts) for job_id, kind, key, payload, attempts in rows]
+
+def finish_outbox(job_id):
+    db_execute("UPDATE outbox SET status = 'done', last_error = NULL, updated = ? WHERE id = ?", (time.time(), job_id))
+
+def retry_outbox(job_id, error, delay, attempts):
+    db_execute("UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ?, updated = ? WHERE id = ?", 
+               (attempts, time.time() + delay, error, time.time(), job_id))
+
+def mark_outbox_stuck(job_id, error, attempts):
+    """Give up on a job; a stuck upload releases its dedup claim so the student can send the file again"""
+    with db_transaction() as c:
+        c.execute("UPDATE outbox SET status = 'stuck', attempts = ?, last_error = ?, updated = ? WHERE id = ?", 
+                  (attempts, error, time.time(), job_id))
+        job = c.execute("SELECT kind, key, payload FROM outbox WHERE id = ?", (job_id,)).fetchone()
+        if job and job[0] == 'upload':
+            release_upload_claim(job[1], json.loads(job[2]))
+
+def release_upload_claim(key, payload):
+    """Forget the file of an upload job (key 'upload:<scope>:<file_unique_id>'), wherever its claim is now"""
+    file_unique_id = payload.get('file_unique_id') or key.rsplit(':', 1)[1]
+    scopes = [payload.get('folder_id') or pending_folder_scope(payload['phone'], payload['name_norm'])]
+    if payload.get('folder_id') is None:  # The claim moved to the folder if it was registered meanwhile
+        folder = get_registered_folder(payload['phone'], payload['name_norm'])
+        if folder:
+            scopes.append(folder[0])
+    for scope in scopes:
+        release_uploaded_file(scope, file_unique_id)
+
+def get_outbox_status(key):
+    row = db_fetchone("SELECT status FROM outbox WHERE key = ?", (key,))
+    return row[0] if row else None
+
+def get_outbox_counts():
+    """{status: count} for the jobs that are not done"""
+    return dict(db_fetchall("SELECT status, COUNT(*) FROM outbox WHERE status IN ('pending', 'stuck') GROUP BY status"))
+
+async def submit_outbox(kind, key, payload, delay=OUTBOX_BACKOFF_BASE):
+    """Queue a job that just failed; it is first retried after `delay` seconds"""
+    added = await run_db(enqueue_outbox, kind, key, payload, delay)
+    OUTBOX_PENDING.inc(int(added))
+    return added
+
+def _spool_path(key):
+    return os.path.join(OUTBOX_SPOOL_DIR, hashlib.sha256(key.encode()).hexdigest() + '.bin')
+
+def _write_spool(stream, path):
+    os.makedirs(OUTBOX_SPOOL_DIR, exist_ok=True)
+    stream.seek(0)
+    with open(path + '.tmp', 'wb') as f:
+        while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+async def queue_upload(key, payload, stream=None, delay=OUTBOX_BACKOFF_BASE):
+    """Put an upload in the outbox; the bytes are spooled to disk when we have them"""
+    if stream is not None:
+        payload['spool'] = _spool_path(key)
+        await asyncio.to_thread(_write_spool, stream, payload['spool'])
+    await submit_outbox('upload', key, payload, delay)
+
+async def _replay_upload(application, key, payload):
+    folder_id = payload.get('folder_id')
+    if folder_id is None:  # The folder itself was still waiting in the outbox
+        folder = await run_db(get_registered_folder, payload['phone'], payload['name_norm'])
+        if folder is None:
+            folder_job = await run_db(get_outbox_status, folder_job_key(payload['phone'], payload['name_norm']))
+            if folder_job == 'pending':
+                raise OutboxNotReady("folder not created yet")
+            if folder_job == 'stuck':
+                raise OutboxBlocked("the student's folder job is stuck")
+            raise RuntimeError(f"no folder and no folder job ({folder_job})")  # Counted as a failed attempt
+        folder_id = folder[0]
+    if await run_google('drive', find_drive_file, key, folder_id):
+        return  # An earlier (timed out) attempt got through
+    spool = payload.get('spool')
+    if spool and os.path.exists(spool):
+        size = os.path.getsize(spool)
+        stream = open(spool, 'rb')
+    else:  # Not spooled (the upload timed out while reading it): fetch it from Telegram again
+        size = payload.get('size')
+        file = await application.bot.get_file(payload['file_id'])
+        stream, _ = await download_telegram_file(file, size)
+    try:
+        async with upload_budget.reserve(upload_memory_cost(size)):
+            await upload_to_drive(stream, payload['filename'], folder_id, size, key=key)
+    finally:
+        stream.close()
+    if spool:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(spool)
+
+async def _replay_folder(application, key, payload):
+    phone, name_norm, name = payload['phone'], payload['name_norm'], payload['name']
+    folder = await run_db(get_registered_folder, phone, name_norm)
+    if folder is None:
+        found = await run_google('drive', find_drive_file, key)
+        f_id, f_link = found or await run_google('drive', create_drive_folder, name, key=key)
+        folder = await register_new_folder(phone, name_norm, name, f_id, f_link)
+    row = payload['row']
+    row[7] = folder[1]  # Folder link column
+    await submit_sheet_row(f"{phone}:{folder[0]}", row)
+
+async def _replay_status(application, key, payload):
+    if 'students' in payload:
+        # Locate the rows in the sheet as it is now
+        await run_google('sheets', reconcile_sheet_mirror)
+        rows = await run_db(find_sheet_rows, [tuple(student) for student in payload['students']])
+        statuses = [(row, payload['status']) for row in sorted({row for row in rows if row is not None})]
+    else:  # Queued before jobs named their students: row numbers as they were then
+        statuses = [tuple(s) for s in payload['statuses']]
+    if statuses:
+        await sheet_write_pacer.acquire()
+        await run_google('sheets', update_sheet_statuses, statuses)
+        await run_db(set_mirror_statuses, statuses)
+
+OUTBOX_HANDLERS = {'upload': _replay_upload, 'folder': _replay_folder, 'status': _replay_status}
+
+async def replay_outbox(application):
+    """Run every due job once, return how many ran"""
+    jobs = await run_db(claim_due_outbox)
+    for job_id, kind, key, payload, attempts in jobs:
+        try:
+            await OUTBOX_HANDLERS[kind](application, key, payload)
+        except OutboxNotReady as e:
+            await run_db(retry_outbox, job_id, str(e), OUTBOX_INTERVAL, attempts)
+        except Exception as e:
+            attempts += 1
+            error = f"{type(e).__name__}: {e}"
+            if attempts >= OUTBOX_MAX_ATTEMPTS or isinstance(e, OutboxBlocked):
+                await run_db(mark_outbox_stuck, job_id, error, attempts)
+                logging.error(f"Outbox job {kind} {key} is stuck: {error}")
+                outbound.post(PRIORITY_ADMIN, ADMIN_ID, application.bot.send_message, chat_id=ADMIN_ID, 
+                              text=f"⚠️ Google काम {attempts} बार विफल रहा, कृपया जांच करें:\n{kind} {key}\n{error}")
+            else:
+                delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+                await run_db(retry_outbox, job_id, error, delay, attempts)
+                logging.warning(f"Outbox job {kind} {key} failed (attempt {attempts}), retrying in {delay}s: {error}")
+        else:
+            await run_db(finish_outbox, job_id)
+    counts = await run_db(get_outbox_counts)
+    OUTBOX_PENDING.set(counts.get('pending', 0))
+    OUTBOX_STUCK.set(counts.get('stuck', 0))
+    return len(jobs)
+
+async def outbox_replayer(application):
+    """Background task that replays due outbox jobs every OUTBOX_INTERVAL"""
+    while True:
+        await asyncio.sleep(OUTBOX_INTERVAL)
+        if not is_leader():
+            continue
+        try:
+            while await replay_outbox(application) == OUTBOX_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logging.error(f"Outbox replayer error: {e}")
+
+# --- SHEET WRITE-BEHIND ---
+# Registration rows are written to queue.db first (that is when the user is
+# acknowledged) and a background writer appends them to the sheet in batches.
+# Rows move pending -> inflight -> sent; an "inflight" batch whose outcome is
+# unknown (timeout, crash) is checked against the sheet before it is retried,
+# so every row lands in the sheet exactly once.
+SHEET_BATCH_SIZE = 50  # Flush as soon as this many rows are waiting
+SHEET_FLUSH_INTERVAL = 10  # ...or after this many seconds
+SHEETS_WRITES_PER_MINUTE = 50  # Google allows 60 write requests per minute per user
+
+class RatePacer:
+    """Token bucket for write requests that backs off after quota errors"""
+
+    def __init__(self, per_minute, burst=5):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.penalty = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def backoff(self):
+        """Pause all writes, doubling the pause on every consecutive quota error"""
+        self.penalty = min(max(self.penalty * 2, 2.0), 64.0)
+        self.blocked_until = time.monotonic() + self.penalty
+
+    def success(self):
+        self.penalty = 0.0
+
+sheet_write_pacer = RatePacer(SHEETS_WRITES_PER_MINUTE)
+_sheet_wakeup = None
+_sheet_writer_task = None
+_sheet_recovery_needed = True  # Until inflight rows left by an earlier run are settled
+_abandoned_append = None  # Future of an append we stopped waiting for; it may still land
+
+def _sheet_event():
+    global _sheet_wakeup
+    if _sheet_wakeup is None:
+        _sheet_wakeup = asyncio.Event()
+    return _sheet_wakeup
+
+def queue_sheet_row(row_key, row):
+    """Persist a registration row locally; the background writer appends it to the sheet"""
+    with db_transaction() as c:
+        c.execute("INSERT OR IGNORE INTO sheet_rows (row_key, row_data, status, created) VALUES (?, ?, 'pending', ?)", 
+                  (row_key, json.dumps(row, ensure_ascii=False), time.time()))
+        pending = c.execute("SELECT COUNT(*) FROM sheet_rows WHERE status = 'pending'").fetchone()[0]
+    return pending
+
+async def submit_sheet_row(row_key, row):
+    """Queue a row from a handler, waking the writer once a full batch is waiting"""
+    pending = await run_db(queue_sheet_row, row_key, row)
+    if pending >= SHEET_BATCH_SIZE:
+        _sheet_event().set()
+
+def _claim_sheet_batch():
+    """Mark the oldest pending rows as inflight and return them"""
+    with db_transaction() as c:
+        c.execute("SELECT id, row_data FROM sheet_rows WHERE status = 'pending' ORDER BY id LIMIT ?", (SHEET_BATCH_SIZE,))
+        batch = [(row_id, json.loads(data)) for row_id, data in c.fetchall()]
+        c.executemany("UPDATE sheet_rows SET status = 'inflight' WHERE id = ?", [(row_id,) for row_id, _ in batch])
+    return batch
+
+def _finish_sheet_rows(row_ids, status, first_row=None):
+    """Mark rows as sent (with their sheet row numbers) or back to pending"""
+    now = time.time()
+    with db_transaction() as c:
+        for offset, row_id in enumerate(row_ids):
+            sheet_row = first_row + offset if (first_row and status == 'sent') else None
+            c.execute("UPDATE sheet_rows SET status = ?, sent_time = ?, sheet_row = ? WHERE id = ?", 
+                      (status, now if status == 'sent' else None, sheet_row, row_id))
+
+def recover_inflight_sheet_rows():
+    """Settle inflight rows from an interrupted flush by checking what the sheet already has"""
+    inflight = db_fetchall("SELECT id, row_data FROM sheet_rows WHERE status = 'inflight' ORDER BY id")
+    if not inflight:
+        return
+    written = {}
+    for i, row in enumerate(get_sheet_values()):
+        written.setdefault(tuple(row[:9]), i + 1)
+    for row_id, data in inflight:
+        key = tuple('' if v is None else str(v) for v in json.loads(data))
+        sheet_row = written.get(key)
+        if sheet_row:
+            _finish_sheet_rows([row_id], 'sent', sheet_row)
+            mirror_sheet_rows([(sheet_row, json.loads(data))])
+        else:
+            _finish_sheet_rows([row_id], 'pending')
+    logging.info(f"Recovered {len(inflight)} inflight sheet rows")
+
+def _is_definite_failure(error):
+    """True if Google rejected the request, i.e. nothing was written"""
+    import gspread
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return isinstance(error, gspread.exceptions.APIError) and status is not None and status < 500
+
+async def flush_sheet_rows():
+    """Append one batch of pending rows to the sheet, return how many were written"""
+    global _sheet_recovery_needed, _abandoned_append
+    if _abandoned_append is not None:
+        if not _abandoned_append.done():
+            return 0  # Checking the sheet now could miss rows that are still on their way
+        _abandoned_append = None
+    if _sheet_recovery_needed:
+        await run_google('sheets', recover_inflight_sheet_rows)
+        _sheet_recovery_needed = False
+    batch = await run_db(_claim_sheet_batch)
+    if not batch:
+        return 0
+    row_ids = [row_id for row_id, _ in batch]
+    await sheet_write_pacer.acquire()
+    try:
+        first_row = await run_google('sheets', append_sheet_rows, [row for _, row in batch])
+    except Exception as e:
+        if _is_definite_failure(e):
+            if getattr(e.response, 'status_code', None) == 429:
+                sheet_write_pacer.backoff()
+            await run_db(_finish_sheet_rows, row_ids, 'pending')
+        else:
+            # Outcome unknown (timeout, 5xx, network): the rows may be in the sheet already,
+            # so they stay inflight until the next flush checks the sheet for them
+            # (after a timed-out append has really finished)
+            sheet_write_pacer.backoff()
+            _sheet_recovery_needed = True
+            if isinstance(e, GoogleCallTimeout):
+                _abandoned_append = e.future
+        logging.error(f"Sheet batch append failed: {e}")
+        return 0
+    sheet_write_pacer.success()
+    await run_db(_finish_sheet_rows, row_ids, 'sent', first_row)
+    if first_row:
+        await run_db(mirror_sheet_rows, [(first_row + i, row) for i, (_, row) in enumerate(batch)])
+    return len(row_ids)
+
+async def sheet_writer():
+    """Background task that flushes queued rows on a size or time threshold"""
+    event = _sheet_event()
+    while True:
+        try:
+            await asyncio.wait_for(event.wait(), SHEET_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+        if not is_leader():
+            continue  # Rows queued here are flushed by the leader
+        try:
+            while await flush_sheet_rows() == SHEET_BATCH_SIZE:
+                pass  # Keep draining while full batches are waiting
+        except Exception as e:
+            logging.error(f"Sheet writer error: {e}")
+
+def start_sheet_writer():
+    global _sheet_writer_task
+    _sheet_writer_task = asyncio.create_task(sheet_writer())
+
+async def stop_sheet_writer():
+    """Stop the writer and try to flush what is left (anything unsent stays in queue.db)"""
+    if _sheet_writer_task is None:
+        return
+    _sheet_writer_task.cancel()
+    if not is_leader():
+        return
+    try:
+        await flush_sheet_rows()
+    except Exception as e:
+        logging.error(f"Final sheet flush failed: {e}")
+
+# --- SHEET MIRROR ---
+# A local copy of the name/phone/status columns, indexed by phone and normalised
+# name, so /verify finds its row without downloading the whole sheet. It is fed
+# by the write-behind writer, rebuilt by the status feed whenever the sheet's
+# version moves and fully reconciled with the sheet periodically. Admins can
+# delete, insert or sort rows at any time, so /verify still confirms the name and
+# phone of its rows in the live sheet before writing to them.
+SHEET_RECONCILE_INTERVAL = 15 * 60
+MIRROR_MISS_REFRESH = 60  # On a miss, re-read the sheet if the mirror is older than this
+
+_mirror_synced_at = 0.0
+
+def normalize_name(name):
+    """Lower-case a student name and collapse its whitespace"""
+    return " ".join(str(name or '').split()).casefold()
+
+def _mirror_record(row_number, row):
+    row = list(row) + [''] * (9 - len(row))
+    return (row_number, row[0], normalize_name(row[0]), str(row[1] or ''), row[8])
+
+def mirror_sheet_rows(rows):
+    """Insert or update mirror entries from (row_number, row) pairs"""
+    with db_transaction() as c:
+        c.executemany("INSERT OR REPLACE INTO sheet_mirror (row_number, name, name_norm, phone, status) VALUES (?, ?, ?, ?, ?)", 
+                      [_mirror_record(n, row) for n, row in rows])
+
+def set_mirror_statuses(statuses):
+    with db_transaction() as c:
+        c.executemany("UPDATE sheet_mirror SET status = ? WHERE row_number = ?", [(status, row) for row, status in statuses])
+
+def replace_sheet_mirror(rows):
+    """Rebuild the mirror from (row_number, name, phone, status) rows read from the sheet"""
+    global _mirror_synced_at
+    with db_transaction() as c:
+        c.execute("DELETE FROM sheet_mirror")
+        c.executemany("INSERT INTO sheet_mirror (row_number, name, name_norm, phone, status) VALUES (?, ?, ?, ?, ?)", 
+                      [(n, name, normalize_name(name), str(phone or ''), status) for n, name, phone, status in rows])
+    _mirror_synced_at = time.time()
+
+def reconcile_sheet_mirror():
+    """Rebuild the mirror from the live sheet (runs on a Google worker thread)"""
+    values = get_sheet_values()
+    replace_sheet_mirror([(n, name, phone, status) for n, name, _, phone, status in 
+                          (_mirror_record(i + 1, row) for i, row in enumerate(values))])
+    return len(values)
+
+def find_sheet_rows(pairs):
+    """Resolve many (phone, student_name) pairs at once; None where no row matches"""
+    phones = list({phone for phone, _ in pairs})
+    candidates = {}
+    for i in range(0, len(phones), 500):  # Stay well below SQLite's bound-parameter limit
+        chunk = phones[i:i + 500]
+        rows = db_fetchall(f"SELECT row_number, phone, name_norm FROM sheet_mirror WHERE phone IN ({','.join('?' * len(chunk))}) ORDER BY row_number", 
+                           chunk)
+        for row_number, phone, name_norm in rows:
+            candidates.setdefault(phone, []).append((row_number, name_norm))
+    found = []
+    for phone, student_name in pairs:
+        wanted = normalize_name(student_name)
+        found.append(next((n for n, name_norm in candidates.get(phone, []) if wanted in name_norm), None))
+    return found
+
+def is_valid_marker(marker):
+    """A /verifybulk marker must be a status an admin typed, not blank or the pending status"""
+    marker = marker.strip().casefold()
+    return bool(marker) and marker not in (PENDING_STATUS.casefold(), PENDING_STATUS.split()[0].casefold())
+
+def find_marked_rows(marker):
+    """All (row_number, phone, name) whose status column reads `marker` (case-insensitive)"""
+    if not is_valid_marker(marker):
+        raise ValueError(f"Invalid status marker: {marker!r}")
+    return db_fetchall("SELECT row_number, phone, name FROM sheet_mirror WHERE trim(status) = ? COLLATE NOCASE ORDER BY row_number", 
+                       (marker.strip(),))
+
+async def lookup_sheet_row(phone, student_name):
+    """Resolve a row from the mirror, re-reading the sheet once if the mirror may be stale"""
+    return (await lookup_sheet_rows([(phone, student_name)]))[0]
+
+async def lookup_sheet_rows(pairs):
+    """Resolve many rows from the mirror, with at most one sheet re-read for the misses"""
+    rows = await run_db(find_sheet_rows, pairs)
+    if None in rows and time.time() - _mirror_synced_at > MIRROR_MISS_REFRESH:
+        await run_google('sheets', reconcile_sheet_mirror)
+        rows = await run_db(find_sheet_rows, pairs)
+    return rows
+
+async def sheet_mirror_sync():
+    """Background task that periodically reconciles the mirror with the sheet"""
+    while True:
+        try:
+            if is_leader():
+                count = await run_google('sheets', reconcile_sheet_mirror)
+                logging.info(f"Sheet mirror reconciled ({count} rows)")
+        except Exception as e:
+            logging.error(f"Sheet mirror reconcile failed: {e}")
+        await asyncio.sleep(SHEET_RECONCILE_INTERVAL)
+
+# --- STATUS CHANGE FEED ---
+# Admins often type a status straight into column I instead of using /verify.
+# Every STATUS_FEED_INTERVAL the leader asks Drive for the spreadsheet's version;
+# only when it moved are the name, phone and status columns read (one request)
+# and diffed against status_feed, keyed by (phone, name) so deleted or moved rows
+# don't look like changes. Students whose status changed get one message each.
+# status_feed.notified remembers what a student was last told (verify_rows sets
+# it too), so nobody hears about the same status twice. A student registered more
+# than once has several rows; they are merged into one state, the most advanced
+# status winning (Verified, then any admin status, then pending, then blank).
+STATUS_FEED_INTERVAL = 60
+PENDING_STATUS = "Pending ⏳"  # Written by registration_row(); not announced
+STATUS_CHANGED_MESSAGE = "📋 <b>आपके फॉर्म का स्टेटस अपडेट हुआ है</b>\n\nनया स्टेटस: <b>{status}</b>"
+
+STATUS_FEED_NOTIFICATIONS = Counter('formcare_status_feed_notifications_total', 'Students told about a status an admin set in the sheet')
+
+def is_verified_status(status):
+    return status.strip().casefold().startswith('verified')
+
+def _status_rank(status):
+    if is_verified_status(status):
+        return 3
+    if status not in ('', PENDING_STATUS):
+        return 2
+    return 1 if status == PENDING_STATUS else 0
+
+def merge_student_rows(rows):
+    """Collapse (row_number, name, phone, status) rows to one per (phone, name):
+    {key: (row_number, name, phone, status)} with the most advanced status
+    (the later row wins between equally advanced ones)"""
+    merged = {}
+    for row_number, name, phone, status in rows:
+        if not phone:
+            continue
+        key = (phone, normalize_name(name))
+        status = status.strip()
+        current = merged.get(key)
+        if current is None or _status_rank(status) >= _status_rank(current[3]):
+            merged[key] = (row_number, name, phone, status)
+    return merged
+
+def apply_status_feed(rows, baseline=False):
+    """Store the latest (row_number, name, phone, status) rows and return those whose
+    status changed to one the student has not been told yet (none on the baseline run)"""
+    now = time.time()
+    known = {(phone, name_norm): (status, notified) for phone, name_norm, status, notified 
+             in db_fetchall("SELECT phone, name_norm, status, notified FROM status_feed")}
+    records, changes = {}, []
+    for key, (row_number, name, phone, status) in merge_student_rows(rows).items():
+        old_status, notified = known.get(key, (PENDING_STATUS, PENDING_STATUS))
+        if baseline:
+            notified = status
+        elif status != old_status and status not in ('', PENDING_STATUS) and status != notified:
+            changes.append((row_number, phone, name, status))
+            notified = status
+        records[key] = (phone, key[1], status, notified, now)
+    with db_transaction() as c:
+        c.executemany("INSERT OR REPLACE INTO status_feed (phone, name_norm, status, notified, seen) VALUES (?, ?, ?, ?, ?)", 
+                      list(records.values()))
+        c.execute("DELETE FROM status_feed WHERE seen < ?", (now,))  # Rows gone from the sheet
+    return changes
+
+def mark_statuses_notified(statuses):
+    """Record (row_number, status) pairs the students were just told about (rows resolved through the mirror)"""
+    now = time.time()
+    with db_transaction() as c:
+        c.executemany("""INSERT INTO status_feed (phone, name_norm, status, notified, seen) 
+                         SELECT phone, name_norm, ?, ?, ? FROM sheet_mirror WHERE row_number = ? 
+                         ON CONFLICT (phone, name_norm) DO UPDATE SET status = excluded.status, notified = excluded.notified""", 
+                      [(status, status, now, row) for row, status in statuses])
+
+def status_change_text(statuses):
+    """One message for all of a student's changed rows"""
+    if any(is_verified_status(status) for status in statuses):
+        return VERIFIED_MESSAGE
+    return STATUS_CHANGED_MESSAGE.format(status=html.escape(", ".join(dict.fromkeys(statuses))))
+
+async def notify_status_changes(application, changes):
+    """Tell each affected student once, concurrently (paced by the outbound scheduler)"""
+    chat_ids = await run_db(get_chat_ids_for_phones, [phone for _, phone, _, _ in changes])
+    recipients = {}  # chat_id -> new statuses
+    for _, phone, _, status in changes:
+        if phone in chat_ids:
+            recipients.setdefault(int(chat_ids[phone]), []).append(status)
+    sent = await asyncio.gather(*[notify(application.bot, chat_id, status_change_text(statuses), parse_mode="HTML") 
+                                  for chat_id, statuses in recipients.items()], return_exceptions=True)
+    for (chat_id, statuses), outcome in zip(recipients.items(), sent):
+        if isinstance(outcome, Exception):
+            logging.error(f"Could not send status update to {chat_id}: {outcome}")
+        else:
+            STATUS_FEED_NOTIFICATIONS.inc()
+        if any(is_verified_status(status) for status in statuses):
+            session_time = await run_db(remove_from_active_users, chat_id)
+            admission_control.record_session(session_time)
+    if recipients:
+        request_admission(application)
+    logging.info(f"Status feed: {len(changes)} rows changed in the sheet, {len(recipients)} students notified")
+
+async def check_status_feed(application):
+    """Diff the sheet's statuses if it changed since the last check, return the number of changed rows"""
+    version = await run_google('drive', get_sheet_version)
+    last = await run_db(get_meta, 'status_feed_version')
+    if last is not None and int(last) == version:
+        return 0
+    rows = await run_google('sheets', get_sheet_statuses)
+    await run_db(replace_sheet_mirror, rows)  # Rows may have been deleted, inserted or sorted too
+    changes = await run_db(apply_status_feed, rows, last is None)
+    await run_db(set_meta, 'status_feed_version', str(version))
+    if changes:
+        await notify_status_changes(application, changes)
+    return len(changes)
+
+async def status_feed_watcher(application):
+    """Background task that checks the sheet for admin status edits every STATUS_FEED_INTERVAL"""
+    while True:
+        await asyncio.sleep(STATUS_FEED_INTERVAL)
+        if not is_leader():
+            continue
+        try:
+            await check_status_feed(application)
+        except Exception as e:
+            logging.error(f"Status feed error: {e}")
+
+# --- CONVERSATION STATE PERSISTENCE ---
+# context.user_data survives restarts: each user's state is one JSON row in
+# queue.db. Rows are loaded lazily the first time a user's update is handled,
+# only users whose state actually changed are written (in one batch per
+# persistence run), and users idle for a while are evicted from memory.
+STATE_UPDATE_INTERVAL = 10  # Seconds between persistence runs
+STATE_EVICT_AFTER = 30 * 60  # Drop idle users from memory after this long
+STATE_EVICT_INTERVAL = 5 * 60
+
+def load_user_state(user_id):
+    row = db_fetchone("SELECT data FROM user_state WHERE user_id = ?", (user_id,))
+    return json.loads(row[0]) if row else None
+
+def save_user_states(states):
+    """Write many (user_id, json) rows in one transaction"""
+    now = time.time()
+    with db_transaction() as c:
+        c.executemany("""INSERT INTO user_state (user_id, data, updated) VALUES (?, ?, ?) 
+                         ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated""", 
+                      [(user_id, data, now) for user_id, data in states])
+
+def delete_user_state(user_id):
+    db_execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+class SQLiteUserPersistence(BasePersistence):
+    """Application persistence that stores only user_data, one row per user"""
+
+    def __init__(self, update_interval=STATE_UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), 
+                         update_interval=update_interval)
+        self._saved = {}  # user_id -> JSON last written (or loaded)
+        self._dirty = {}  # user_id -> JSON waiting for the next batch write
+        self._live = {}  # user_id -> the user_data dict the Application is using
+        self._last_seen = {}  # user_id -> time of the last handled update
+        self._evicted = set()
+        self._write_task = None
+
+    async def get_user_data(self):
+        return {}  # Nothing is preloaded; see refresh_user_data
+
+    async def refresh_user_data(self, user_id, user_data):
+        """Load a user's saved state the first time one of their updates is handled"""
+        self._last_seen[user_id] = time.monotonic()
+        if user_id in self._live:
+            return
+        self._live[user_id] = user_data
+        saved = await run_db(load_user_state, user_id)
+        if saved is not None:
+            self._saved[user_id] = json.dumps(saved, ensure_ascii=False, sort_keys=True)
+            for key, value in saved.items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        encoded = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        if self._saved.get(user_id) == encoded:
+            return  # Touched but unchanged
+        self._dirty[user_id] = encoded
+        if self._write_task is None or self._write_task.done():
+            # The Application updates all users of a run concurrently; write them together
+            self._write_task = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self):
+        await asyncio.sleep(0)
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+        try:
+            await run_db(save_user_states, list(batch.items()))
+        except Exception:
+            for user_id, encoded in batch.items():
+                self._dirty.setdefault(user_id, encoded)  # Retry with the next run
+            raise
+        self._saved.update(batch)
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicted:
+            # Evicted from memory only. If the user came back in the meantime the
+            # Application skipped their update in favour of this drop, so save now.
+            self._evicted.discard(user_id)
+            live = self._live.get(user_id)
+            if live is not None:
+                await self.update_user_data(user_id, live)
+            return
+        for store in (self._saved, self._dirty, self._live, self._last_seen):
+            store.pop(user_id, None)
+        await run_db(delete_user_state, user_id)
+
+    def evict_idle(self, application, max_idle=STATE_EVICT_AFTER):
+        """Forget users that have been idle for a while (their state stays in queue.db)"""
+        cutoff = time.monotonic() - max_idle
+        idle = [user_id for user_id, seen in self._last_seen.items() if seen < cutoff and user_id not in self._dirty]
+        for user_id in idle:
+            for store in (self._saved, self._live, self._last_seen):
+                store.pop(user_id, None)
+            self._evicted.add(user_id)
+            application.drop_user_data(user_id)
+        return len(idle)
+
+    async def flush(self):
+        if self._write_task is not None:
+            await asyncio.gather(self._write_task, return_exceptions=True)
+        await self._write_dirty()
+
+    # Only user_data is persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
 
-def get_active_user_count():
-    """Get count of currently active users"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM active_users")
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    async def update_callback_data(self, data):
+        pass
 
-def add_to_active_users(telegram_id):
-    """Add user to active users list"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO active_users (telegram_id, start_time) VALUES (?, ?)", 
-              (telegram_id, time.time()))
-    conn.commit()
-    conn.close()
-
-def remove_from_active_users(telegram_id):
-    """Remove user from active users list"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM active_users WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    conn.close()
+    async def drop_chat_data(self, chat_id):
+        pass
 
-def get_doc_count(telegram_id):
-    """Get document count for user"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("SELECT count FROM doc_counts WHERE telegram_id = ?", (telegram_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 0
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
-def increment_doc_count(telegram_id):
-    """Increment document count for user"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    current_count = get_doc_count(telegram_id)
-    new_count = current_count + 1
-    c.execute("INSERT OR REPLACE INTO doc_counts (telegram_id, count, last_update) VALUES (?, ?, ?)", 
-              (telegram_id, new_count, time.time()))
-    conn.commit()
-    conn.close()
-    return new_count
+    async def refresh_bot_data(self, bot_data):
+        pass
 
-def reset_doc_count(telegram_id):
-    """Reset document count for user"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM doc_counts WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    conn.close()
+async def evict_idle_users(context: ContextTypes.DEFAULT_TYPE):
+    """Job: drop idle users' state from memory"""
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLiteUserPersistence):
+        evicted = persistence.evict_idle(context.application)
+        if evicted:
+            logging.info(f"Evicted {evicted} idle users from memory")
 
-def add_to_queue(telegram_id):
-    """Add user to queue"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("SELECT MAX(position) FROM queue WHERE status = 'waiting'")
-    max_pos = c.fetchone()[0]
-    position = (max_pos or 0) + 1
-    c.execute("INSERT INTO queue (telegram_id, position, status, timestamp) VALUES (?, ?, 'waiting', ?)", 
-              (telegram_id, position, time.time()))
-    conn.commit()
-    conn.close()
-    return position
+# --- OUTBOUND MESSAGES ---
+# Every message the bot sends goes through one scheduler so peaks stay under
+# Telegram's flood limits (about 1 message/s per chat, 30/s overall). Replies to
+# users go out first, queue/verification notifications next and admin forwards
+# last; a RetryAfter pauses that chat for as long as Telegram asks, then retries.
+OUTBOUND_WORKERS = 8
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))  # Messages per second, all chats together
+OUTBOUND_CHAT_RATE = 1.0  # Messages per second to one chat
+OUTBOUND_CHAT_BURST = 3  # A few replies in a row may go out at once
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_BUCKETS = 10000  # Idle per-chat buckets are dropped beyond this
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", "0"))  # Seconds; 0 = forward every document
 
-def remove_from_queue(telegram_id):
-    """Remove user from queue"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("UPDATE queue SET status = 'completed' WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    conn.close()
+PRIORITY_REPLY = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_ADMIN = 2
 
-def get_queue_position(telegram_id):
-    """Get user's position in queue"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("SELECT position FROM queue WHERE telegram_id = ? AND status = 'waiting'", (telegram_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
+class TokenBucket:
+    """Per-chat send budget refilled at a fixed rate"""
 
-def get_estimated_wait_time(position):
-    """Calculate estimated wait time"""
-    active_count = get_active_user_count()
-    remaining_ahead = max(0, position - 50)
-    estimated_minutes = remaining_ahead * 0.5  # Assuming 30 seconds per user
-    return int(estimated_minutes)
-
-def process_next_from_queue():
-    """Process next user from queue"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    c.execute("SELECT telegram_id FROM queue WHERE status = 'waiting' ORDER BY position LIMIT 1")
-    result = c.fetchone()
-    if result:
-        next_user_id = result[0]
-        c.execute("UPDATE queue SET status = 'completed' WHERE telegram_id = ?", (next_user_id,))
-        conn.commit()
-        conn.close()
-        return next_user_id
-    conn.close()
-    return None
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
 
-def cleanup_old_records():
-    """Clean up old records"""
-    conn = sqlite3.connect('queue.db')
-    c = conn.cursor()
-    
-    # Clean up old active users (older than 1 hour)
-    cutoff_time = time.time() - 3600
-    c.execute("DELETE FROM active_users WHERE start_time < ?", (cutoff_time,))
-    
-    # Clean up old doc counts (older than 30 minutes)
-    cutoff_time = time.time() - 1800
-    c.execute("DELETE FROM doc_counts WHERE last_update < ?", (cutoff_time,))
-    
-    conn.commit()
-    conn.close()
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-def queue_monitor():
-    """Monitor queue and process next users"""
-    while True:
+    def delay(self):
+        """Seconds until the next message may go out"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Hand out nothing for the next `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+class OutboundScheduler:
+    """Priority queue of Telegram calls paced per chat and globally.
+
+    Each chat keeps its own heap of pending calls ordered by (priority, arrival)
+    and has at most one call in flight, so a chat's messages arrive in order and a
+    reply never waits behind that chat's lower-priority backlog. A chat is put on
+    the shared ready queue only when its bucket allows another message."""
+
+    def __init__(self, workers, global_rate, chat_rate, chat_burst):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = RatePacer(global_rate * 60, burst=max(1, int(global_rate)))
+        self._chats = {}  # chat_id -> TokenBucket
+        self._pending = {}  # chat_id -> heap of (priority, seq, call, attempts, future)
+        self._seq = itertools.count()
+        self._queue = None  # Ready chats as (priority, seq, chat_id)
+        self._tasks = []
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        for pending in self._pending.values():
+            for job in pending:
+                job[-1].cancel()
+        self._pending = {}
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUTBOUND_MAX_BUCKETS:
+                self._chats = {c: b for c, b in self._chats.items() if c in self._pending or not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id):
+        """Make the chat ready once its bucket allows another message"""
+        delay = self._bucket(chat_id).delay()
+        if delay > 0:
+            # Parked off the queue so one busy chat never holds up the others
+            asyncio.get_running_loop().call_later(delay, self._ready, chat_id)
+        else:
+            self._ready(chat_id)
+
+    def _ready(self, chat_id):
+        pending = self._pending.get(chat_id)
+        if self._queue is not None and pending:
+            self._queue.put_nowait((pending[0][0], pending[0][1], chat_id))
+
+    def submit(self, priority, chat_id, func, /, *args, **kwargs):
+        """Queue a Telegram call; returns a future with its result"""
+        if self._queue is None:  # Not started (or already stopped): send right away
+            return asyncio.ensure_future(func(*args, **kwargs))
+        future = asyncio.get_running_loop().create_future()
+        job = (priority, next(self._seq), functools.partial(func, *args, **kwargs), 0, future)
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            self._pending[chat_id] = [job]
+            self._schedule(chat_id)
+        else:
+            heapq.heappush(pending, job)  # The chat is already parked, queued or sending
+        return future
+
+    async def send(self, priority, chat_id, func, /, *args, **kwargs):
+        return await self.submit(priority, chat_id, func, *args, **kwargs)
+
+    def post(self, priority, chat_id, func, /, *args, **kwargs):
+        """Fire and forget; failures are only logged"""
+        self.submit(priority, chat_id, func, *args, **kwargs).add_done_callback(_log_outbound_failure)
+
+    async def _worker(self):
+        while True:
+            _, _, chat_id = await self._queue.get()
+            pending = self._pending.get(chat_id)
+            if not pending:
+                continue
+            priority, seq, call, attempts, future = heapq.heappop(pending)
+            try:
+                if not future.done():
+                    await self._send(chat_id, priority, seq, call, attempts, future)
+            finally:
+                if pending:
+                    self._schedule(chat_id)
+                elif self._pending.get(chat_id) is pending:
+                    del self._pending[chat_id]
+
+    async def _send(self, chat_id, priority, seq, call, attempts, future):
+        await self._global.acquire()
+        bucket = self._bucket(chat_id)
+        bucket.take()
         try:
-            cleanup_old_records()
-            
-            # Check if we have space for more users
-            active_count = get_active_user_count()
-            if active_count < 50:
-                next_user_id = process_next_from_queue()
-                if next_user_id:
-                    # In a real implementation, you would send a message to the user (this would require storing user references)
-                    # For now, just return the user ID
-                    pass
-            
-            time.sleep(30)  # Check every 30 seconds
+            with TELEGRAM_SECONDS.time(op=getattr(call.func, '__name__', 'call')):
+                result = await call()
+        except RetryAfter as e:
+            if attempts >= OUTBOUND_MAX_RETRIES:
+                future.set_exception(e)
+                return
+            logging.warning(f"Flood limit for chat {chat_id}, retrying in {e.retry_after}s")
+            bucket.block(e.retry_after)
+            heapq.heappush(self._pending[chat_id], (priority, seq, call, attempts + 1, future))
         except Exception as e:
-            logging.error(f"Queue monitor error: {e}")
-            time.sleep(60)
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
 
-# Initialize queue system
-init_queue_db()
-queue_thread = threading.Thread(target=queue_monitor, daemon=True)
-queue_thread.start()
+def _log_outbound_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Outbound message failed: {future.exception()}")
 
-# --- API HELPERS (UPDATED) ---
-def get_creds():
-    with open('user_token.json', 'r') as f:
-        token_data = json.load(f)
-    creds = Credentials.from_authorized_user_info(token_data)
-    return creds
+# Telegram's overall limit is per bot, so workers split it (a chat always belongs to one worker)
+outbound = OutboundScheduler(OUTBOUND_WORKERS, OUTBOUND_GLOBAL_RATE / BOT_WORKERS, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+OUTBOUND_QUEUE = Gauge('formcare_outbound_queue', 'Telegram calls ready and waiting for a worker', 
+                       lambda: outbound._queue.qsize() if outbound._queue is not None else 0)
 
-def get_sheet():
-    creds = get_creds()
-    client = gspread.authorize(creds)
-    # ✅ NEW: Change this to your new sheet name
-    return client.open("FormCare_Data").sheet1  # Replace with your new sheet name
+async def reply(update: Update, text, **kwargs):
+    """Reply to the user's message through the outbound scheduler"""
+    return await outbound.send(PRIORITY_REPLY, update.effective_chat.id, update.message.reply_text, text, **kwargs)
 
-def create_drive_folder(name):
-    creds = get_creds()
-    service = build('drive', 'v3', credentials=creds)
-    meta = {
-        'name': name,
-        'mimeType': 'application/vnd.google-apps.folder',
-        'parents': [PARENT_FOLDER_ID]
-    }
-    file = service.files().create(
-        body=meta,
-        fields='id, webViewLink',
-        supportsAllDrives=True
-    ).execute()
-    return file.get('id'), file.get('webViewLink')
+async def notify(bot, chat_id, text, **kwargs):
+    """Send an unprompted message (queue, verification) to a user"""
+    return await outbound.send(PRIORITY_NOTIFY, chat_id, bot.send_message, chat_id=chat_id, text=text, **kwargs)
 
-async def upload_to_drive(content, filename, folder_id):
-    creds = get_creds()
-    service = build('drive', 'v3', credentials=creds)
-    
-    meta = {'name': filename, 'parents': [folder_id]}
-    
-    media = MediaIoBaseUpload(io.BytesIO(content), mimetype='application/octet-stream', resumable=True)
-    
-    service.files().create(
-        body=meta,
-        media_body=media,
-        fields='id',
-        supportsAllDrives=True
-    ).execute()
+# Digest mode: instead of forwarding every document, the admin gets one summary
+# per ADMIN_DIGEST_INTERVAL listing who sent how many documents (with folder links).
+_admin_digest = {}  # phone -> {'name', 'phone', 'link', 'count'}
+
+def add_to_admin_digest(user_data, count):
+    phone = user_data.get('phone', '')
+    entry = _admin_digest.setdefault(phone, {'name': user_data.get('student_name', ''), 'phone': phone,
+                                             'link': user_data.get('f_link', ''), 'count': 0})
+    entry['count'] += count
+
+async def send_admin_digest(context: ContextTypes.DEFAULT_TYPE):
+    """Post the collected document summary to the admin"""
+    global _admin_digest
+    if not _admin_digest:
+        return
+    entries, _admin_digest = _admin_digest, {}
+    lines = [f"📎 {e['name']} ({e['phone']}) - {e['count']} documents\n{e['link']}" for e in entries.values()]
+    total = sum(e['count'] for e in entries.values())
+    chunk = f"📥 <b>{len(entries)} students, {total} documents</b>"
+    for line in lines:
+        if len(chunk) + len(line) + 2 > 4000:  # Telegram's limit is 4096 characters
+            outbound.post(PRIORITY_ADMIN, ADMIN_ID, context.bot.send_message, chat_id=ADMIN_ID, text=chunk, parse_mode="HTML")
+            chunk = ""
+        chunk += f"\n\n{line}"
+    outbound.post(PRIORITY_ADMIN, ADMIN_ID, context.bot.send_message, chat_id=ADMIN_ID, text=chunk, parse_mode="HTML")
+
+# --- UPDATE PROCESSING ---
+# Updates are handled concurrently (up to MAX_CONCURRENT_UPDATES), but each user's
+# updates still run one after another so the registration state machine in
+# handle_message/handle_contact/handle_docs never races with itself. A user's
+# updates wait in their own queue *before* taking a concurrent-update slot, so a
+# user stuck on a slow Drive call holds one slot and never blocks anybody else.
+_user_queues = {}  # user_id -> updates (or coroutine functions) waiting behind the running one
+
+def _update_user_id(update):
+    user = getattr(update, 'effective_user', None)
+    return user.id if user else None
+
+PTB_VERSION = "20.0"  # The python-telegram-bot release OrderedApplication was written against
+
+class OrderedApplication(Application):
+    """Application that keeps each user's updates in order under concurrent processing.
+
+    Replaces PTB 20.0's private Application._update_fetcher (pinned in requirements.txt),
+    which would take a slot for every update before our per-user ordering. Later releases
+    change those internals, so any other version is refused when the Application is built."""
+
+    def __init__(self, *args, **kwargs):
+        if telegram.__version__ != PTB_VERSION:
+            raise RuntimeError(f"OrderedApplication needs python-telegram-bot {PTB_VERSION}, "
+                               f"{telegram.__version__} is installed")
+        super().__init__(*args, **kwargs)
+
+    async def _update_fetcher(self):
+        while True:
+            update = await self.update_queue.get()
+            if update is _ptb_application._STOP_SIGNAL:
+                while not self.update_queue.empty():  # Dropping pending updates, as PTB does
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                return
+            user_id = _update_user_id(update)
+            if user_id is None:
+                self.create_task(self._process_in_slot(update), update=update)
+            else:
+                self.run_for_user(user_id, update)
+
+    def run_for_user(self, user_id, item):
+        """Queue an update, or a coroutine function, behind the user's earlier ones"""
+        queue = _user_queues.get(user_id)
+        if queue is not None:
+            queue.append(item)
+            return
+        _user_queues[user_id] = collections.deque([item])
+        self.create_task(self._drain_user(user_id), update=None if callable(item) else item)
+
+    async def _drain_user(self, user_id):
+        """One consumer per user with queued work: takes a slot for one item at a time"""
+        queue = _user_queues[user_id]
+        try:
+            while queue:
+                item = queue.popleft()
+                try:
+                    if callable(item):
+                        async with self._concurrent_updates_sem:
+                            await item()
+                        # Ran outside process_update, so PTB won't save the user_data it changed
+                        self._user_ids_to_be_updated_in_persistence.add(user_id)
+                    else:
+                        await self._process_in_slot(item)
+                except Exception as e:
+                    logging.error(f"Processing for user {user_id} failed: {e}")
+        finally:
+            _user_queues.pop(user_id, None)
+
+    async def _process_in_slot(self, update):
+        try:
+            async with self._concurrent_updates_sem:
+                trace_id.set(f"u{getattr(update, 'update_id', '-')}")
+                await self.process_update(update)
+        finally:
+            self.update_queue.task_done()
+
+# --- APP LIFECYCLE ---
+# Importing bot.py doesn't touch queue.db, Google or Telegram. create_app() sets up
+# queue.db and the Application, whose post_init (on_startup) starts the background
+# workers and runs the readiness check before polling or the webhook take updates.
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "10"))  # Seconds from import until ready
+WARMUP_TIMEOUT = 30
+
+_background_tasks = []
+_metrics_server = None
+STARTUP_SECONDS = Gauge('formcare_startup_seconds', 'Seconds from import until the bot was ready to take updates')
+READY = Gauge('formcare_ready', '1 once credentials and Google connections are warm')
+
+async def warm_up():
+    """Readiness check: load and refresh the credentials, open the worksheet and
+    build a Drive service, so the first students don't pay for it. Returns the
+    APIs that could not be reached (the bot still starts; the outbox covers them)."""
+    failed = []
+    for api, check in (('sheets', get_sheet), ('drive', get_drive_service)):
+        try:
+            await run_google(api, check, timeout=WARMUP_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"Warm-up of {api} failed: {e}")
+            failed.append(api)
+    return failed
+
+async def on_startup(application):
+    """Start background workers once the bot is initialised"""
+    global _metrics_server
+    _metrics_server = await start_metrics_server()
+    outbound.start()
+    await run_db(import_folder_registry)
+    start_sheet_writer()
+    await start_admission_scheduler(application)
+    if ADMIN_DIGEST_INTERVAL > 0:
+        application.job_queue.run_repeating(send_admin_digest, interval=ADMIN_DIGEST_INTERVAL, name='admin_digest')
+    application.job_queue.run_repeating(evict_idle_users, interval=STATE_EVICT_INTERVAL, name='evict_idle_users')
+    application.job_queue.run_repeating(leader_only(maintain_folder_pool), interval=FOLDER_POOL_INTERVAL, first=5, name='folder_pool')
+    _background_tasks.append(asyncio.create_task(sheet_mirror_sync()))
+    _background_tasks.append(asyncio.create_task(outbox_replayer(application)))
+    _background_tasks.append(asyncio.create_task(status_feed_watcher(application)))
+    failed = await warm_up()
+    READY.set(0 if failed else 1)
+    elapsed = time.time() - _started_at
+    STARTUP_SECONDS.set(elapsed)
+    if elapsed > STARTUP_BUDGET:
+        logging.warning(f"Startup took {elapsed:.1f}s, over the {STARTUP_BUDGET:.0f}s budget")
+    else:
+        logging.info(f"Ready in {elapsed:.1f}s")
+
+async def on_shutdown(application):
+    """Release shared clients and worker threads when the bot shuts down"""
+    for task in _background_tasks:
+        task.cancel()
+    await stop_sheet_writer()
+    if SHARED_STATE and _leader:
+        await run_db(release_lease, LEADER_LEASE, WORKER_ID)  # Let another worker take over right away
+    await outbound.stop()
+    if _metrics_server is not None:
+        _metrics_server.close()
+    if _download_client is not None:
+        await _download_client.aclose()
+    _google_executor.shutdown(wait=False, cancel_futures=True)
 
 # ---------- SESSION TIMEOUT CHECK ----------
 def check_timeout(context):
@@ -241,18 +2678,136 @@ def check_timeout(context):
     return False
 
 # ---------- Keyboards ----------
+RESTART_BUTTON = "🔄 फिर से शुरू करें"
+RESTART_KB = ReplyKeyboardMarkup([[RESTART_BUTTON]], resize_keyboard=True)
+RESUME_KB = ReplyKeyboardMarkup([["हां", "नहीं"]], resize_keyboard=True)
+CONTACT_KB = ReplyKeyboardMarkup([[KeyboardButton("📱 अपना मोबाइल नंबर साझा करें", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
+
 def restart_kb():
-    return ReplyKeyboardMarkup([["🔄 फिर से शुरू करें"]], resize_keyboard=True)
+    return RESTART_KB
+
+# ---------- Menu ----------
+# The PPU -> college -> course -> session -> semester -> form flow as a tree.
+# compile_menu() turns it into a dict keyed by (menu state, button text) with
+# every keyboard built once, so routing a button press is a single lookup.
+# Buttons marked "Coming Soon"/🔒/Completed/✍️/📝 are locked and "(Upcoming)"
+# ones announce the form; "🟢 LIVE" forms ask for the mobile number.
+LOCKED_MARKERS = ("Coming Soon", "🔒", "Completed", "✍️", "📝")
+NOT_AVAILABLE_TEXT = "⏳ यह विकल्प अभी उपलब्ध नहीं है।\nयह सुविधा भविष्य में सक्रिय की जाएगी। 🔜"
+UPCOMING_TEXT = "📢 <b>Coming Soon!</b>\nयह फॉर्म जल्द ही शुरू होने वाला है। कृपया अपडेट के लिए जुड़े रहें। 🔜"
+
+def menu(text, *buttons):
+    return {'text': text, 'buttons': list(buttons)}
+
+def button(label, next_menu=None, **values):
+    return {'label': label, 'next': next_menu, 'set': values}
+
+def _intermediate_menu():
+    forms = menu("कृपया <b>form type</b> चुनें। 👇",
+                 button("Admission Form (प्रवेश प्रपत्र) 📝"),
+                 button("Examination Form (परीक्षा प्रपत्र) ✍️"))
+    classes = menu("कृपया <b>class</b> चुनें। 👇",
+                   *[button(label, forms, **{'class': label}) for label in ["11वीं 📚", "12वीं 📚"]])
+    sessions = menu("कृपया <b>session</b> चुनें। 👇",
+                    *[button(label, classes, session=label) for label in ["2025–27 📅", "2026–28 📅"]])
+    return menu("कृपया अपनी <b>stream (संकाय)</b> चुनें। 👇",
+                *[button(label, sessions, stream=label) for label in ["Science (विज्ञान) 🧪", "Arts (कला) 🎨", "Commerce (वाणिज्य) 📊"]])
+
+UG_SEMESTERS = {
+    "2023–27": ["Sem 1-5 ✅ Completed", "Semester 6 (Upcoming) 🔜", "Sem 7-8 (Coming Soon) 🔒"],
+    "2024–28": ["Sem 1-3 ✅ Completed", "Semester 4 (Upcoming) 🔜", "Sem 5-8 (Coming Soon) 🔒"],
+    "2025–29": ["Semester 1 ✅ Completed", "Semester 2 🟢 LIVE", "Sem 3-8 (Coming Soon) 🔒"],
+    "2026–30": ["सभी सेमेस्टर (Coming Soon) 🔒"],
+}
+
+UG_FORMS = {
+    "Semester 2 🟢 LIVE": button("Semester 2 🟢 LIVE", menu(
+        "कृपया <b>Form Type</b> चुनें। 👇",
+        button("Admission Form (प्रवेश प्रपत्र) 🟢 LIVE", final_selection="Semester 2 Admission Form"),
+        button("Examination Form (परीक्षा प्रपत्र) (Upcoming) 🔜")), semester_context="Semester 2"),
+}
+
+def _ug_menu():
+    sessions = []
+    for session, semesters in UG_SEMESTERS.items():
+        sem_menu = menu(f"🎓 <b>UG Session {session}</b>\n\nकृपया अपना semester चुनें। 👇",
+                        *[UG_FORMS.get(label) or button(label) for label in semesters])
+        sessions.append(button(session, sem_menu, session=session))
+    return menu("कृपया <b>session</b> चुनें। 👇", *sessions)
+
+MENU_TREE = menu(
+    "👋 <b>Welcome to FormCare Official Bot!</b>\n\nहम आपकी form filling प्रक्रिया को आसान और सुरक्षित बनाते हैं। ✨\n\nकृपया विश्वविद्यालय चुनें। 👇",
+    button("PPU 🏛️", menu(
+        "आपने PPU विश्वविद्यालय चुना है। ✅\n\nकृपया कॉलेज चुनें। 👇",
+        button("MD College Naubatpur 🏫", menu(
+            "MD College Naubatpur चुना गया। 📍\n\nकृपया अपना course चुनें। 👇",
+            button("Intermediate (इंटरमीडिएट) 🎒", _intermediate_menu(), course="Intermediate"),
+            button("UG (स्नातक) 🎓", _ug_menu(), course="UG")), college="MD College Naubatpur"),
+        button("अन्य कॉलेज (Coming Soon) 🏢")), univ="PPU"),
+    button("अन्य विश्वविद्यालय (Coming Soon) 🎓"),
+)
+
+def _button_action(btn):
+    label = btn['label']
+    if btn['next'] is not None:
+        return 'menu'
+    if "Upcoming" in label:
+        return 'upcoming'
+    if any(marker in label for marker in LOCKED_MARKERS):
+        return 'locked'
+    if "🟢 LIVE" in label:
+        btn['set'].setdefault('final_selection', label)
+        return 'request_mobile'
+    raise ValueError(f"Menu button {label!r} leads nowhere")
+
+def compile_menu(root):
+    """Build the (state, button text) routing table and prebuilt keyboards"""
+    routes = {}  # (state, text) -> route
+    by_text = {}  # text -> route, for buttons pressed on an older keyboard
+    states = {}  # id(menu) -> state name
+    pending = [(root, 'root')]
+    while pending:
+        node, state = pending.pop()
+        if id(node) in states:
+            continue  # Shared sub-menu (e.g. the same sessions for every stream)
+        states[id(node)] = state
+        node['state'] = state
+        node['keyboard'] = ReplyKeyboardMarkup([[b['label']] for b in node['buttons']] + [[RESTART_BUTTON]], resize_keyboard=True)
+        for b in node['buttons']:
+            route = {'action': _button_action(b), 'set': b['set'], 'next': b['next']}
+            routes[(state, b['label'])] = route
+            by_text.setdefault(b['label'], route)
+            if b['next'] is not None:
+                pending.append((b['next'], f"{state}/{b['label']}"))
+    return routes, by_text
+
+MENU_ROUTES, MENU_BUTTONS = compile_menu(MENU_TREE)
+
+async def run_menu_route(update: Update, context: ContextTypes.DEFAULT_TYPE, route):
+    """Apply a compiled menu route: store the selection and send the prebuilt reply"""
+    context.user_data.update(route['set'])
+    action = route['action']
+    if action == 'menu':
+        node = route['next']
+        context.user_data['menu_state'] = node['state']
+        await reply(update, node['text'], reply_markup=node['keyboard'], parse_mode="HTML")
+    elif action == 'request_mobile':
+        await request_mobile(update)
+    elif action == 'upcoming':
+        await reply(update, UPCOMING_TEXT, reply_markup=RESTART_KB, parse_mode="HTML")
+    else:
+        await reply(update, NOT_AVAILABLE_TEXT, reply_markup=RESTART_KB, parse_mode="HTML")
 
 # ---------- Handlers ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    # Check if too many active users
-    active_count = get_active_user_count()
-    if active_count >= 50:
+    # Check if too many active users (users admitted from the queue already hold a slot)
+    already_active = await run_db(is_active_user, user_id)
+    active_count = await run_db(get_active_user_count)
+    if not already_active and active_count >= admission_control.limit:
         # Add to queue
-        position = add_to_queue(user_id)
+        position = await enqueue_user(user_id)
         wait_time = get_estimated_wait_time(position)
         
         queue_msg = (
@@ -261,43 +2816,37 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"⏰ आपकी बारी आने में: {wait_time} मिनट\n"
             "🔄 आपको अपडेट भेजे जाएंगे।"
         )
-        await update.message.reply_text(queue_msg, reply_markup=restart_kb())
+        await reply(update, queue_msg, reply_markup=restart_kb())
         return
 
     # Otherwise, add to active users and proceed normally
-    add_to_active_users(user_id)
+    await admit_user(user_id)
     
     # Check if user was in middle of process
     if context.user_data.get('waiting_docs'):
-        await update.message.reply_text(
+        await reply(update,
             "आप पहले से डॉक्यूमेंट भेज रहे हैं। क्या आप फिर से शुरू करना चाहते हैं?\nयदि हां, तो 'हां' लिखें।",
-            reply_markup=ReplyKeyboardMarkup([["हां", "नहीं"]], resize_keyboard=True)
+            reply_markup=RESUME_KB
         )
         return
 
     # Otherwise, clear data and start fresh
     context.user_data.clear()
     context.user_data['last_active'] = time.time()
-    kb = [["PPU 🏛️"], ["अन्य विश्वविद्यालय (Coming Soon) 🎓"], ["🔄 फिर से शुरू करें"]]
-    await update.message.reply_text(
-        "👋 <b>Welcome to FormCare Official Bot!</b>\n\nहम आपकी form filling प्रक्रिया को आसान और सुरक्षित बनाते हैं। ✨\n\nकृपया विश्वविद्यालय चुनें। 👇",
-        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True),
-        parse_mode="HTML"
-    )
+    context.user_data['menu_state'] = MENU_TREE['state']
+    await reply(update, MENU_TREE['text'], reply_markup=MENU_TREE['keyboard'], parse_mode="HTML")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if check_timeout(context):
-        kb = [["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text(
+        await reply(update,
             "⏳ 24 घंटे बीत गए हैं। फिर से शुरू करने के लिए नीचे दिए गए बटन पर क्लिक करें।",
-            reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+            reply_markup=RESTART_KB
         )
         return
 
     text = update.message.text
-    if text == "🔄 फिर से शुरू करें":
-        # Remove from active users if previously active
-        remove_from_active_users(update.effective_user.id)
+    if text == RESTART_BUTTON:
+        # start() keeps (and refreshes) the user's slot if they already have one
         await start(update, context)
         return
 
@@ -308,7 +2857,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     elif text.lower() == "नहीं":
         if context.user_data.get('waiting_docs'):
-            await update.message.reply_text("ठीक है। कृपया अपने दस्तावेज़ भेजें।")
+            await reply(update, "ठीक है। कृपया अपने दस्तावेज़ भेजें।")
         return
 
     # Check if waiting for student name
@@ -322,28 +2871,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         name = context.user_data.get('name')  # This is the Telegram user's name (not needed here)
         
         try:
-            # Google Drive Folder बनाना (फ़ोन + नाम के साथ)
-            f_id, f_link = create_drive_folder(f"{phone}_{student_name}")
-            context.user_data['f_id'] = f_id
+            # Google Drive Folder (फ़ोन + नाम के साथ): the student's existing one or a spare one,
+            # otherwise it is created when the first document arrives
+            for key in ('f_id', 'f_link', 'folder_queued'):
+                context.user_data.pop(key, None)
+            await attach_student_folder(context)
             
             # Save user's chat_id
             context.user_data['chat_id'] = update.effective_chat.id  # ✅ यूजर का chat_id सेव करें
-            # Save phone and chat_id mapping in a JSON file
-            save_user_mapping(phone, update.effective_chat.id)  # ✅ नया फ़ंक्शन
-            
-            # Google Sheet में Data डालना (सही क्रम में)
-            sheet = get_sheet()
-            sheet.append_row([
-                student_name,  # ✅ यहाँ यूजर द्वारा टाइप किया गया नाम जाएगा
-                phone, 
-                context.user_data.get('univ'), 
-                context.user_data.get('college'), 
-                context.user_data.get('course'), 
-                context.user_data.get('session'), 
-                context.user_data.get('semester_context', ''),  # ✅ Semester
-                f_link,  # ✅ Folder Link
-                "Pending ⏳"  # ✅ Status
-            ])
+            # Save phone and chat_id mapping in queue.db
+            await run_db(save_user_mapping, phone, update.effective_chat.id)  # ✅ नया फ़ंक्शन
             
             # --- NEW UPDATED MESSAGE LOGIC ---
             if context.user_data.get('session') == "2025–29" and "Semester 2" in context.user_data.get('final_selection', ''):
@@ -358,120 +2895,72 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 msg = f"✅ वेरिफिकेशन सफल! <b>{phone}</b>\n\nकृपया अपने दस्तावेज़ (Documents) भेजना शुरू करें। 📁"
 
-            await update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove(), parse_mode="HTML")
+            await reply(update, msg, reply_markup=ReplyKeyboardRemove(), parse_mode="HTML")
             context.user_data['waiting_docs'] = True
             context.user_data['doc_count'] = 0
             context.user_data['last_active'] = time.time()
         except Exception as e:
             logging.error(f"❌ CRITICAL ERROR in Contact Handler: {e}")
             print(f"❌ DETAILED ERROR: {e}") 
-            await update.message.reply_text("⚠️ सिस्टम एरर! कृपया एडमिन से संपर्क करें।")
-        return
-
-    # --- GLOBAL COMING SOON CHECK ---
-    if any(x in text for x in ["Coming Soon", "🔒", "Completed", "✍️", "📝"]) and "Upcoming" not in text:
-        await update.message.reply_text(
-            "⏳ यह विकल्प अभी उपलब्ध नहीं है।\nयह सुविधा भविष्य में सक्रिय की जाएगी। 🔜", 
-            reply_markup=restart_kb(),
-            parse_mode="HTML"
-        )
-        return
-    
-    if "Upcoming" in text:
-        await update.message.reply_text(
-            "📢 <b>Coming Soon!</b>\nयह फॉर्म जल्द ही शुरू होने वाला है। कृपया अपडेट के लिए जुड़े रहें। 🔜",
-            reply_markup=restart_kb(),
-            parse_mode="HTML"
-        )
-        return
-
-    # 1. PPU & College
-    if text == "PPU 🏛️":
-        context.user_data['univ'] = "PPU"
-        kb = [["MD College Naubatpur 🏫"], ["अन्य कॉलेज (Coming Soon) 🏢"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("आपने PPU विश्वविद्यालय चुना है। ✅\n\nकृपया कॉलेज चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
-        return
-
-    if text == "MD College Naubatpur 🏫":
-        context.user_data['college'] = "MD College Naubatpur"
-        kb = [["Intermediate (इंटरमीडिएट) 🎒"], ["UG (स्नातक) 🎓"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("MD College Naubatpur चुना गया। 📍\n\nकृपया अपना course चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
-        return
-
-    # 2. INTERMEDIATE FLOW
-    if text == "Intermediate (इंटरमीडिएट) 🎒":
-        context.user_data['course'] = "Intermediate"
-        kb = [["Science (विज्ञान) 🧪"], ["Arts (कला) 🎨"], ["Commerce (वाणिज्य) 📊"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("कृपया अपनी <b>stream (संकाय)</b> चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
-        return
-
-    if text in ["Science (विज्ञान) 🧪", "Arts (कला) 🎨", "Commerce (वाणिज्य) 📊"]:
-        context.user_data['stream'] = text
-        kb = [["2025–27 📅"], ["2026–28 📅"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("कृपया <b>session</b> चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
+            await reply(update, "⚠️ सिस्टम एरर! कृपया एडमिन से संपर्क करें।")
         return
 
-    if text in ["2025–27 📅", "2026–28 📅"]:
-        context.user_data['session'] = text
-        kb = [["11वीं 📚"], ["12वीं 📚"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("कृपया <b>class</b> चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
+    # --- MENU (compiled routes: one dict lookup per button press) ---
+    route = MENU_ROUTES.get((context.user_data.get('menu_state'), text)) or MENU_BUTTONS.get(text)
+    if route:
+        await run_menu_route(update, context, route)
         return
 
-    if text in ["11वीं 📚", "12वीं 📚"]:
-        context.user_data['class'] = text
-        kb = [["Admission Form (प्रवेश प्रपत्र) 📝"], ["Examination Form (परीक्षा प्रपत्र) ✍️"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("कृपया <b>form type</b> चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
-        return
-
-    # 3. UG FLOW
-    if text == "UG (स्नातक) 🎓":
-        context.user_data['course'] = "UG"
-        kb = [["2023–27"], ["2024–28"], ["2025–29"], ["2026–30"], ["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text("कृपया <b>session</b> चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
-        return
-
-    if text in ["2023–27", "2024–28", "2025–29", "2026–30"]:
-        context.user_data['session'] = text
-        await ug_semesters(update, text)
-        return
-
-    if text == "Semester 2 🟢 LIVE":
-        context.user_data['semester_context'] = "Semester 2"
-        kb = [
-            ["Admission Form (प्रवेश प्रपत्र) 🟢 LIVE"], 
-            ["Examination Form (परीक्षा प्रपत्र) (Upcoming) 🔜"], 
-            ["🔄 फिर से शुरू करें"]
-        ]
-        await update.message.reply_text("कृपया <b>Form Type</b> चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
-        return
+    # Typed text that is not a button still gets the old "not available" replies
+    if "Upcoming" in text:
+        await reply(update, UPCOMING_TEXT, reply_markup=RESTART_KB, parse_mode="HTML")
+    elif any(x in text for x in LOCKED_MARKERS):
+        await reply(update, NOT_AVAILABLE_TEXT, reply_markup=RESTART_KB, parse_mode="HTML")
 
-    if text == "Admission Form (प्रवेश प्रपत्र) 🟢 LIVE":
-        context.user_data['final_selection'] = "Semester 2 Admission Form"
-        await request_mobile(update)
-        return
+def registration_row(user_data, f_link):
+    """The student's FormCare_Data row"""
+    return [
+        user_data.get('student_name'),  # ✅ यहाँ यूजर द्वारा टाइप किया गया नाम जाएगा
+        user_data.get('phone'), 
+        user_data.get('univ'), 
+        user_data.get('college'), 
+        user_data.get('course'), 
+        user_data.get('session'), 
+        user_data.get('semester_context', ''),  # ✅ Semester
+        f_link,  # ✅ Folder Link
+        PENDING_STATUS  # ✅ Status
+    ]
 
-    if "🟢 LIVE" in text and text != "Admission Form (प्रवेश प्रपत्र) 🟢 LIVE": 
-        context.user_data['final_selection'] = text
-        await request_mobile(update)
-        return
+async def attach_student_folder(context: ContextTypes.DEFAULT_TYPE, create=False):
+    """Give the student their Drive folder and queue their sheet row; False if there is no folder yet.
 
-async def ug_semesters(update: Update, session: str):
-    sems = []
-    if session == "2023–27":
-        sems = [["Sem 1-5 ✅ Completed"], ["Semester 6 (Upcoming) 🔜"], ["Sem 7-8 (Coming Soon) 🔒"]]
-    elif session == "2024–28":
-        sems = [["Sem 1-3 ✅ Completed"], ["Semester 4 (Upcoming) 🔜"], ["Sem 5-8 (Coming Soon) 🔒"]]
-    elif session == "2025–29":
-        sems = [["Semester 1 ✅ Completed"], ["Semester 2 🟢 LIVE"], ["Sem 3-8 (Coming Soon) 🔒"]]
-    else:
-        sems = [["सभी सेमेस्टर (Coming Soon) 🔒"]]
-    
-    kb = sems + [["🔄 फिर से शुरू करें"]]
-    await update.message.reply_text(f"🎓 <b>UG Session {session}</b>\n\nकृपया अपना semester चुनें। 👇", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode="HTML")
+    With create=True a failed folder creation is queued in the outbox (which also
+    queues the row once the folder exists) and False is returned."""
+    phone = context.user_data.get('phone')
+    student_name = context.user_data.get('student_name')
+    try:
+        folder = await provision_folder(phone, student_name, create=create and not context.user_data.get('folder_queued'))
+    except Exception as e:
+        logging.warning(f"Folder creation for {phone} failed, queued in the outbox: {e}")
+        name_norm = normalize_name(student_name)
+        await submit_outbox('folder', folder_job_key(phone, name_norm), 
+                            {'phone': phone, 'name_norm': name_norm, 'name': f"{phone}_{student_name}", 
+                             'row': registration_row(context.user_data, '')})
+        context.user_data['folder_queued'] = True
+        return False
+    if folder is None:
+        return False
+    f_id, f_link = folder
+    context.user_data['f_id'] = f_id
+    context.user_data['f_link'] = f_link
+    context.user_data.pop('folder_queued', None)
+    # Google Sheet में Data डालना (सही क्रम में) - saved locally, appended in the next batch.
+    # The key is phone + folder, so a student who keeps their folder keeps their row.
+    await submit_sheet_row(f"{phone}:{f_id}", registration_row(context.user_data, f_link))
+    return True
 
 async def request_mobile(update: Update):
-    btn = [[KeyboardButton("📱 अपना मोबाइल नंबर साझा करें", request_contact=True)]]
-    await update.message.reply_text("🔒 <b>वेरिफिकेशन स्टेप</b>\n\n⚠️ <b>ध्यान दें:</b> नंबर साझा करने के लिए नीचे दिए गए बटन का उपयोग करें। 👇", reply_markup=ReplyKeyboardMarkup(btn, resize_keyboard=True, one_time_keyboard=True), parse_mode="HTML")
+    await reply(update, "🔒 <b>वेरिफिकेशन स्टेप</b>\n\n⚠️ <b>ध्यान दें:</b> नंबर साझा करने के लिए नीचे दिए गए बटन का उपयोग करें। 👇", reply_markup=CONTACT_KB, parse_mode="HTML")
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     contact = update.message.contact
@@ -482,7 +2971,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['name'] = name
     
     # Now ask for student name
-    await update.message.reply_text(
+    await reply(update,
         "📝 कृपया अपना नाम बताएं।",
         reply_markup=ReplyKeyboardRemove()
     )
@@ -490,130 +2979,689 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_docs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if check_timeout(context):
-        kb = [["🔄 फिर से शुरू करें"]]
-        await update.message.reply_text(
+        await reply(update,
             "⏳ 24 घंटे बीत गए हैं। फिर से शुरू करने के लिए नीचे दिए गए बटन पर क्लिक करें।",
-            reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+            reply_markup=RESTART_KB
         )
         return
 
     if context.user_data.get('waiting_docs'):
-        f_id = context.user_data.get('f_id')
-        if not f_id:
-            await update.message.reply_text("⚠️ सेशन एक्सपायर! /start करें।")
+        if not context.user_data.get('f_id'):
+            if not context.user_data.get('student_name'):
+                await reply(update, "⚠️ सेशन एक्सपायर! /start करें।")
+                return
+            # First document and no folder yet (the spare pool was empty at the name step). If Drive
+            # fails the folder is created from the outbox and the documents wait there for it.
+            await attach_student_folder(context, create=True)
+        if update.message.media_group_id:
+            # Part of an album: collected and processed together once the album is complete
+            collect_media_group(update, context)
             return
+        await ingest_documents(update, context, [update.message])
+
+# ---------- Document ingestion ----------
+MEDIA_GROUP_WINDOW = 1.5  # Seconds without a new item before an album is considered complete
+ADMIN_ALBUM_SIZE = 10  # Telegram's limit for one media group
+
+_media_groups = {}  # (user_id, media_group_id) -> pending album
+
+def collect_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Buffer one album item; the album is flushed after MEDIA_GROUP_WINDOW of quiet"""
+    key = (update.effective_user.id, update.message.media_group_id)
+    group = _media_groups.get(key)
+    if group is None:
+        group = _media_groups[key] = {'update': update, 'context': context, 'messages': []}
+        group['task'] = asyncio.create_task(_flush_media_group(key))
+    group['messages'].append(update.message)
+    group['deadline'] = time.monotonic() + MEDIA_GROUP_WINDOW
+
+async def _flush_media_group(key):
+    group = _media_groups[key]
+    while (delay := group['deadline'] - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+    _media_groups.pop(key, None)
+
+    async def ingest():
         try:
-            # File Handling
-            file_item = update.message.photo[-1] if update.message.photo else update.message.document
-            file = await context.bot.get_file(file_item.file_id)
-            
-            # Download file to memory
-            out_buffer = io.BytesIO()
-            await file.download_to_memory(out_buffer)
-            out_buffer.seek(0) # Reset buffer
-            
-            ext = ".jpg" if update.message.photo else ".pdf"
-            fname = f"Doc_{datetime.datetime.now().strftime('%H%M%S')}{ext}"
-            
-            # Upload content
-            await upload_to_drive(out_buffer.read(), fname, f_id)
-            
-            # Forward to Admin
-            await context.bot.forward_message(chat_id=ADMIN_ID, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            
-            # ✅ नया मैसेज (Document Counter के साथ)
-            doc_count = context.user_data.get('doc_count', 0) + 1
-            context.user_data['doc_count'] = doc_count  # Count Update
-            
-            # Increment document count for queue system
-            increment_doc_count(update.effective_user.id)
-            
-            await update.message.reply_text(
-                f"✅ {doc_count} document प्राप्त हुआ।\n\n"
-                f"अब हमारी टीम आपके documents को verify करेगी और verification के बाद आपको सूचित किया जाएगा।"
-            )
-            
-            # Check for 20-second timeout to mark as finished
-            # In a real implementation, this would be handled by the queue monitor
-            # For now, we'll just increment the counter
-            
+            await ingest_documents(group['update'], group['context'], group['messages'])
         except Exception as e:
-            logging.error(f"Error in docs: {e}")
-            print(f"❌ DOC UPLOAD ERROR: {e}")
-            await update.message.reply_text("⚠️ फाइल अपलोड में समस्या आई।")
+            logging.error(f"Album processing failed for user {key[0]}: {e}")
+    # Keep the album in order with the user's other updates
+    group['context'].application.run_for_user(key[0], ingest)
 
-# ✅ फ़ोन और chat_id को JSON में सेव करने का फ़ंक्शन
-def save_user_mapping(phone, chat_id):
-    try:
-        with open('user_mapping.json', 'r') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = {}
+async def _store_document(bot, message, folder_id, fname, student):
+    """Download one photo/document from Telegram and upload it to the student's folder.
+
+    `student` is (phone, normalised name). Returns False (without uploading) if the
+    folder already has this file. If Drive fails (or there is no folder yet because
+    its creation is waiting in the outbox) the upload is queued in the outbox."""
+    file_item = message.photo[-1] if message.photo else message.document
+    size = file_item.file_size
+    scope = folder_id or pending_folder_scope(*student)
+    if await run_db(is_uploaded_file, scope, file_item.file_unique_id):
+        DUPLICATE_DOCUMENTS.inc(match='file_id')
+        return False
+    key = f"upload:{scope}:{file_item.file_unique_id}"
+    payload = {'folder_id': folder_id, 'phone': student[0], 'name_norm': student[1], 'filename': fname, 
+               'file_id': file_item.file_id, 'file_unique_id': file_item.file_unique_id, 'size': size}
+    # Download and upload without copying the content (waits if the memory budget is used up)
+    async with upload_budget.reserve(upload_memory_cost(size)):
+        file = await bot.get_file(file_item.file_id)
+        stream, sha256 = await download_telegram_file(file, size)
+        try:
+            duplicate = await run_db(claim_uploaded_file, scope, file_item.file_unique_id, sha256)
+            if duplicate:
+                DUPLICATE_DOCUMENTS.inc(match=duplicate)
+                return False
+            try:
+                if folder_id is None:
+                    await queue_upload(key, payload, stream, delay=0)
+                    return True
+                try:
+                    await upload_to_drive(stream, fname, folder_id, size, key=key, timeout=INLINE_UPLOAD_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # The worker thread may still be reading the stream; the retry downloads
+                    # the file from Telegram again once this attempt has certainly ended
+                    await queue_upload(key, payload, delay=GOOGLE_TIMEOUTS['drive'])
+                except Exception as e:
+                    logging.warning(f"Upload of {fname} failed, queued in the outbox: {e}")
+                    await queue_upload(key, payload, stream)
+            except BaseException:
+                await run_db(release_uploaded_file, scope, file_item.file_unique_id)
+                raise
+        finally:
+            stream.close()
+    return True
+
+def send_to_admin(bot, messages, caption):
+    """Queue a forward of one message, or copies of a whole album, to the admin (lowest priority)"""
+    if len(messages) == 1:
+        outbound.post(PRIORITY_ADMIN, ADMIN_ID, bot.forward_message,
+                      chat_id=ADMIN_ID, from_chat_id=messages[0].chat_id, message_id=messages[0].message_id)
+        return
+    # Albums can't mix photos and documents, so send each kind as its own group
+    photos = [InputMediaPhoto(m.photo[-1].file_id) for m in messages if m.photo]
+    documents = [InputMediaDocument(m.document.file_id) for m in messages if not m.photo]
+    for media in (photos, documents):
+        for i in range(0, len(media), ADMIN_ALBUM_SIZE):
+            outbound.post(PRIORITY_ADMIN, ADMIN_ID, bot.send_media_group,
+                          chat_id=ADMIN_ID, media=media[i:i + ADMIN_ALBUM_SIZE], caption=caption)
+
+async def ingest_documents(update: Update, context: ContextTypes.DEFAULT_TYPE, messages):
+    """Upload one document or a whole album in parallel, then forward, count and reply once"""
+    f_id = context.user_data.get('f_id')
+    stamp = datetime.datetime.now().strftime('%H%M%S')
+    names = []
+    for i, message in enumerate(messages):
+        ext = ".jpg" if message.photo else ".pdf"
+        names.append(f"Doc_{stamp}{ext}" if len(messages) == 1 else f"Doc_{stamp}_{i + 1}{ext}")
     
-    data[phone] = chat_id
+    student = (context.user_data.get('phone'), normalize_name(context.user_data.get('student_name')))
+    results = await asyncio.gather(*[_store_document(context.bot, m, f_id, name, student) for m, name in zip(messages, names)], 
+                                   return_exceptions=True)
+    stored = [m for m, result in zip(messages, results) if result is True]
+    duplicates = sum(1 for result in results if result is False)
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.error(f"Error in docs: {result}", exc_info=result)
     
-    with open('user_mapping.json', 'w') as f:
-        json.dump(data, f)
+    if not stored:
+        if duplicates:
+            # Nothing new: no upload, no admin forward, no count bump - just let the student know
+            await reply(update, f"♻️ यह फाइल पहले ही प्राप्त हो चुकी है, दोबारा भेजने की जरूरत नहीं है।\n\n"
+                                f"✅ अब तक {context.user_data.get('doc_count', 0)} document प्राप्त हुए।")
+        else:
+            await reply(update, "⚠️ फाइल अपलोड में समस्या आई।")
+        return
+    try:
+        # Forward to Admin (queued behind user replies, or summarised in the digest)
+        if ADMIN_DIGEST_INTERVAL > 0:
+            add_to_admin_digest(context.user_data, len(stored))
+        else:
+            caption = f"📎 {context.user_data.get('student_name', '')} ({context.user_data.get('phone', '')}) - {len(stored)} documents"
+            send_to_admin(context.bot, stored, caption)
+        
+        # ✅ नया मैसेज (Document Counter के साथ)
+        doc_count = context.user_data.get('doc_count', 0) + len(stored)
+        context.user_data['doc_count'] = doc_count  # Count Update
+        
+        # Increment document count for queue system
+        await run_db(increment_doc_count, update.effective_user.id, len(stored))
+        
+        failed = len(messages) - len(stored) - duplicates
+        await reply(update,
+            f"✅ {doc_count} document प्राप्त हुआ।\n\n"
+            + (f"♻️ {duplicates} फाइल पहले ही प्राप्त हो चुकी थी, उसे दोबारा सेव नहीं किया गया।\n\n" if duplicates else "")
+            + (f"⚠️ {failed} फाइल अपलोड में समस्या आई, कृपया उन्हें फिर से भेजें।\n\n" if failed else "")
+            + f"अब हमारी टीम आपके documents को verify करेगी और verification के बाद आपको सूचित किया जाएगा।"
+        )
+    except Exception as e:
+        logging.exception(f"Error in docs: {e}")
+        await reply(update, "⚠️ फाइल अपलोड में समस्या आई।")
+
+# ---------- Verification ----------
+VERIFIED_STATUS = "Verified ✅"
+VERIFY_REPORT_MAX_LINES = 30  # Longer bulk reports are sent as a CSV file
+VERIFIED_MESSAGE = "✅ <b>Documents Verification Completed</b>\nआपके दस्तावेज़ों का सत्यापन सफलतापूर्वक पूरा हो गया है।\nकोई भी त्रुटि नहीं पाई गई है।\n\n<b>🔜 अगला स्टेप:</b> पेमेंट करें।\nपेमेंट केवल ऑफिशियल FormCare WhatsApp नंबर पर ही करें:\n📱 <b>9234992071</b>\n\n⚠️ <b>सावधान:</b> कोई भी अन्य नंबर या व्यक्ति आपसे पेमेंट नहीं लेगा।\nऐसे किसी भी व्यक्ति से सावधान रहें जो खुद को FormCare स्टाफ़ बताकर पेमेंट करने को कहे।\nहमारा एकमात्र ऑफिशियल WhatsApp: <b>9234992071</b>"
+VERIFY_BULK_USAGE = "ℹ️ उपयोग:\n/verifybulk 98xxxxxxxx नाम; 97xxxxxxxx नाम\n/verifybulk marked <status> (Pending या खाली नहीं)\nया phone,name वाली CSV फाइल भेजें।"
+VERIFY_RESULT_TEXT = {
+    'verified': "✅ Verified, मैसेज भेजा गया",
+    'no_chat': "⚠️ Verified, लेकिन chat_id नहीं मिला",
+    'not_found': "❌ स्प्रेडशीट में नहीं मिला",
+    'failed': "❌ Verified, लेकिन मैसेज नहीं गया",
+    'invalid': "❌ गलत एंट्री",
+}
+
+def row_matches(phone, student_name, name, row_phone):
+    """Whether a sheet row (name, row_phone) is the student's, matched like find_sheet_rows"""
+    return row_phone == phone and normalize_name(student_name) in normalize_name(name)
+
+async def confirm_sheet_rows(items):
+    """Check (phone, student_name, row_number) items against the live sheet with one read of
+    their name and phone cells; rows that no longer match are resolved again from a fresh mirror"""
+    rows = sorted({row for _, _, row in items if row is not None})
+    if not rows:
+        return items
+    live = dict(zip(rows, await run_google('sheets', get_sheet_names, rows)))
+    moved = [i for i, (phone, name, row) in enumerate(items) if row is not None and not row_matches(phone, name, *live[row])]
+    if not moved:
+        return items
+    logging.info(f"{len(moved)} sheet rows moved since the mirror was built, reading the sheet again")
+    await run_google('sheets', reconcile_sheet_mirror)
+    found = await run_db(find_sheet_rows, [items[i][:2] for i in moved])
+    items = list(items)
+    for i, row in zip(moved, found):
+        items[i] = (items[i][0], items[i][1], row)
+    return items
+
+async def verify_rows(context: ContextTypes.DEFAULT_TYPE, items):
+    """Mark (phone, student_name, row_number) items verified and notify the students.
+
+    The rows are confirmed in the live sheet first, all status changes go to the
+    sheet in one batch request and the notifications are sent concurrently (paced
+    by the outbound scheduler). Returns one (result, detail) per item, result
+    being a key of VERIFY_RESULT_TEXT."""
+    items = await confirm_sheet_rows(items)
+    results = [('not_found', '') if row is None else None for _, _, row in items]
+    statuses = [(row, VERIFIED_STATUS) for row in sorted({row for _, _, row in items if row is not None})]
+    if not statuses:
+        return results
+    await sheet_write_pacer.acquire()
+    try:
+        await run_google('sheets', update_sheet_statuses, statuses)
+    except Exception as e:
+        # Setting a status is idempotent: the outbox writes it later, the students are told now.
+        # Rows can move before then, so the job finds them again by phone and name.
+        logging.warning(f"Status update failed, queued in the outbox: {e}")
+        students = sorted({(phone, name) for phone, name, row in items if row is not None})
+        await submit_outbox('status', f"status:{time.time_ns()}", {'students': students, 'status': VERIFIED_STATUS})
+    await run_db(set_mirror_statuses, statuses)
+    await run_db(mark_statuses_notified, statuses)  # The status feed must not announce these again
+
+    chat_ids = await run_db(get_chat_ids_for_phones, [phone for phone, _, row in items if row is not None])
+    recipients = {}  # chat_id -> item indexes (a student listed twice is notified once)
+    for i, (phone, _, row) in enumerate(items):
+        if row is None:
+            continue
+        if phone in chat_ids:
+            recipients.setdefault(int(chat_ids[phone]), []).append(i)
+        else:
+            results[i] = ('no_chat', '')
+    sent = await asyncio.gather(*[notify(context.bot, chat_id, VERIFIED_MESSAGE, parse_mode="HTML") for chat_id in recipients], 
+                                return_exceptions=True)
+    for (chat_id, indexes), outcome in zip(recipients.items(), sent):
+        failed = isinstance(outcome, Exception)
+        for i in indexes:
+            results[i] = ('failed', str(outcome)) if failed else ('verified', '')
+        # Remove from active users since verification is complete
+        session_time = await run_db(remove_from_active_users, chat_id)
+        admission_control.record_session(session_time)
+    request_admission(context.application)
+    return results
 
 # ✅ एडमिन द्वारा वेरिफाई करने के लिए नया फ़ंक्शन (फ़ोन + नाम दोनों से ढूंढेगा)
 async def verify_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("❌ आपको यह करने की अनुमति नहीं है।")
+        await reply(update, "❌ आपको यह करने की अनुमति नहीं है।")
         return
 
     try:
         phone_number = context.args[0]
         student_name = " ".join(context.args[1:])  # नाम को अलग करें
-        sheet = get_sheet()
-        all_values = sheet.get_all_values()
-        
-        row_index = None
-        for i, row in enumerate(all_values):
-            if len(row) > 1 and row[1] == phone_number and student_name.lower() in row[0].lower():  # Name column is index 0
-                row_index = i + 1  # Google Sheets rows are 1-indexed
+        row_index = await lookup_sheet_row(phone_number, student_name)  # Indexed lookup, no full sheet read
+        (result, detail), = await verify_rows(context, [(phone_number, student_name, row_index)])
+
+        if result == 'verified':
+            await reply(update, f"✅ {phone_number} - {student_name} को वेरिफिकेशन मैसेज भेज दिया गया और स्प्रेडशीट में Verified कर दिया गया।")
+        elif result == 'no_chat':
+            await reply(update, f"❌ यूजर का chat_id नहीं मिला। कृपया यूजर को फिर से बॉट से संपर्क करने को कहें।")
+        elif result == 'not_found':
+            await reply(update, f"❌ फ़ोन नंबर {phone_number} और नाम {student_name} स्प्रेडशीट में नहीं मिला।")
+        else:
+            await reply(update, f"❌ वेरिफाई करने में त्रुटि: {detail}")
+    except Exception as e:
+        await reply(update, f"❌ वेरिफाई करने में त्रुटि: {e}")
+
+def parse_verify_entries(lines):
+    """Turn '<phone> <name>' strings or [phone, name, ...] CSV rows into pairs; incomplete ones are returned as invalid"""
+    pairs, invalid = [], []
+    for entry in lines:
+        parts = [p.strip() for p in entry if p.strip()] if isinstance(entry, list) else entry.replace(',', ' ').split(None, 1)
+        if len(parts) >= 2:
+            pairs.append((parts[0], parts[1].strip()))  # Extra CSV columns are ignored
+        elif parts:
+            invalid.append(" ".join(parts))
+    return pairs, invalid
+
+async def run_bulk_verification(update: Update, context: ContextTypes.DEFAULT_TYPE, items, invalid=()):
+    """Verify a batch and reply with a per-row report"""
+    if not items and not invalid:
+        await reply(update, "❌ वेरिफाई करने के लिए कोई एंट्री नहीं मिली।")
+        return
+    try:
+        results = await verify_rows(context, items)
+    except Exception as e:
+        await reply(update, f"❌ वेरिफाई करने में त्रुटि: {e}")
+        return
+    report = [(phone, name, result, detail) for (phone, name, _), (result, detail) in zip(items, results)]
+    report += [(entry, '', 'invalid', '') for entry in invalid]
+    ok = sum(1 for r in report if r[2] == 'verified')
+    summary = f"📋 Bulk verify: {ok}/{len(report)} verified और सूचित किए गए।"
+    if len(report) <= VERIFY_REPORT_MAX_LINES:
+        lines = [f"{VERIFY_RESULT_TEXT[result]}: {phone} {name}".rstrip() + (f" ({detail})" if detail else '') 
+                 for phone, name, result, detail in report]
+        await reply(update, "\n".join([summary, ""] + lines))
+        return
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['phone', 'name', 'result', 'detail'])
+    writer.writerows(report)
+    await outbound.send(PRIORITY_REPLY, update.effective_chat.id, update.message.reply_document, 
+                        document=out.getvalue().encode('utf-8'), filename='verify_report.csv', caption=summary)
+
+async def verify_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/verifybulk <phone> <name>; <phone> <name> ... (or one per line), or /verifybulk marked <status>"""
+    if update.effective_user.id != ADMIN_ID:
+        await reply(update, "❌ आपको यह करने की अनुमति नहीं है।")
+        return
+    body = update.message.text.split(None, 1)[1] if len(update.message.text.split(None, 1)) > 1 else ''
+    if not body.strip():
+        await reply(update, VERIFY_BULK_USAGE)
+        return
+
+    if context.args[0].lower() == 'marked':
+        marker = body.split(None, 1)[1] if len(body.split(None, 1)) > 1 else ''
+        if not is_valid_marker(marker):
+            # A blank or pending marker would match every student nobody has reviewed yet
+            await reply(update, VERIFY_BULK_USAGE)
+            return
+        try:
+            # Statuses are typed into the sheet by hand, so read the sheet fresh once
+            await run_google('sheets', reconcile_sheet_mirror)
+            rows = await run_db(find_marked_rows, marker)
+        except Exception as e:
+            await reply(update, f"❌ स्प्रेडशीट पढ़ने में त्रुटि: {e}")
+            return
+        await run_bulk_verification(update, context, [(phone, name, row) for row, phone, name in rows])
+        return
+
+    pairs, invalid = parse_verify_entries(re.split(r'[\n;]+', body))
+    rows = await lookup_sheet_rows(pairs)  # One mirror query for the whole batch
+    await run_bulk_verification(update, context, [(phone, name, row) for (phone, name), row in zip(pairs, rows)], invalid)
+
+async def verify_bulk_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Bulk verify from a CSV file (phone, name columns) sent by the admin"""
+    try:
+        file = await context.bot.get_file(update.message.document.file_id)
+        data = await file.download_as_bytearray()
+        rows = list(csv.reader(io.StringIO(bytes(data).decode('utf-8-sig'))))
+    except Exception as e:
+        await reply(update, f"❌ CSV पढ़ने में त्रुटि: {e}")
+        return
+    if rows and not any(ch.isdigit() for ch in (rows[0][0] if rows[0] else '')):
+        rows = rows[1:]  # Header row
+    pairs, invalid = parse_verify_entries(rows)
+    found = await lookup_sheet_rows(pairs)
+    await run_bulk_verification(update, context, [(phone, name, row) for (phone, name), row in zip(pairs, found)], invalid)
+
+def _latency_lines(histogram):
+    lines = []
+    for key, (_, total, count) in sorted(histogram.values.items()):
+        name = html.escape(" ".join(str(v) for _, v in key))
+        lines.append(f"  {name}: {count} calls, avg {total / count:.2f}s, p95 ≤{histogram.quantile(0.95, key)}s")
+    return lines
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats: live counters for the admin"""
+    if update.effective_user.id != ADMIN_ID:
+        await reply(update, "❌ आपको यह करने की अनुमति नहीं है।")
+        return
+    active_count = await run_db(get_active_user_count)
+    uptime = int(time.time() - _started_at)
+    uploaded = sum(UPLOAD_BYTES.values.values()) / (1024 * 1024)
+    lines = [
+        "📊 <b>FormCare Stats</b>",
+        f"⏱ Uptime: {uptime // 3600}h {uptime % 3600 // 60}m",
+        f"👥 Active: {active_count} / {admission_control.limit}, कतार में: {len(waiting_index)}",
+        f"📤 Outbound queue: {OUTBOUND_QUEUE.func()}",
+        f"📁 Uploads: {sum(UPLOADS.values.values())} files, {uploaded:.1f} MB",
+        f"📮 Outbox: {OUTBOX_PENDING.values.get((), 0)} pending, {OUTBOX_STUCK.values.get((), 0)} stuck",
+        "", "<b>Handlers</b>", *_latency_lines(HANDLER_SECONDS),
+        "", "<b>Google</b>", *_latency_lines(GOOGLE_SECONDS),
+        "", "<b>Telegram</b>", *_latency_lines(TELEGRAM_SECONDS),
+    ]
+    errors = sum(GOOGLE_ERRORS.values.values()) + sum(HANDLER_ERRORS.values.values())
+    if errors:
+        lines += ["", f"⚠️ Errors: {errors}"]
+    history = await run_db(get_capacity_history)
+    if history:
+        lines += ["", "<b>Last 7 days</b>"]
+        for day, h in history:
+            queued, wait = h.get('queued', (0, 0))
+            sessions, length = h.get('sessions', (0, 0))
+            lines.append(f"  {day}: {queued} queued (avg wait {(wait or 0) / 60:.1f}m), "
+                         f"{sessions} sessions (avg {(length or 0) / 60:.1f}m)")
+    await reply(update, "\n".join(lines), parse_mode="HTML")
+
+# --- WORKERS ---
+# BOT_WORKERS > 1: this process becomes a dispatcher. It receives updates (webhook
+# or long polling), starts BOT_WORKERS copies of the bot with WORKER_INDEX set and
+# forwards each update to worker (user id % BOT_WORKERS), so one user's updates are
+# always handled, in order, by the same worker. Workers share state through queue.db.
+# Telegram only gets its acknowledgement (the webhook's 200, or the next polling
+# offset) once the worker has queued the update, so updates still waiting in the
+# dispatcher when it stops are delivered again by Telegram after the restart, and
+# a stopping worker handles everything it queued before it exits.
+WORKER_LISTEN = '127.0.0.1'
+WORKER_RESTART_DELAY = 5
+
+FORWARD_MAX_ATTEMPTS = 60  # Seconds of retries while a worker is (re)starting before its update is dropped
+MAX_UPDATE_BYTES = 256 * 1024  # Telegram updates are a few KB; larger request bodies are refused unread
+MAX_HEADER_LINES = 100
+
+class UpdateNotAccepted(Exception):
+    """The server can't take updates right now; the sender should retry"""
+
+async def _read_http_head(reader):
+    """Read one HTTP/1.1 request line and its headers, return (method, path, headers) or None when the client closed"""
+    request = await reader.readline()
+    if not request:
+        return None
+    method, path, _ = request.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        if len(headers) >= MAX_HEADER_LINES:
+            raise ValueError("Too many request headers")
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, path, headers
+
+def _http_response(writer, status, body=b'', close=False):
+    head = f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\n" + ("Connection: close\r\n" if close else "")
+    writer.write(f"{head}\r\n".encode() + body)
+
+def _serve_updates(path, handle_update, secret=None):
+    """Connection handler for a keep-alive server that passes POSTed update JSON to handle_update.
+
+    The method, path, secret and size are checked from the headers; a request failing
+    them is answered without reading its body, and the connection is closed. An update
+    that can't be handled is logged and answered 400 (the sender must not retry it);
+    handle_update raises UpdateNotAccepted to get a 503 (retry later) instead."""
+    async def serve(reader, writer):
+        try:
+            while (head := await _read_http_head(reader)) is not None:
+                method, request_path, headers = head
+                length = headers.get('content-length', '0')
+                if method != 'POST' or request_path.split('?')[0] != path:
+                    status = "404 Not Found"
+                elif secret and not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', '').encode(), secret.encode()):
+                    status = "403 Forbidden"
+                elif not length.isdigit():
+                    status = "400 Bad Request"
+                elif int(length) > MAX_UPDATE_BYTES:
+                    status = "413 Payload Too Large"
+                else:
+                    body = await reader.readexactly(int(length))
+                    try:
+                        await handle_update(json.loads(body))
+                        status = "200 OK"
+                    except UpdateNotAccepted as e:
+                        status = "503 Service Unavailable"
+                        logging.warning(f"Update not accepted: {e}")
+                    except Exception as e:
+                        status = "400 Bad Request"
+                        logging.error(f"Dropping an update that could not be handled: {e!r}")
+                    _http_response(writer, status)
+                    await writer.drain()
+                    continue
+                _http_response(writer, status, close=True)
+                await writer.drain()
                 break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logging.debug(f"Update connection closed: {e}")
+        finally:
+            writer.close()
+    return serve
 
-        if row_index:
-            # Update status to Verified in Column I (index 8)
-            sheet.update_cell(row_index, 9, "Verified ✅")  # Column I = 9
-            
-            # Get user's chat_id from saved data
+def create_app(updater=True):
+    """Set up queue.db and build the Application with every handler (nothing starts until it runs)"""
+    init_queue_db()
+    builder = (
+        Application.builder()
+        .application_class(OrderedApplication)
+        .token(TOKEN)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .persistence(SQLiteUserPersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", timed(start)))
+    app.add_handler(CommandHandler("restart", timed(start)))
+    app.add_handler(CommandHandler("home", timed(start)))
+    app.add_handler(CommandHandler("verify", timed(verify_user)))  # ✅ नया कमांड
+    app.add_handler(CommandHandler("verifybulk", timed(verify_bulk)))
+    app.add_handler(CommandHandler("stats", timed(show_stats)))
+    app.add_handler(MessageHandler(filters.CONTACT, timed(handle_contact)))
+    app.add_handler(MessageHandler(filters.User(ADMIN_ID) & filters.Document.FileExtension("csv"), timed(verify_bulk_csv)))
+    app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, timed(handle_docs)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(handle_message)))
+    return app
+
+def _stop_event():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def run_worker(app):
+    """Worker process: handle the updates the dispatcher POSTs to WORKER_BASE_PORT + WORKER_INDEX"""
+    stop = _stop_event()
+
+    async def handle_update(data):
+        if not app.running:
+            raise UpdateNotAccepted(f"worker {WORKER_INDEX} is not running")
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    await app.initialize()
+    await on_startup(app)  # post_init only runs from run_polling/run_webhook
+    await app.start()
+    server = await asyncio.start_server(_serve_updates('/update', handle_update), WORKER_LISTEN, WORKER_BASE_PORT + WORKER_INDEX)
+    logging.info(f"Worker {WORKER_INDEX} listening on {WORKER_LISTEN}:{WORKER_BASE_PORT + WORKER_INDEX}")
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+
+def update_shard(data, workers):
+    """Worker index for a raw update: the sender's id (else the chat's) modulo the worker count"""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat') or {}
+            if 'id' in sender:
+                return sender['id'] % workers
+    return 0
+
+class Dispatcher:
+    """Starts the workers, restarts any that die and forwards updates to them in order"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = [asyncio.Queue() for _ in range(workers)]  # (update data, future set once forwarded)
+        self.processes = [None] * workers
+        self.offset = None  # Polling: the first update id not yet taken by a worker
+
+    def dispatch(self, data):
+        """Queue an update for its worker; the returned future is done once the worker took it (or it was dropped)"""
+        forwarded = asyncio.get_running_loop().create_future()
+        self.queues[update_shard(data, self.workers)].put_nowait((data, forwarded))
+        return forwarded
+
+    async def handle_update(self, data):
+        await self.dispatch(data)  # Only then does the webhook answer Telegram
+
+    def _spawn(self, index):
+        env = dict(os.environ, WORKER_INDEX=str(index))
+        self.processes[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        logging.info(f"Started worker {index} (pid {self.processes[index].pid})")
+
+    async def supervise(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        while True:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for index, process in enumerate(self.processes):
+                if process.poll() is not None:
+                    logging.error(f"Worker {index} exited with code {process.returncode}, restarting")
+                    self._spawn(index)
+
+    async def forward(self, index):
+        """Post one worker's updates in arrival order"""
+        url = f"http://{WORKER_LISTEN}:{WORKER_BASE_PORT + index}/update"
+        async with httpx.AsyncClient(timeout=10) as client:
+            while True:
+                data, forwarded = await self.queues[index].get()
+                await self.post_update(client, url, index, data)
+                forwarded.set_result(None)
+
+    async def post_update(self, client, url, index, data, retry_delay=1):
+        """Post one update, retrying connection errors and 503s while the worker is (re)starting.
+
+        Returns True once the worker took it; an update it refused, or one still not
+        delivered after FORWARD_MAX_ATTEMPTS, is logged and dropped (returns False)."""
+        for attempt in range(FORWARD_MAX_ATTEMPTS):
             try:
-                with open('user_mapping.json', 'r') as f:
-                    user_data = json.load(f)
-                user_chat_id = user_data.get(phone_number)
-            except FileNotFoundError:
-                user_chat_id = None
-
-            if user_chat_id:
-                # Send message to user
-                await context.bot.send_message(
-                    chat_id=user_chat_id,
-                    text=f"✅ <b>Documents Verification Completed</b>\nआपके दस्तावेज़ों का सत्यापन सफलतापूर्वक पूरा हो गया है।\nकोई भी त्रुटि नहीं पाई गई है।\n\n<b>🔜 अगला स्टेप:</b> पेमेंट करें।\nपेमेंट केवल ऑफिशियल FormCare WhatsApp नंबर पर ही करें:\n📱 <b>9234992071</b>\n\n⚠️ <b>सावधान:</b> कोई भी अन्य नंबर या व्यक्ति आपसे पेमेंट नहीं लेगा।\nऐसे किसी भी व्यक्ति से सावधान रहें जो खुद को FormCare स्टाफ़ बताकर पेमेंट करने को कहे।\nहमारा एकमात्र ऑफिशियल WhatsApp: <b>9234992071</b>",
-                    parse_mode="HTML"
-                )
-                await update.message.reply_text(f"✅ {phone_number} - {student_name} को वेरिफिकेशन मैसेज भेज दिया गया और स्प्रेडशीट में Verified कर दिया गया।")
-                
-                # Remove from active users since verification is complete
-                remove_from_active_users(int(user_chat_id))
+                response = await client.post(url, json=data)
+            except httpx.TransportError as e:
+                error = e
             else:
-                await update.message.reply_text(f"❌ यूजर का chat_id नहीं मिला। कृपया यूजर को फिर से बॉट से संपर्क करने को कहें।")
-        else:
-            await update.message.reply_text(f"❌ फ़ोन नंबर {phone_number} और नाम {student_name} स्प्रेडशीट में नहीं मिला।")
-    except Exception as e:
-        await update.message.reply_text(f"❌ वेरिफाई करने में त्रुटि: {e}")
+                if response.status_code != 503:
+                    if response.is_success:
+                        return True
+                    logging.error(f"Worker {index} refused update {data.get('update_id')} "
+                                  f"(HTTP {response.status_code}), dropped")
+                    return False
+                error = "HTTP 503"
+            if attempt == 0:
+                logging.warning(f"Worker {index} not reachable ({error}), retrying")
+            await asyncio.sleep(retry_delay)
+        logging.error(f"Worker {index} still not reachable after {FORWARD_MAX_ATTEMPTS} attempts, "
+                      f"dropped update {data.get('update_id')}")
+        return False
+
+    async def poll(self, bot):
+        """Long-poll Telegram and dispatch every update; self.offset moves past an update once its worker took it"""
+        await bot.delete_webhook()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=self.offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logging.error(f"get_updates failed: {e}")
+                await asyncio.sleep(5)
+                continue
+            batch = [(update.update_id, self.dispatch(update.to_dict())) for update in updates]
+            for update_id, forwarded in batch:
+                await forwarded
+                self.offset = update_id + 1
+
+    async def confirm_polled(self, bot):
+        """Tell Telegram which polled updates the workers took, so they aren't delivered again"""
+        if self.offset is None:
+            return
+        try:
+            await bot.get_updates(offset=self.offset, timeout=0, limit=1)
+        except Exception as e:
+            logging.warning(f"Confirming polled updates failed, they will be delivered again: {e}")
+
+    def stop_workers(self):
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.wait()
+
+async def run_dispatcher():
+    stop = _stop_event()
+    dispatcher = Dispatcher(BOT_WORKERS)
+    tasks = [asyncio.create_task(dispatcher.supervise())]
+    tasks += [asyncio.create_task(dispatcher.forward(index)) for index in range(BOT_WORKERS)]
+    bot = Bot(TOKEN)
+    await bot.initialize()
+    server = None
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        handler = _serve_updates(f"/{WEBHOOK_PATH}", dispatcher.handle_update, secret=WEBHOOK_SECRET)
+        server = await asyncio.start_server(handler, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              max_connections=MAX_CONCURRENT_UPDATES, allowed_updates=Update.ALL_TYPES)
+    else:
+        tasks.append(asyncio.create_task(dispatcher.poll(bot)))
+    print(f"Bot is running with {BOT_WORKERS} workers...")
+    try:
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.close()
+        for task in tasks:
+            task.cancel()
+        await dispatcher.confirm_polled(bot)
+        dispatcher.stop_workers()
+        await bot.shutdown()
 
 def main():
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("restart", start))
-    app.add_handler(CommandHandler("home", start))
-    app.add_handler(CommandHandler("verify", verify_user))  # ✅ नया कमांड
-    app.add_handler(MessageHandler(filters.CONTACT, handle_contact))
-    app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, handle_docs))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    if WORKER_INDEX is not None:
+        asyncio.run(run_worker(create_app(updater=False)))
+        return
+    if BOT_WORKERS > 1:
+        asyncio.run(run_dispatcher())
+        return
+    app = create_app()
     print("Bot is running...")
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        # Served by python-telegram-bot's built-in (tornado) webhook server
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=MAX_CONCURRENT_UPDATES,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,953 @@
+"""Unit tests for bot.py's pure logic and queue.db helpers (no Telegram or Google)
+
+    python -m pytest -q
+"""
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, migrated queue.db in a temporary directory"""
+    monkeypatch.setattr(bot, 'QUEUE_DB', str(tmp_path / 'queue.db'))
+    monkeypatch.chdir(tmp_path)
+    bot._db_conn = None
+    bot.init_queue_db()
+    yield bot
+    bot._db_conn.close()
+    bot._db_conn = None
+
+
+# ---------- queue.db migrations ----------
+def test_migrations_upgrade_a_pre_versioning_db_with_duplicates(tmp_path, monkeypatch):
+    """queue.db as the bot created it before versioning, with the duplicate rows INSERT OR REPLACE left"""
+    import sqlite3
+    path = tmp_path / 'queue.db'
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE queue (id INTEGER PRIMARY KEY, telegram_id TEXT, position INTEGER, status TEXT, timestamp REAL);
+        CREATE TABLE active_users (id INTEGER PRIMARY KEY, telegram_id TEXT, start_time REAL);
+        CREATE TABLE doc_counts (id INTEGER PRIMARY KEY, telegram_id TEXT, count INTEGER, last_update REAL);
+        INSERT INTO active_users (telegram_id, start_time) VALUES ('1', 10), ('1', 20), ('2', 30);
+        INSERT INTO doc_counts (telegram_id, count, last_update) VALUES ('1', 1, 10), ('1', 4, 20);
+        INSERT INTO queue (telegram_id, position, status, timestamp) VALUES ('5', 1, 'waiting', 10), ('5', 2, 'waiting', 20), 
+                                                                           ('6', 3, 'waiting', 30);
+    """)
+    conn.close()
+    monkeypatch.setattr(bot, 'QUEUE_DB', str(path))
+    monkeypatch.chdir(tmp_path)
+    bot._db_conn = None
+    try:
+        bot.init_queue_db()
+        bot.init_queue_db()  # Already current: nothing to do
+        assert bot.db_fetchone("PRAGMA user_version")[0] == len(bot.DB_MIGRATIONS)
+        assert bot.db_fetchall("SELECT telegram_id, start_time FROM active_users ORDER BY telegram_id") == [('1', 20), ('2', 30)]
+        assert bot.get_doc_count(1) == 4
+        assert bot.db_fetchall("SELECT telegram_id FROM queue WHERE status = 'waiting' ORDER BY position") == [('5',), ('6',)]
+        with pytest.raises(bot.sqlite3.IntegrityError):
+            bot.db_execute("INSERT INTO active_users (telegram_id, start_time) VALUES ('2', 40)")
+    finally:
+        bot._db_conn.close()
+        bot._db_conn = None
+
+
+# ---------- Phone mapping ----------
+def test_user_mapping_json_is_imported_once_and_existing_rows_win(db, monkeypatch):
+    import json
+    monkeypatch.setattr(bot, '_chat_id_cache', {})
+    monkeypatch.setattr(bot, '_phone_cache', {})
+    bot.save_user_mapping('9001', 99)
+    with open('user_mapping.json', 'w') as f:
+        json.dump({'9001': 11, '9002': '12'}, f)
+    bot.import_user_mapping_json()
+    assert bot.get_chat_ids_for_phones(['9001', '9002']) == {'9001': 99, '9002': 12}
+    assert bot.get_phone_for_chat_id(12) == '9002'
+
+    with open('user_mapping.json', 'w') as f:
+        json.dump({'9003': 13}, f)
+    bot.import_user_mapping_json()  # Already imported: the file is not read again
+    assert bot.get_chat_id_for_phone('9003') is None
+
+
+# ---------- Status change feed ----------
+def feed_rows(*statuses):
+    """Sheet rows for (name, phone, status) triples, numbered from row 2"""
+    return [(i + 2, name, phone, status) for i, (name, phone, status) in enumerate(statuses)]
+
+def test_status_feed_baseline_is_silent(db):
+    rows = feed_rows(('Asha', '9001', 'Docs missing'), ('Ravi', '9002', bot.VERIFIED_STATUS))
+    assert bot.apply_status_feed(rows, baseline=True) == []
+    assert bot.apply_status_feed(rows) == []
+
+def test_status_feed_reports_admin_edit_once(db):
+    bot.apply_status_feed(feed_rows(('Asha', '9001', bot.PENDING_STATUS)), baseline=True)
+    rows = feed_rows(('Asha', '9001', 'Docs missing'))
+    assert bot.apply_status_feed(rows) == [(2, '9001', 'Asha', 'Docs missing')]
+    assert bot.apply_status_feed(rows) == []
+
+def test_status_feed_ignores_pending_and_blank(db):
+    bot.apply_status_feed(feed_rows(('Asha', '9001', 'Docs missing')), baseline=True)
+    assert bot.apply_status_feed(feed_rows(('Asha', '9001', ''))) == []
+    assert bot.apply_status_feed(feed_rows(('Asha', '9001', bot.PENDING_STATUS))) == []
+
+def test_status_feed_deleted_row_is_not_a_change(db):
+    rows = feed_rows(('Asha', '9001', bot.PENDING_STATUS), ('Ravi', '9002', bot.VERIFIED_STATUS))
+    bot.apply_status_feed(rows, baseline=True)
+    assert bot.apply_status_feed(feed_rows(('Ravi', '9002', bot.VERIFIED_STATUS))) == []
+
+def test_status_feed_merges_duplicate_rows(db):
+    """A student with several rows is told once, however often the sheet changes afterwards"""
+    duplicate = [('Asha Devi', '9001', bot.PENDING_STATUS), ('Asha  devi', '9001', bot.PENDING_STATUS)]
+    bot.apply_status_feed(feed_rows(*duplicate), baseline=True)
+    verified = feed_rows(('Asha Devi', '9001', bot.VERIFIED_STATUS), duplicate[1])
+    changes = bot.apply_status_feed(verified)
+    assert [(phone, status) for _, phone, _, status in changes] == [('9001', bot.VERIFIED_STATUS)]
+    for other in ('Docs missing', 'Form filled', bot.PENDING_STATUS):  # Unrelated edits elsewhere in the sheet
+        changes = bot.apply_status_feed(verified + [(10, 'Ravi', '9002', other)])
+        assert all(phone != '9001' for _, phone, _, _ in changes)
+
+def test_status_feed_respects_verify_command(db):
+    bot.mirror_sheet_rows([(2, ['Asha', '9001'] + [''] * 6 + [bot.PENDING_STATUS])])
+    bot.apply_status_feed(feed_rows(('Asha', '9001', bot.PENDING_STATUS)), baseline=True)
+    bot.mark_statuses_notified([(2, bot.VERIFIED_STATUS)])
+    assert bot.apply_status_feed(feed_rows(('Asha', '9001', bot.VERIFIED_STATUS))) == []
+
+
+# ---------- /verifybulk ----------
+@pytest.mark.parametrize('marker', ['', '   ', bot.PENDING_STATUS, 'pending', ' PENDING ⏳ '])
+def test_marker_must_not_be_blank_or_pending(db, marker):
+    assert not bot.is_valid_marker(marker)
+    with pytest.raises(ValueError):
+        bot.find_marked_rows(marker)
+
+def test_find_marked_rows_matches_marker_only(db):
+    bot.mirror_sheet_rows([(2, ['Asha', '9001'] + [''] * 6 + ['']),
+                           (3, ['Ravi', '9002'] + [''] * 6 + [' ok ']),
+                           (4, ['Mina', '9003'] + [''] * 6 + [bot.PENDING_STATUS])])
+    assert bot.find_marked_rows('OK') == [(3, '9002', 'Ravi')]
+
+
+# ---------- Verification against the live sheet ----------
+class FakeSheet:
+    """Columns A (name), B (phone) and I (status) of the sheet, behind bot.py's Google helpers"""
+
+    def __init__(self, monkeypatch, *students):
+        self.rows = [['Name', 'Phone', '', '', '', '', '', '', 'Status']]
+        self.rows += [[name, phone, '', '', '', '', '', '', bot.PENDING_STATUS] for name, phone in students]
+        self.version = 1
+        for name in ('get_sheet_values', 'get_sheet_names', 'get_sheet_statuses', 'get_sheet_version', 'update_sheet_statuses'):
+            monkeypatch.setattr(bot, name, getattr(self, name))
+        monkeypatch.setattr(bot, 'sheet_write_pacer', bot.RatePacer(6000, burst=100))
+        bot._google_semaphores.clear()
+
+    def get_sheet_values(self):
+        return [list(row) for row in self.rows]
+
+    def get_sheet_names(self, rows):
+        return [tuple(self.rows[row - 1][:2]) if row <= len(self.rows) else ('', '') for row in rows]
+
+    def get_sheet_statuses(self):
+        return [(i + 1, row[0], row[1], row[8]) for i, row in enumerate(self.rows)]
+
+    def get_sheet_version(self):
+        return self.version
+
+    def update_sheet_statuses(self, statuses):
+        for row, status in statuses:
+            self.rows[row - 1][8] = status
+        self.version += 1
+
+    def sort(self):
+        self.rows[1:] = sorted(self.rows[1:])
+        self.version += 1
+
+    def status(self, name):
+        return next(row[8] for row in self.rows if row[0] == name)
+
+def test_find_sheet_rows_matches_phone_and_name(db):
+    bot.mirror_sheet_rows([(2, ['Asha  Devi', '9001']), (3, ['Ravi Kumar', '9002']), (4, ['Asha Kumari', '9001']),
+                           (5, ['Meena', 9003])])
+    pairs = [('9001', 'asha devi'), ('9001', 'KUMARI'), ('9001', 'Asha'), ('9002', 'Asha'), ('9003', 'Meena'), ('9009', 'Ravi')]
+    # The name may be part of the sheet's, in any case and spacing; the first matching row wins
+    assert bot.find_sheet_rows(pairs) == [2, 4, 2, None, 5, None]
+
+def verify_context():
+    from types import SimpleNamespace
+    return SimpleNamespace(bot=None, application=SimpleNamespace(job_queue=None))
+
+def test_verify_writes_to_the_student_row_after_the_sheet_was_sorted(db, monkeypatch):
+    import asyncio
+    sheet = FakeSheet(monkeypatch, ('Ravi', '9002'), ('Asha', '9001'))
+    bot.reconcile_sheet_mirror()
+    sheet.sort()  # Asha moves to row 2, Ravi to row 3; the mirror still has the old order
+    items = [('9001', 'Asha', bot.find_sheet_rows([('9001', 'Asha')])[0])]
+    assert items[0][2] == 3
+    results = asyncio.run(bot.verify_rows(verify_context(), items))
+    assert results == [('no_chat', '')]
+    assert sheet.status('Asha') == bot.VERIFIED_STATUS
+    assert sheet.status('Ravi') == bot.PENDING_STATUS
+
+def test_status_feed_refreshes_the_mirror(db, monkeypatch):
+    import asyncio
+    sheet = FakeSheet(monkeypatch, ('Ravi', '9002'), ('Asha', '9001'))
+    bot.reconcile_sheet_mirror()
+    sheet.sort()
+    asyncio.run(bot.check_status_feed(None))
+    assert bot.find_sheet_rows([('9001', 'Asha'), ('9002', 'Ravi')]) == [2, 3]
+
+def test_queued_status_write_finds_rows_by_student(db, monkeypatch):
+    import asyncio
+    sheet = FakeSheet(monkeypatch, ('Ravi', '9002'), ('Asha', '9001'))
+    bot.reconcile_sheet_mirror()
+
+    def sheets_down(statuses):
+        raise RuntimeError("503")
+    monkeypatch.setattr(bot, 'update_sheet_statuses', sheets_down)
+    asyncio.run(bot.verify_rows(verify_context(), [('9001', 'Asha', 3)]))
+    payload = bot.json.loads(bot.db_fetchone("SELECT payload FROM outbox WHERE kind = 'status'")[0])
+    assert payload == {'students': [['9001', 'Asha']], 'status': bot.VERIFIED_STATUS}
+    monkeypatch.setattr(bot, 'update_sheet_statuses', sheet.update_sheet_statuses)
+    sheet.sort()
+    asyncio.run(bot._replay_status(None, 'status:1', payload))
+    assert sheet.status('Asha') == bot.VERIFIED_STATUS
+    assert sheet.status('Ravi') == bot.PENDING_STATUS
+
+
+# ---------- Sheet write-behind ----------
+def test_timed_out_append_is_not_appended_twice(db, monkeypatch):
+    """Recovery waits for an abandoned append instead of re-sending rows it may still write"""
+    import asyncio
+    import threading
+    sheet, release = [], threading.Event()
+
+    def slow_append(rows):
+        release.wait(5)
+        sheet.extend(rows)
+        return len(sheet) - len(rows) + 1
+
+    monkeypatch.setattr(bot, 'append_sheet_rows', slow_append)
+    monkeypatch.setattr(bot, 'get_sheet_values', lambda: [list(row) for row in sheet])
+    monkeypatch.setitem(bot.GOOGLE_TIMEOUTS, 'sheets', 0.2)
+    monkeypatch.setattr(bot, 'sheet_write_pacer', bot.RatePacer(6000, burst=100))
+    monkeypatch.setattr(bot, '_sheet_recovery_needed', False)
+    monkeypatch.setattr(bot, '_abandoned_append', None)
+    bot.queue_sheet_row('k1', ['Asha', '9001', '', '', '', '', '', '', bot.PENDING_STATUS])
+
+    async def scenario():
+        bot._google_semaphores.clear()
+        assert await bot.flush_sheet_rows() == 0  # Times out, rows stay inflight
+        assert await bot.flush_sheet_rows() == 0  # Append still running: no recovery yet
+        release.set()
+        while not bot._abandoned_append.done():
+            await asyncio.sleep(0.01)
+        bot.sheet_write_pacer.blocked_until = 0
+        await bot.flush_sheet_rows()  # Recovery finds the late row
+        assert await bot.flush_sheet_rows() == 0
+
+    asyncio.run(scenario())
+    assert len(sheet) == 1
+    assert bot.db_fetchall("SELECT status, sheet_row FROM sheet_rows") == [('sent', 1)]
+
+
+# ---------- Admission control ----------
+def test_admission_limit_grows_when_saturated():
+    control = bot.AdmissionController(initial=50, minimum=10, maximum=300)
+    control.record_call('sheets', 0.5)
+    assert control.adjust(active_count=50, waiting_count=5) == 50 + bot.INCREASE_STEP
+
+def test_admission_limit_cut_on_errors():
+    control = bot.AdmissionController(initial=40, minimum=10, maximum=300)
+    for i in range(10):
+        control.record_call('sheets', 0.5, error=i < 2)
+    assert control.adjust(active_count=40, waiting_count=5) == int(40 * bot.DECREASE_FACTOR)
+
+def test_one_slow_call_cuts_the_limit_once():
+    """Latency is judged per window: a quiet window after a slow call changes nothing"""
+    control = bot.AdmissionController(initial=50, minimum=10, maximum=300)
+    control.record_call('drive', 12.0)
+    assert control.adjust(active_count=0, waiting_count=0) == 37
+    for _ in range(5):
+        assert control.adjust(active_count=0, waiting_count=0) == 37
+
+def test_slow_uploads_do_not_cut_the_limit():
+    control = bot.AdmissionController(initial=50, minimum=10, maximum=300)
+    for _ in range(10):
+        control.record_call('drive', 9.0, timed=False)  # Large files take long to upload
+        control.record_call('drive', 0.4)
+    assert control.adjust(active_count=50, waiting_count=5) == 50 + bot.INCREASE_STEP
+
+
+# ---------- Per-user ordering ----------
+def test_slow_user_does_not_block_others():
+    """One user's updates run in order, outside the concurrent-update slots, while other users run concurrently"""
+    import asyncio
+    from types import SimpleNamespace
+    from telegram.ext import Application, TypeHandler
+
+    async def scenario():
+        app = (Application.builder().token('1:test').application_class(bot.OrderedApplication)
+               .concurrent_updates(2).updater(None).job_queue(None).build())
+        app._initialized = True  # Skip initialize(): it would call Telegram
+        handled, blocker = [], asyncio.Event()
+
+        async def handler(update, context):
+            if update.update_id == 1:
+                await blocker.wait()
+            handled.append(update.update_id)
+
+        app.add_handler(TypeHandler(SimpleNamespace, handler))
+        await app.start()
+        updates = [(1, 'a'), (2, 'a'), (3, 'a'), (4, 'b'), (5, 'c')]
+        for update_id, user in updates:
+            await app.update_queue.put(SimpleNamespace(update_id=update_id, effective_user=SimpleNamespace(id=user)))
+        await asyncio.wait_for(_until(lambda: {4, 5} <= set(handled)), 2)
+        assert handled == [4, 5]  # User 'a' holds one slot; 'b' and 'c' share the other
+        blocker.set()
+        await asyncio.wait_for(_until(lambda: len(handled) == 5), 2)
+        assert handled[2:] == [1, 2, 3]  # ...and 'a' kept their order
+        await asyncio.wait_for(app.stop(), 2)
+
+    asyncio.run(scenario())
+
+def test_ordered_application_refuses_other_ptb_versions(monkeypatch):
+    from telegram.ext import Application
+    monkeypatch.setattr(bot.telegram, '__version__', '20.4')
+    with pytest.raises(RuntimeError, match='20.0'):
+        Application.builder().token('1:test').application_class(bot.OrderedApplication).updater(None).build()
+
+async def _until(predicate):
+    import asyncio
+    while not predicate():
+        await asyncio.sleep(0.01)
+
+def test_leader_adjusts_on_all_workers_windows(db):
+    """Errors seen by followers cut the limit even if the leader's own calls were fine"""
+    leader = bot.AdmissionController(initial=40, minimum=10, maximum=300)
+    follower = bot.AdmissionController(initial=40, minimum=10, maximum=300)
+    for _ in range(10):
+        leader.record_call('sheets', 0.5)
+        follower.record_call('sheets', 0.5, error=True)
+    follower.record_session(600)
+    bot.push_admission_window('follower', follower.take_window())
+    assert follower.calls == 0 and follower.sessions == []
+    for window in bot.pop_admission_windows(since=0):
+        leader.merge_window(window)
+    assert (leader.calls, leader.errors) == (20, 10)
+    assert leader.service_time > 30.0
+    assert leader.adjust(active_count=40, waiting_count=5) == int(40 * bot.DECREASE_FACTOR)
+    assert bot.pop_admission_windows(since=0) == []
+
+def test_stale_admission_windows_are_dropped(db):
+    bot.push_admission_window('follower', {'calls': 1, 'errors': 1, 'quota_errors': 1, 'latency': {}, 'sessions': []})
+    assert bot.pop_admission_windows(since=bot.time.time() + 1) == []
+    assert bot.db_fetchone("SELECT COUNT(*) FROM admission_windows")[0] == 0
+
+
+# ---------- Queue ----------
+def test_direct_admission_takes_user_out_of_queue(db):
+    """A waiting user who gets a free slot through /start is not admitted a second time"""
+    assert bot.add_to_queue(7) == 1
+    bot.add_to_queue(8)
+    assert bot.add_to_active_users(7) == [1]
+    assert bot.get_queue_position(7) is None
+    assert bot.admit_next_users(limit=10) == [('8', 2)]
+    assert bot.db_fetchall("SELECT telegram_id, outcome FROM queue_archive ORDER BY telegram_id") == [
+        ('7', 'admitted'), ('8', 'admitted')]
+
+def test_announced_positions_survive_a_restart(db, monkeypatch):
+    """The last position told to each waiting user lives in queue.db, not in the process"""
+    import asyncio
+    from types import SimpleNamespace
+    told = []
+
+    async def notify(bot_, chat_id, text, **kwargs):
+        told.append(chat_id)
+    monkeypatch.setattr(bot, 'notify', notify)
+    monkeypatch.setattr(bot, '_queue_lock', None)
+    context = SimpleNamespace(bot=None)
+
+    async def scenario():
+        await bot.rebuild_waiting_index()
+        for user in range(1, 9):
+            assert await bot.enqueue_user(user) == user
+        await bot.run_db(bot.admit_next_users, 6)
+        await bot.rebuild_waiting_index()  # As after a restart
+        await bot.send_position_updates(context)
+        assert told == [7, 8]
+        await bot.rebuild_waiting_index()
+        await bot.send_position_updates(context)  # Nobody moved: nothing is repeated
+        assert told == [7, 8]
+
+    asyncio.run(scenario())
+    assert bot.get_notified_positions() == [('7', 7, 1), ('8', 8, 2)]
+
+def test_waiting_index_ranks_live_positions():
+    index = bot.WaitingIndex(size=4)
+    for ticket in (3, 5, 9, 12):
+        index.add(ticket)
+    index.remove(5)
+    assert [index.rank(t) for t in (3, 9, 12)] == [1, 2, 3]
+    assert index.rank(5) is None
+    assert len(index) == 3
+
+
+# ---------- Retention ----------
+def test_waiting_tickets_are_renumbered_in_order_once_they_drift(db, monkeypatch):
+    monkeypatch.setattr(bot, 'RENUMBER_AFTER', 2)
+    for user in (1, 2, 3, 4, 5):
+        bot.add_to_queue(user)
+    bot.admit_next_users(limit=1)
+    assert not bot.renumber_waiting_positions()  # Lowest ticket is 2
+    bot.admit_next_users(limit=3)  # Limit counts all active slots
+    assert bot.renumber_waiting_positions()
+    assert [bot.get_queue_position(user) for user in (4, 5)] == [1, 2]
+    assert bot.add_to_queue(6) == 3
+
+def test_prune_history_deletes_only_expired_rows_in_batches(db, monkeypatch):
+    monkeypatch.setattr(bot, 'RETENTION_BATCH', 2)
+    now = bot.time.time()
+    old = now - 500 * 24 * 3600
+    with bot.db_transaction() as c:
+        c.executemany("INSERT INTO queue_archive (telegram_id, queued, finished, outcome) VALUES (?, ?, ?, 'admitted')", 
+                      [('1', old, old), ('2', old, old), ('3', old, old), ('4', now, now)])
+        c.executemany("""INSERT INTO outbox (kind, key, payload, status, next_attempt, created, updated) 
+                         VALUES ('status', ?, '{}', ?, 0, ?, ?)""", [('a', 'done', old, old), ('b', 'stuck', old, old)])
+        c.executemany("INSERT INTO sheet_rows (row_key, row_data, status, created, sent_time) VALUES (?, '[]', ?, ?, ?)", 
+                      [('9001:f1', 'sent', old, old), ('9002:f2', 'pending', old, None)])
+    assert bot.prune_history() == {'queue_archive': 3, 'session_archive': 0, 'outbox': 1, 'sheet_rows': 1, 'user_state': 0}
+    assert bot.db_fetchall("SELECT telegram_id FROM queue_archive") == [('4',)]
+    assert bot.db_fetchall("SELECT key FROM outbox") == [('b',)]
+    assert bot.db_fetchall("SELECT row_key, row_data FROM sheet_rows ORDER BY id") == [('9001:f1', None), ('9002:f2', '[]')]
+
+
+# ---------- Menu ----------
+def test_compile_menu_routes_every_button():
+    live = bot.menu("Form?", bot.button("Admission 🟢 LIVE"), bot.button("Exam (Upcoming) 🔜"))
+    shared = bot.menu("Session?", bot.button("2025", live, session="2025"))
+    root = bot.menu("Stream?", bot.button("Science", shared, stream="Science"), bot.button("Arts", shared, stream="Arts"),
+                    bot.button("Other (Coming Soon) 🔒"))
+    routes, by_text = bot.compile_menu(root)
+    assert routes[('root', 'Science')] == {'action': 'menu', 'set': {'stream': 'Science'}, 'next': shared}
+    assert routes[('root', 'Other (Coming Soon) 🔒')]['action'] == 'locked'
+    # A sub-menu shared by two buttons is compiled once, under the first path that reaches it
+    assert shared['state'] in ('root/Science', 'root/Arts')
+    assert len([key for key in routes if key[1] == '2025']) == 1
+    route = routes[(f"{shared['state']}/2025", 'Admission 🟢 LIVE')]
+    assert route['action'] == 'request_mobile' and route['set'] == {'final_selection': 'Admission 🟢 LIVE'}
+    assert by_text['Exam (Upcoming) 🔜']['action'] == 'upcoming'
+    assert [row[0].text for row in root['keyboard'].keyboard][-1] == bot.RESTART_BUTTON
+
+def test_compile_menu_rejects_dead_end_button():
+    with pytest.raises(ValueError):
+        bot.compile_menu(bot.menu("Pick", bot.button("Nowhere")))
+
+def test_live_menu_reaches_a_form():
+    assert any(route['action'] == 'request_mobile' for route in bot.MENU_ROUTES.values())
+
+
+# ---------- /verifybulk parsing ----------
+def test_parse_verify_entries_text_and_csv():
+    pairs, invalid = bot.parse_verify_entries(["9001 Asha Devi", "9002,Ravi", "  ", "9003",
+                                               ["9004", " Meena ", "extra"], ["9005", ""], []])
+    assert pairs == [('9001', 'Asha Devi'), ('9002', 'Ravi'), ('9004', 'Meena')]
+    assert invalid == ['9003', '9005']
+
+
+# ---------- Drive folders ----------
+def test_folder_created_by_the_losing_registration_goes_to_the_pool(db, monkeypatch):
+    import asyncio
+    created, renamed = [], {}
+
+    async def run_google(api, func, *args, **kwargs):
+        await asyncio.sleep(0)
+        if func is bot.create_drive_folder:
+            created.append(f"new-{len(created) + 1}")
+            return created[-1], f"link-{created[-1]}"
+        assert func is bot.rename_drive_folder
+        renamed[args[0]] = args[1]
+    monkeypatch.setattr(bot, 'run_google', run_google)
+
+    async def scenario():
+        return await asyncio.gather(*[bot.provision_folder('9001', 'Asha', create=True) for _ in range(2)])
+
+    first, second = asyncio.run(scenario())
+    assert first == second == ('new-1', 'link-new-1') and created == ['new-1', 'new-2']
+    assert bot.db_fetchall("SELECT folder_id FROM folder_pool") == [('new-2',)]
+    assert renamed['new-2'].startswith(bot.POOL_FOLDER_PREFIX)
+
+def test_claiming_for_a_registered_student_keeps_the_spare(db):
+    bot.add_pool_folder('spare-1', 'link-spare-1')
+    bot.register_folder('9001', 'asha', '9001_Asha', 'folder-1', 'link-1')
+    assert bot.claim_pool_folder('9001', 'asha', '9001_Asha') == ('folder-1', 'link-1')
+    assert bot.get_pool_size() == 1
+
+
+# ---------- Albums ----------
+def test_album_is_ingested_once_and_failures_are_logged_with_the_trace_id(db, monkeypatch, caplog, capsys):
+    import asyncio
+    from types import SimpleNamespace
+
+    async def store(bot_, message, folder_id, fname, student):
+        if message.outcome == 'fail':
+            raise RuntimeError('Drive down')
+        return message.outcome == 'ok'
+    replies, forwarded = [], []
+
+    async def reply(update, text, **kwargs):
+        replies.append(text)
+    monkeypatch.setattr(bot, 'MEDIA_GROUP_WINDOW', 0.05)
+    monkeypatch.setattr(bot, 'ADMIN_DIGEST_INTERVAL', 0)
+    monkeypatch.setattr(bot, '_store_document', store)
+    monkeypatch.setattr(bot, 'reply', reply)
+    monkeypatch.setattr(bot, 'send_to_admin', lambda bot_, messages, caption: forwarded.append(len(messages)))
+    caplog.handler.addFilter(bot.TraceIdFilter())
+
+    async def scenario():
+        application = SimpleNamespace(run_for_user=lambda user_id, ingest: asyncio.create_task(ingest()))
+        context = SimpleNamespace(bot=None, application=application,
+                                  user_data={'f_id': 'folder-1', 'phone': '9001', 'student_name': 'Asha'})
+        bot.trace_id.set('u42')
+        for outcome in ('ok', 'ok', 'dup', 'fail'):
+            message = SimpleNamespace(media_group_id='g1', photo=None, outcome=outcome)
+            bot.collect_media_group(SimpleNamespace(effective_user=SimpleNamespace(id=7), message=message), context)
+        await asyncio.wait_for(_until(lambda: replies), 2)
+        return context.user_data
+
+    user_data = asyncio.run(scenario())
+    assert user_data['doc_count'] == 2 and bot.get_doc_count(7) == 2
+    assert forwarded == [2] and len(replies) == 1
+    assert '♻️ 1' in replies[0] and '⚠️ 1' in replies[0]
+    [error] = [r for r in caplog.records if r.levelname == 'ERROR']
+    assert error.trace_id == 'u42' and error.exc_info[0] is RuntimeError
+    assert capsys.readouterr().out == ''
+
+
+# ---------- Document dedup ----------
+def test_files_sent_before_the_folder_stay_deduplicated(db):
+    pending = bot.pending_folder_scope('9001', 'asha')
+    assert bot.claim_uploaded_file(pending, 'f1', 'h1') is None
+    assert bot.claim_uploaded_file(pending, 'f2', 'h2') is None
+    bot.claim_uploaded_file('folder-1', 'f2', 'h2')  # Already stored there by a racing upload
+    assert bot.register_folder('9001', 'asha', '9001_Asha', 'folder-1', 'link') == ('folder-1', 'link')
+    assert bot.is_uploaded_file('folder-1', 'f1')
+    assert bot.claim_uploaded_file('folder-1', 'f3', 'h1') == 'hash'
+    assert bot.db_fetchone("SELECT COUNT(*) FROM uploaded_files WHERE folder_id = ?", (pending,))[0] == 0
+
+
+# ---------- Outbox ----------
+def test_upload_behind_stuck_folder_job_becomes_stuck(db):
+    import asyncio
+    from types import SimpleNamespace
+    bot.enqueue_outbox('folder', bot.folder_job_key('9001', 'asha'), {'phone': '9001', 'name_norm': 'asha', 'name': 'Asha'})
+    folder_id = bot.db_fetchone("SELECT id FROM outbox WHERE kind = 'folder'")[0]
+    bot.mark_outbox_stuck(folder_id, 'HttpError 500', bot.OUTBOX_MAX_ATTEMPTS)
+    bot.enqueue_outbox('upload', 'upload:pending:9001:asha:f1', 
+                       {'folder_id': None, 'phone': '9001', 'name_norm': 'asha', 'filename': 'a.pdf', 'file_id': 'f1', 'size': 1})
+
+    async def send_message(**kwargs):
+        pass
+    app = SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+    asyncio.run(bot.replay_outbox(app))
+    assert bot.get_outbox_status('upload:pending:9001:asha:f1') == 'stuck'
+
+def test_upload_waits_for_pending_folder_job(db):
+    import asyncio
+    from types import SimpleNamespace
+    bot.enqueue_outbox('folder', bot.folder_job_key('9001', 'asha'), {'phone': '9001', 'name_norm': 'asha', 'name': 'Asha'}, 
+                       delay=3600)
+    bot.enqueue_outbox('upload', 'upload:pending:9001:asha:f1', 
+                       {'folder_id': None, 'phone': '9001', 'name_norm': 'asha', 'filename': 'a.pdf', 'file_id': 'f1', 'size': 1})
+    asyncio.run(bot.replay_outbox(SimpleNamespace(bot=None)))
+    assert bot.db_fetchone("SELECT status, attempts FROM outbox WHERE kind = 'upload'") == ('pending', 0)
+
+
+# ---------- Workers ----------
+def serve_requests(handle_update, *requests, secret=None):
+    """Send raw HTTP requests, one connection each, to _serve_updates; return the status lines"""
+    import asyncio
+
+    async def run():
+        server = await asyncio.start_server(bot._serve_updates('/update', handle_update, secret=secret), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        statuses = []
+        for request in requests:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            await writer.drain()
+            statuses.append((await reader.readline()).decode().strip())
+            writer.close()
+        server.close()
+        return statuses
+    return asyncio.run(run())
+
+def post(body, length=None, secret='s3cret'):
+    return (f"POST /update HTTP/1.1\r\nContent-Length: {len(body) if length is None else length}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n\r\n").encode() + body
+
+def test_webhook_checks_headers_before_reading_the_body():
+    received = []
+
+    async def handle_update(data):
+        received.append(data)
+    statuses = serve_requests(handle_update, post(b'{"update_id": 1}'), post(b'', length=10 ** 9),
+                              post(b'{}', secret='wrong'), post(b'{}', length='abc'), b"GET /update HTTP/1.1\r\n\r\n",
+                              secret='s3cret')
+    assert statuses == ["HTTP/1.1 200 OK", "HTTP/1.1 413 Payload Too Large", "HTTP/1.1 403 Forbidden",
+                        "HTTP/1.1 400 Bad Request", "HTTP/1.1 404 Not Found"]
+    assert received == [{'update_id': 1}]
+
+def test_worker_answers_bad_updates_instead_of_dropping_the_connection():
+    async def handle_update(data):
+        if data.get('stopping'):
+            raise bot.UpdateNotAccepted("stopping")
+        raise TypeError("bad update")
+    statuses = serve_requests(handle_update, post(b'{"update_id": 1}'), post(b'{"stopping": true}'), post(b'not json'))
+    assert statuses == ["HTTP/1.1 400 Bad Request", "HTTP/1.1 503 Service Unavailable", "HTTP/1.1 400 Bad Request"]
+
+@pytest.mark.parametrize('replies, delivered, attempts', [
+    (['connect', 503, 200], True, 3),
+    ([400], False, 1),
+    ([500], False, 1),
+    ([503] * 5, False, 3),
+])
+def test_dispatcher_retries_only_unreachable_workers(monkeypatch, replies, delivered, attempts):
+    import asyncio
+    import httpx
+    monkeypatch.setattr(bot, 'FORWARD_MAX_ATTEMPTS', 3)
+    sent = []
+
+    def reply(request):
+        sent.append(request)
+        status = replies[len(sent) - 1]
+        if status == 'connect':
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(status)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(reply)) as client:
+            return await bot.Dispatcher(1).post_update(client, 'http://worker/update', 0, {'update_id': 7}, retry_delay=0)
+    assert asyncio.run(run()) is delivered
+    assert len(sent) == attempts
+
+def test_polled_updates_are_confirmed_only_once_a_worker_took_them():
+    import asyncio
+    from types import SimpleNamespace
+    calls = []
+
+    async def run():
+        release = asyncio.Event()
+        dispatcher = bot.Dispatcher(1)
+
+        async def post_update(client, url, index, data):
+            await release.wait()
+            return True
+        dispatcher.post_update = post_update
+
+        async def get_updates(offset=None, timeout=None, limit=None, **kwargs):
+            calls.append(offset)
+            if len(calls) == 1:
+                return [SimpleNamespace(update_id=i, to_dict=lambda i=i: {'update_id': i}) for i in (1, 2)]
+            if timeout:
+                await asyncio.Event().wait()  # Long poll with nothing new
+            return []
+
+        async def delete_webhook():
+            pass
+        telegram = SimpleNamespace(get_updates=get_updates, delete_webhook=delete_webhook)
+        tasks = [asyncio.create_task(dispatcher.poll(telegram)), asyncio.create_task(dispatcher.forward(0))]
+        await asyncio.sleep(0.05)
+        assert dispatcher.offset is None  # Not yet with a worker: Telegram would deliver them again
+        release.set()
+        await _until(lambda: dispatcher.offset == 3)
+        for task in tasks:
+            task.cancel()
+        await dispatcher.confirm_polled(telegram)
+    asyncio.run(run())
+    assert calls == [None, 3, 3]
+
+def test_stuck_upload_lets_the_student_send_the_file_again(db):
+    import asyncio
+    from types import SimpleNamespace
+    scope = bot.pending_folder_scope('9001', 'asha')
+    assert bot.claim_uploaded_file(scope, 'f1', 'h1') is None
+    bot.enqueue_outbox('folder', bot.folder_job_key('9001', 'asha'), {'phone': '9001', 'name_norm': 'asha', 'name': 'Asha'})
+    folder_job = bot.db_fetchone("SELECT id FROM outbox WHERE kind = 'folder'")[0]
+    bot.mark_outbox_stuck(folder_job, 'HttpError 500', bot.OUTBOX_MAX_ATTEMPTS)
+    bot.enqueue_outbox('upload', f'upload:{scope}:f1', {'folder_id': None, 'phone': '9001', 'name_norm': 'asha', 
+                                                        'filename': 'a.pdf', 'file_id': 'f1', 'file_unique_id': 'f1', 'size': 1})
+
+    async def send_message(**kwargs):
+        pass
+    asyncio.run(bot.replay_outbox(SimpleNamespace(bot=SimpleNamespace(send_message=send_message))))
+    assert bot.get_outbox_status(f'upload:{scope}:f1') == 'stuck'
+    assert bot.claim_uploaded_file(scope, 'f1', 'h1') is None  # The resend is taken, not reported as a duplicate
+
+def test_stuck_upload_releases_a_claim_moved_to_the_folder(db):
+    scope = bot.pending_folder_scope('9001', 'asha')
+    bot.claim_uploaded_file(scope, 'f1', 'h1')
+    bot.register_folder('9001', 'asha', '9001_Asha', 'folder-1', 'link')
+    bot.enqueue_outbox('upload', f'upload:{scope}:f1', {'folder_id': None, 'phone': '9001', 'name_norm': 'asha', 
+                                                        'filename': 'a.pdf', 'file_id': 'f1', 'size': 1})
+    job = bot.db_fetchone("SELECT id FROM outbox WHERE kind = 'upload'")[0]
+    bot.mark_outbox_stuck(job, 'HttpError 500', bot.OUTBOX_MAX_ATTEMPTS)
+    assert not bot.is_uploaded_file('folder-1', 'f1')
+
+def test_album_ingestion_is_persisted(db):
+    """user_data changed by work queued with run_for_user (albums) is saved like an update's"""
+    import asyncio
+    from telegram.ext import Application
+
+    async def scenario():
+        persistence = bot.SQLiteUserPersistence(update_interval=60)
+        app = (Application.builder().token('1:test').application_class(bot.OrderedApplication)
+               .persistence(persistence).updater(None).build())
+        app._initialized = app._running = True  # Skip initialize()/start(): they would call Telegram
+        user_data = app.user_data[7]
+        await persistence.refresh_user_data(7, user_data)
+
+        async def ingest():
+            user_data['doc_count'] = 3
+        app.run_for_user(7, ingest)
+        await asyncio.wait_for(_until(lambda: 7 not in bot._user_queues), 2)
+        await app.update_persistence()
+        await asyncio.wait_for(_until(lambda: bot.load_user_state(7) is not None), 2)
+
+    asyncio.run(scenario())
+    assert bot.load_user_state(7) == {'doc_count': 3}
+
+def test_persistence_writes_only_changed_users_in_one_batch(db, monkeypatch):
+    import asyncio
+    writes = []
+    save = bot.save_user_states
+    monkeypatch.setattr(bot, 'save_user_states', lambda states: (writes.append(sorted(states)), save(states)))
+
+    async def scenario():
+        persistence = bot.SQLiteUserPersistence()
+        await persistence.update_user_data(1, {'step': 'name'})
+        await persistence.update_user_data(2, {'step': 'phone'})
+        await persistence.flush()
+        await persistence.update_user_data(1, {'step': 'name'})  # Touched but unchanged
+        await persistence.flush()
+
+    asyncio.run(scenario())
+    assert writes == [[(1, '{"step": "name"}'), (2, '{"step": "phone"}')]]
+
+def test_evicted_user_keeps_saved_state_and_reloads_it(db):
+    import asyncio
+
+    class App:
+        dropped = []
+
+        def drop_user_data(self, user_id):
+            self.dropped.append(user_id)
+
+    async def scenario():
+        persistence = bot.SQLiteUserPersistence()
+        await persistence.refresh_user_data(1, {})
+        await persistence.update_user_data(1, {'step': 'docs'})
+        await persistence.flush()
+        assert persistence.evict_idle(App(), max_idle=-1) == 1
+        await persistence.drop_user_data(1)  # The Application's drop after an eviction
+        assert bot.load_user_state(1) == {'step': 'docs'}
+
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        assert user_data == {'step': 'docs'}
+        await persistence.drop_user_data(1)  # A real drop deletes the row
+        assert bot.load_user_state(1) is None
+
+    asyncio.run(scenario())
+    assert App.dropped == [1]
+
+
+# ---------- Outbound scheduler ----------
+def test_token_bucket_paces_after_the_burst():
+    bucket = bot.TokenBucket(rate=2.0, burst=2)
+    assert bucket.delay() == 0
+    bucket.take()
+    bucket.take()
+    assert 0.4 < bucket.delay() <= 0.5
+    bucket.block(3)
+    assert 3.4 < bucket.delay() <= 3.5
+    assert not bucket.idle()
+
+def test_reply_overtakes_a_chats_queued_backlog_in_order():
+    import asyncio
+    sent = []
+
+    async def scenario():
+        scheduler = bot.OutboundScheduler(workers=1, global_rate=1000, chat_rate=1000, chat_burst=1)
+        scheduler.start()
+
+        async def send(chat_id, text):
+            sent.append((chat_id, text))
+        futures = [scheduler.submit(bot.PRIORITY_ADMIN, 1, send, 1, f"forward {i}") for i in range(3)]
+        futures.append(scheduler.submit(bot.PRIORITY_NOTIFY, 1, send, 1, "notify"))
+        futures.append(scheduler.submit(bot.PRIORITY_REPLY, 1, send, 1, "reply"))
+        futures.append(scheduler.submit(bot.PRIORITY_ADMIN, 2, send, 2, "other chat"))
+        await asyncio.wait_for(asyncio.gather(*futures), 2)
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert [text for chat, text in sent if chat == 1] == ["reply", "notify", "forward 0", "forward 1", "forward 2"]
+    assert (2, "other chat") in sent
+
+
+# ---------- Metrics ----------
+def test_render_metrics_prometheus_text_format(monkeypatch):
+    monkeypatch.setattr(bot, '_metrics', [])
+    errors = bot.Counter('t_errors_total', 'Failed calls')
+    active = bot.Gauge('t_active', 'Active users', func=lambda: 3)
+    seconds = bot.Histogram('t_seconds', 'Call latency', buckets=(0.1, 1.0))
+    errors.inc(op='append')
+    errors.inc(2, op='append')
+    seconds.observe(0.05, op='get')
+    seconds.observe(0.5, op='get')
+    seconds.observe(5, op='get')
+    assert bot.render_metrics() == (
+        '# HELP t_errors_total Failed calls\n'
+        '# TYPE t_errors_total counter\n'
+        't_errors_total{op="append"} 3\n'
+        '# HELP t_active Active users\n'
+        '# TYPE t_active gauge\n'
+        't_active 3\n'
+        '# HELP t_seconds Call latency\n'
+        '# TYPE t_seconds histogram\n'
+        't_seconds_bucket{op="get",le="0.1"} 1\n'
+        't_seconds_bucket{op="get",le="1.0"} 2\n'
+        't_seconds_bucket{op="get",le="+Inf"} 3\n'
+        't_seconds_sum{op="get"} 5.55\n'
+        't_seconds_count{op="get"} 3\n')
+    assert seconds.quantile(0.5, (('op', 'get'),)) == 1.0
+
+
+# ---------- Startup ----------
+def test_import_loads_no_google_client_and_touches_no_files(tmp_path):
+    import os
+    import subprocess
+    import sys
+    check = ("import sys, bot; print(' '.join(m for m in ('gspread', 'googleapiclient', 'google.oauth2', "
+             "'httplib2', 'requests') if m in sys.modules))")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(bot.__file__)))
+    result = subprocess.run([sys.executable, '-c', check], cwd=tmp_path, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ''
+    assert os.listdir(tmp_path) == []  # queue.db is only opened by create_app()
+
+
+# ---------- Google credentials ----------
+def test_credentials_are_loaded_once_and_refreshed_before_expiry(tmp_path, monkeypatch):
+    import datetime
+    from google.oauth2 import credentials
+
+    class FakeCreds:
+        token = 'token'
+        expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        refreshes = 0
+
+        def refresh(self, request):
+            self.refreshes += 1
+            self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    creds, loads = FakeCreds(), []
+    monkeypatch.setattr(credentials.Credentials, 'from_authorized_user_info', staticmethod(lambda info: loads.append(info) or creds))
+    (tmp_path / 'token.json').write_text('{"refresh_token": "r"}')
+    monkeypatch.setattr(bot, 'TOKEN_FILE', str(tmp_path / 'token.json'))
+    monkeypatch.setattr(bot, '_creds', None)
+    monkeypatch.setattr(bot, '_auth_session', None)
+    assert bot.get_creds() is creds and bot.get_creds() is creds
+    assert loads == [{'refresh_token': 'r'}] and creds.refreshes == 0
+    creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=bot.TOKEN_REFRESH_MARGIN - 60)
+    bot.get_creds()
+    bot.get_creds()
+    assert creds.refreshes == 1
+
+
+# ---------- Google worker pool ----------
+def test_google_call_holds_its_slot_until_the_thread_returns(monkeypatch):
+    """A timed-out call keeps its API slot, so the pool is never oversubscribed"""
+    import asyncio
+    import threading
+    monkeypatch.setitem(bot.GOOGLE_CONCURRENCY, 'sheets', 1)
+    release = threading.Event()
+
+    def slow_read():
+        release.wait(5)
+        return 'late'
+
+    async def scenario():
+        bot._google_semaphores.clear()
+        with pytest.raises(bot.GoogleCallTimeout) as timed_out:
+            await bot.run_google('sheets', slow_read, timeout=0.05)
+        waiting = asyncio.create_task(bot.run_google('sheets', lambda: 'next'))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        assert await bot.run_google('drive', lambda: 'drive') == 'drive'  # Other APIs have their own slots
+        release.set()
+        assert await asyncio.wait_for(waiting, 2) == 'next'
+        assert timed_out.value.future.result() == 'late'
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        bot._google_semaphores.clear()
+
+
+# ---------- Document streaming ----------
+def test_memory_budget_holds_back_uploads_over_the_limit():
+    import asyncio
+    budget = bot.MemoryBudget(100)
+    order = []
+
+    async def upload(name, nbytes, hold):
+        async with budget.reserve(nbytes):
+            order.append(f"start {name}")
+            await hold.wait()
+            order.append(f"end {name}")
+
+    async def scenario():
+        first, second, huge = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        tasks = [asyncio.create_task(upload('a', 60, first))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(upload('b', 60, second)))
+        await asyncio.sleep(0.01)
+        assert order == ["start a"] and budget.in_use == 60  # 'b' waits for room
+        first.set()
+        await _until(lambda: "start b" in order)
+        tasks.append(asyncio.create_task(upload('huge', 10 ** 9, huge)))  # Capped at the limit: runs alone
+        second.set()
+        await _until(lambda: "start huge" in order)
+        assert budget.in_use == 100
+        huge.set()
+        await asyncio.gather(*tasks)
+        assert budget.in_use == 0
+
+    asyncio.run(scenario())
+
+def test_small_files_stay_in_memory_and_large_ones_are_spooled():
+    import asyncio
+    import hashlib
+
+    class TelegramFile:
+        file_path = 'documents/file.pdf'  # Local Bot API server: read through download_to_memory
+
+        def __init__(self, data):
+            self.data = data
+
+        async def download_to_memory(self, out):
+            out.write(self.data)
+
+    async def scenario():
+        small, large = b'x' * 1000, b'y' * (bot.SPOOL_THRESHOLD + 1)
+        stream, sha256 = await bot.download_telegram_file(TelegramFile(small), len(small))
+        assert isinstance(stream, bot.io.BytesIO) and stream.read() == small
+        assert sha256 == hashlib.sha256(small).hexdigest()
+        for size in (len(large), None):  # Unknown sizes are spooled too
+            stream, sha256 = await bot.download_telegram_file(TelegramFile(large), size)
+            assert not isinstance(stream, bot.io.BytesIO) and stream.read() == large
+            assert sha256 == hashlib.sha256(large).hexdigest()
+            stream.close()
+
+    asyncio.run(scenario())
+    assert bot.upload_memory_cost(1000) == 1000
+    assert bot.upload_memory_cost(bot.SPOOL_THRESHOLD + 1) == bot.upload_memory_cost(None) == bot.UPLOAD_CHUNK_SIZE